@@ -0,0 +1,5 @@
+-- Hash of the payload last exported to Salesforce, used to skip unchanged rows on export.
+ALTER TABLE entity_integration ADD COLUMN IF NOT EXISTS export_hash text;
+
+CREATE INDEX IF NOT EXISTS entity_integration_entity_type_id_entity_based_id_idx
+    ON entity_integration (entity_type_id, entity_based_id);
@@ -0,0 +1,110 @@
+-- Leases on tenants, so sync workers on several nodes each sync a tenant at a time, see sync/lease.py.
+-- A worker claims due tenants, marks a lease started when it begins syncing the tenant, renews its
+-- leases while it holds them and releases each one when done. Expired leases can be claimed by any
+-- worker, and claimed leases not started yet can be taken by idle workers.
+CREATE TABLE IF NOT EXISTS sync_lease (
+    tenant_id bigint PRIMARY KEY,
+    owner text,
+    expires_at timestamptz,
+    started_at timestamptz,
+    heartbeat_at timestamptz,
+    next_sync_at timestamptz NOT NULL DEFAULT now(),
+    synced_at timestamptz,
+    last_error text
+);
+
+CREATE INDEX IF NOT EXISTS sync_lease_next_sync_at_idx ON sync_lease (next_sync_at);
+CREATE INDEX IF NOT EXISTS sync_lease_owner_idx ON sync_lease (owner) WHERE owner IS NOT NULL;
+
+-- Add a lease row for every tenant with a Salesforce connection.
+CREATE OR REPLACE FUNCTION register_sync_tenants() RETURNS integer LANGUAGE sql AS $$
+    WITH inserted AS (
+        INSERT INTO sync_lease (tenant_id)
+        SELECT DISTINCT tenant_id FROM integration_connection WHERE connection_key = 'salesforce'
+        ON CONFLICT (tenant_id) DO NOTHING
+        RETURNING 1
+    )
+    SELECT count(*)::integer FROM inserted;
+$$;
+
+-- Claim up to p_limit due tenants whose lease is free or expired. When there aren't enough, take
+-- leases not started yet from workers holding more than one of them.
+CREATE OR REPLACE FUNCTION claim_sync_leases(p_owner text, p_limit integer, p_ttl_seconds double precision)
+RETURNS SETOF sync_lease LANGUAGE plpgsql AS $$
+DECLARE
+    claimed integer;
+BEGIN
+    RETURN QUERY
+    WITH free AS (
+        SELECT tenant_id FROM sync_lease
+        WHERE next_sync_at <= now() AND (owner IS NULL OR expires_at < now())
+        ORDER BY next_sync_at
+        LIMIT p_limit
+        FOR UPDATE SKIP LOCKED
+    )
+    UPDATE sync_lease l
+    SET owner = p_owner, expires_at = now() + make_interval(secs => p_ttl_seconds), started_at = NULL,
+        heartbeat_at = now()
+    FROM free WHERE l.tenant_id = free.tenant_id
+    RETURNING l.*;
+    GET DIAGNOSTICS claimed = ROW_COUNT;
+
+    IF claimed < p_limit THEN
+        RETURN QUERY
+        WITH queued AS (
+            SELECT owner FROM sync_lease
+            WHERE started_at IS NULL AND expires_at >= now() AND owner <> p_owner
+            GROUP BY owner HAVING count(*) > 1
+        ), stolen AS (
+            SELECT l.tenant_id FROM sync_lease l JOIN queued q ON q.owner = l.owner
+            WHERE l.started_at IS NULL AND l.expires_at >= now()
+            ORDER BY l.next_sync_at
+            LIMIT p_limit - claimed
+            FOR UPDATE OF l SKIP LOCKED
+        )
+        UPDATE sync_lease l
+        SET owner = p_owner, expires_at = now() + make_interval(secs => p_ttl_seconds), started_at = NULL,
+            heartbeat_at = now()
+        FROM stolen WHERE l.tenant_id = stolen.tenant_id
+        RETURNING l.*;
+    END IF;
+END;
+$$;
+
+-- Mark a claimed lease started; false if another worker has taken it since.
+CREATE OR REPLACE FUNCTION start_sync_lease(p_owner text, p_tenant_id bigint, p_ttl_seconds double precision)
+RETURNS boolean LANGUAGE sql AS $$
+    WITH started AS (
+        UPDATE sync_lease
+        SET started_at = now(), expires_at = now() + make_interval(secs => p_ttl_seconds), heartbeat_at = now()
+        WHERE tenant_id = p_tenant_id AND owner = p_owner
+        RETURNING 1
+    )
+    SELECT EXISTS (SELECT 1 FROM started);
+$$;
+
+-- Extend the leases still held by p_owner, returning their tenants.
+CREATE OR REPLACE FUNCTION renew_sync_leases(p_owner text, p_tenant_ids bigint[], p_ttl_seconds double precision)
+RETURNS SETOF bigint LANGUAGE sql AS $$
+    UPDATE sync_lease
+    SET expires_at = now() + make_interval(secs => p_ttl_seconds), heartbeat_at = now()
+    WHERE owner = p_owner AND tenant_id = ANY (p_tenant_ids)
+    RETURNING tenant_id;
+$$;
+
+-- Give up a lease. After a sync (p_synced), the tenant is next due p_next_sync_seconds from now.
+CREATE OR REPLACE FUNCTION release_sync_lease(p_owner text, p_tenant_id bigint, p_synced boolean,
+                                              p_next_sync_seconds double precision, p_error text)
+RETURNS boolean LANGUAGE sql AS $$
+    WITH released AS (
+        UPDATE sync_lease
+        SET owner = NULL, expires_at = NULL, started_at = NULL, heartbeat_at = NULL,
+            synced_at = CASE WHEN p_synced THEN now() ELSE synced_at END,
+            next_sync_at = CASE WHEN p_synced THEN now() + make_interval(secs => p_next_sync_seconds)
+                                ELSE next_sync_at END,
+            last_error = CASE WHEN p_synced THEN p_error ELSE last_error END
+        WHERE tenant_id = p_tenant_id AND owner = p_owner
+        RETURNING 1
+    )
+    SELECT EXISTS (SELECT 1 FROM released);
+$$;
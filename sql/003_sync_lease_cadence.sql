@@ -0,0 +1,28 @@
+-- Schedule state of each tenant's adaptive sync interval, see sync/cadence.py.
+ALTER TABLE sync_lease ADD COLUMN IF NOT EXISTS change_rate double precision;
+ALTER TABLE sync_lease ADD COLUMN IF NOT EXISTS sync_interval double precision;
+ALTER TABLE sync_lease ADD COLUMN IF NOT EXISTS last_changes integer;
+
+-- Releasing a synced lease also saves the tenant's change rate and interval.
+DROP FUNCTION IF EXISTS release_sync_lease(text, bigint, boolean, double precision, text);
+
+CREATE OR REPLACE FUNCTION release_sync_lease(p_owner text, p_tenant_id bigint, p_synced boolean,
+                                              p_next_sync_seconds double precision, p_error text,
+                                              p_changes integer DEFAULT NULL,
+                                              p_change_rate double precision DEFAULT NULL)
+RETURNS boolean LANGUAGE sql AS $$
+    WITH released AS (
+        UPDATE sync_lease
+        SET owner = NULL, expires_at = NULL, started_at = NULL, heartbeat_at = NULL,
+            synced_at = CASE WHEN p_synced THEN now() ELSE synced_at END,
+            next_sync_at = CASE WHEN p_synced THEN now() + make_interval(secs => p_next_sync_seconds)
+                                ELSE next_sync_at END,
+            last_error = CASE WHEN p_synced THEN p_error ELSE last_error END,
+            sync_interval = CASE WHEN p_synced THEN p_next_sync_seconds ELSE sync_interval END,
+            last_changes = CASE WHEN p_synced THEN p_changes ELSE last_changes END,
+            change_rate = CASE WHEN p_synced THEN coalesce(p_change_rate, change_rate) ELSE change_rate END
+        WHERE tenant_id = p_tenant_id AND owner = p_owner
+        RETURNING 1
+    )
+    SELECT EXISTS (SELECT 1 FROM released);
+$$;
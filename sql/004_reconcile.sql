@@ -0,0 +1,61 @@
+-- Hash summaries of linked records for sync/reconcile.py.
+--
+-- Records are bucketed by the hex MD5 of their Salesforce ID. A record's leaf hash is the MD5 of
+-- its Salesforce ID and compared column values (NULL as \N), separated by '|'; a bucket's hash is
+-- the MD5 of its leaf hashes in order. p_columns lists the compared columns as
+-- [{"table": ..., "via": ..., "column": ...}], where "via" is the column of the entity table
+-- pointing at a parent table, or null for the entity table itself.
+CREATE INDEX IF NOT EXISTS entity_integration_entity_type_id_salesforce_id_md5_idx
+    ON entity_integration (entity_type_id, md5(salesforce_id) text_pattern_ops);
+
+CREATE OR REPLACE FUNCTION reconcile_leaf_query(p_entity_type integer, p_table text, p_columns jsonb, p_prefix text)
+RETURNS text LANGUAGE plpgsql IMMUTABLE AS $$
+DECLARE
+    spec jsonb;
+    joins text := '';
+    values_ text[] := '{}';
+    parents jsonb := '{}';
+    alias text;
+BEGIN
+    FOR spec IN SELECT * FROM jsonb_array_elements(p_columns) LOOP
+        IF spec->>'via' IS NULL THEN
+            alias := 'e';
+        ELSE
+            alias := parents->>(spec->>'via');
+            IF alias IS NULL THEN
+                alias := 'p' || (SELECT count(*) FROM jsonb_object_keys(parents));
+                parents := parents || jsonb_build_object(spec->>'via', alias);
+                joins := joins || format(' LEFT JOIN %I %s ON %s.id = e.%I', spec->>'table', alias, alias,
+                                         spec->>'via');
+            END IF;
+        END IF;
+        values_ := values_ || format('coalesce(%s.%I::text, %L)', alias, spec->>'column', '\N');
+    END LOOP;
+    RETURN format(
+        'SELECT md5(ei.salesforce_id) AS key, ei.salesforce_id, ei.entity_based_id::text AS entity_based_id,'
+        ' md5(ei.salesforce_id || %L || concat_ws(%L, %s)) AS leaf'
+        ' FROM entity_integration ei JOIN %I e ON e.id = ei.entity_based_id%s'
+        ' WHERE ei.entity_type_id = %s AND md5(ei.salesforce_id) LIKE %L',
+        '|', '|', array_to_string(values_, ', '), p_table, joins, p_entity_type, p_prefix || '%');
+END;
+$$;
+
+-- Record count and hash of each bucket one hex digit below p_prefix.
+CREATE OR REPLACE FUNCTION reconcile_buckets(p_entity_type integer, p_table text, p_columns jsonb, p_prefix text)
+RETURNS TABLE (bucket text, records bigint, hash text) LANGUAGE plpgsql STABLE AS $$
+BEGIN
+    RETURN QUERY EXECUTE format(
+        'SELECT left(l.key, %s), count(*), md5(string_agg(l.leaf, %L ORDER BY l.leaf COLLATE "C"))'
+        ' FROM (%s) l GROUP BY 1',
+        length(p_prefix) + 1, '', reconcile_leaf_query(p_entity_type, p_table, p_columns, p_prefix));
+END;
+$$;
+
+-- Leaf hashes of the records in the bucket p_prefix.
+CREATE OR REPLACE FUNCTION reconcile_leaves(p_entity_type integer, p_table text, p_columns jsonb, p_prefix text)
+RETURNS TABLE (salesforce_id text, entity_based_id text, hash text) LANGUAGE plpgsql STABLE AS $$
+BEGIN
+    RETURN QUERY EXECUTE format('SELECT l.salesforce_id, l.entity_based_id, l.leaf FROM (%s) l',
+                                reconcile_leaf_query(p_entity_type, p_table, p_columns, p_prefix));
+END;
+$$;
@@ -0,0 +1,12 @@
+-- Which side last changed a linked record and which version was synced, so neither direction
+-- syncs back the change the other direction just made (see sync/integration.py).
+--
+-- sync_origin: 'salesforce' when the record was last written by an import, 'supabase' by an export.
+-- salesforce_updated_at: updatedTime of the Salesforce record as last imported, or seen as an echo.
+-- synced_at: when the sync last wrote the record to either side.
+ALTER TABLE entity_integration ADD COLUMN IF NOT EXISTS sync_origin text;
+ALTER TABLE entity_integration ADD COLUMN IF NOT EXISTS salesforce_updated_at timestamptz;
+ALTER TABLE entity_integration ADD COLUMN IF NOT EXISTS synced_at timestamptz;
+
+CREATE INDEX IF NOT EXISTS entity_integration_entity_type_id_salesforce_id_idx
+    ON entity_integration (entity_type_id, salesforce_id);
@@ -0,0 +1,65 @@
+-- Scope the reconcile summaries of 004_reconcile.sql to one tenant: only entity rows whose owner
+-- (p_owner_column) is a user of p_tenant_id in user_role are summarized, so the links of other
+-- tenants' records aren't reported as extra. The unscoped functions are dropped.
+DROP FUNCTION IF EXISTS reconcile_buckets(integer, text, jsonb, text);
+DROP FUNCTION IF EXISTS reconcile_leaves(integer, text, jsonb, text);
+DROP FUNCTION IF EXISTS reconcile_leaf_query(integer, text, jsonb, text);
+
+CREATE OR REPLACE FUNCTION reconcile_leaf_query(p_entity_type integer, p_table text, p_columns jsonb, p_prefix text,
+                                                p_tenant_id bigint, p_owner_column text)
+RETURNS text LANGUAGE plpgsql IMMUTABLE AS $$
+DECLARE
+    spec jsonb;
+    joins text := '';
+    values_ text[] := '{}';
+    parents jsonb := '{}';
+    alias text;
+BEGIN
+    FOR spec IN SELECT * FROM jsonb_array_elements(p_columns) LOOP
+        IF spec->>'via' IS NULL THEN
+            alias := 'e';
+        ELSE
+            alias := parents->>(spec->>'via');
+            IF alias IS NULL THEN
+                alias := 'p' || (SELECT count(*) FROM jsonb_object_keys(parents));
+                parents := parents || jsonb_build_object(spec->>'via', alias);
+                joins := joins || format(' LEFT JOIN %I %s ON %s.id = e.%I', spec->>'table', alias, alias,
+                                         spec->>'via');
+            END IF;
+        END IF;
+        values_ := values_ || format('coalesce(%s.%I::text, %L)', alias, spec->>'column', '\N');
+    END LOOP;
+    RETURN format(
+        'SELECT md5(ei.salesforce_id) AS key, ei.salesforce_id, ei.entity_based_id::text AS entity_based_id,'
+        ' md5(ei.salesforce_id || %L || concat_ws(%L, %s)) AS leaf'
+        ' FROM entity_integration ei JOIN %I e ON e.id = ei.entity_based_id%s'
+        ' WHERE ei.entity_type_id = %s AND md5(ei.salesforce_id) LIKE %L'
+        ' AND EXISTS (SELECT 1 FROM user_role ur WHERE ur.user_id = e.%I AND ur.tenant_id = %s)',
+        '|', '|', array_to_string(values_, ', '), p_table, joins, p_entity_type, p_prefix || '%',
+        p_owner_column, p_tenant_id);
+END;
+$$;
+
+-- Record count and hash of each bucket one hex digit below p_prefix.
+CREATE OR REPLACE FUNCTION reconcile_buckets(p_entity_type integer, p_table text, p_columns jsonb, p_prefix text,
+                                             p_tenant_id bigint, p_owner_column text)
+RETURNS TABLE (bucket text, records bigint, hash text) LANGUAGE plpgsql STABLE AS $$
+BEGIN
+    RETURN QUERY EXECUTE format(
+        'SELECT left(l.key, %s), count(*), md5(string_agg(l.leaf, %L ORDER BY l.leaf COLLATE "C"))'
+        ' FROM (%s) l GROUP BY 1',
+        length(p_prefix) + 1, '',
+        reconcile_leaf_query(p_entity_type, p_table, p_columns, p_prefix, p_tenant_id, p_owner_column));
+END;
+$$;
+
+-- Leaf hashes of the records in the bucket p_prefix.
+CREATE OR REPLACE FUNCTION reconcile_leaves(p_entity_type integer, p_table text, p_columns jsonb, p_prefix text,
+                                            p_tenant_id bigint, p_owner_column text)
+RETURNS TABLE (salesforce_id text, entity_based_id text, hash text) LANGUAGE plpgsql STABLE AS $$
+BEGIN
+    RETURN QUERY EXECUTE format(
+        'SELECT l.salesforce_id, l.entity_based_id, l.leaf FROM (%s) l',
+        reconcile_leaf_query(p_entity_type, p_table, p_columns, p_prefix, p_tenant_id, p_owner_column));
+END;
+$$;
@@ -0,0 +1,23 @@
+-- Update entity_integration rows by id, each with its own values, in one statement (see
+-- update_links in sync/integration.py). PostgREST can only give every row of an update the same
+-- values, and an upsert of partial rows fails the table's NOT NULL checks on its insert path.
+--
+-- p_rows: [{"id": ..., "export_hash": ..., "sync_origin": ..., "salesforce_updated_at": ...,
+-- "synced_at": ...}]; a column missing from a row keeps its value. Returns the rows updated.
+CREATE OR REPLACE FUNCTION update_entity_integration(p_rows jsonb)
+RETURNS integer LANGUAGE sql AS $$
+    WITH updated AS (
+        UPDATE entity_integration ei
+        SET export_hash = CASE WHEN r.link ? 'export_hash' THEN r.link->>'export_hash' ELSE ei.export_hash END,
+            sync_origin = CASE WHEN r.link ? 'sync_origin' THEN r.link->>'sync_origin' ELSE ei.sync_origin END,
+            salesforce_updated_at = CASE WHEN r.link ? 'salesforce_updated_at'
+                                         THEN (r.link->>'salesforce_updated_at')::timestamptz
+                                         ELSE ei.salesforce_updated_at END,
+            synced_at = CASE WHEN r.link ? 'synced_at' THEN (r.link->>'synced_at')::timestamptz
+                             ELSE ei.synced_at END
+        FROM jsonb_array_elements(p_rows) AS r(link)
+        WHERE ei.id = (r.link->>'id')::bigint
+        RETURNING 1
+    )
+    SELECT count(*)::integer FROM updated;
+$$;
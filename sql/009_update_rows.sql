@@ -0,0 +1,28 @@
+-- Update rows of p_table by id, each with its own columns, in one statement (see update_changed in
+-- sync/integration.py). PostgREST can only give every row of an update the same values, and an
+-- upsert of partial rows fails the table's NOT NULL checks on its insert path.
+--
+-- p_rows: [{"id": ..., <column>: <value>, ...}]; values are cast to the column types as by
+-- jsonb_populate_record, and a column missing from a row keeps its value. Returns the rows updated.
+CREATE OR REPLACE FUNCTION update_rows(p_table text, p_rows jsonb)
+RETURNS integer LANGUAGE plpgsql AS $$
+DECLARE
+    columns_ text;
+    updated integer;
+BEGIN
+    SELECT string_agg(DISTINCT format('%I', key), ', ') INTO columns_
+    FROM jsonb_array_elements(p_rows) AS r(link), jsonb_object_keys(r.link) AS key
+    WHERE key <> 'id';
+    IF columns_ IS NULL THEN
+        RETURN 0;
+    END IF;
+    EXECUTE format(
+        'UPDATE %1$I t SET (%2$s) = (SELECT %2$s FROM jsonb_populate_record(t, r.link))'
+        ' FROM jsonb_array_elements($1) AS r(link)'
+        ' WHERE t.id = (jsonb_populate_record(NULL::%1$I, r.link)).id',
+        p_table, columns_)
+    USING p_rows;
+    GET DIAGNOSTICS updated = ROW_COUNT;
+    RETURN updated;
+END;
+$$;
@@ -0,0 +1,24 @@
+-- A synced tenant's synced_at is when its sync started (started_at, set by start_sync_lease), not
+-- when it was released: an incremental import starts from synced_at, so a Salesforce record changed
+-- after its entity was fetched but before the release is imported by the next sync instead of lost.
+-- As in 006_sync_lease_keep_synced_at_on_error.sql, a sync with an error keeps synced_at.
+CREATE OR REPLACE FUNCTION release_sync_lease(p_owner text, p_tenant_id bigint, p_synced boolean,
+                                              p_next_sync_seconds double precision, p_error text,
+                                              p_changes integer DEFAULT NULL,
+                                              p_change_rate double precision DEFAULT NULL)
+RETURNS boolean LANGUAGE sql AS $$
+    WITH released AS (
+        UPDATE sync_lease
+        SET owner = NULL, expires_at = NULL, started_at = NULL, heartbeat_at = NULL,
+            synced_at = CASE WHEN p_synced AND p_error IS NULL THEN coalesce(started_at, now()) ELSE synced_at END,
+            next_sync_at = CASE WHEN p_synced THEN now() + make_interval(secs => p_next_sync_seconds)
+                                ELSE next_sync_at END,
+            last_error = CASE WHEN p_synced THEN p_error ELSE last_error END,
+            sync_interval = CASE WHEN p_synced THEN p_next_sync_seconds ELSE sync_interval END,
+            last_changes = CASE WHEN p_synced AND p_error IS NULL THEN p_changes ELSE last_changes END,
+            change_rate = CASE WHEN p_synced THEN coalesce(p_change_rate, change_rate) ELSE change_rate END
+        WHERE tenant_id = p_tenant_id AND owner = p_owner
+        RETURNING 1
+    )
+    SELECT EXISTS (SELECT 1 FROM released);
+$$;
@@ -1,5 +1,4 @@
-from supabase import create_client, Client
+from sync.clients import registry
 
-from config import SUPABASE_URL, SUPABASE_KEY
-
-sb: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# Resolved to a real Supabase client on first use, see sync.clients
+sb = registry.lazy()
@@ -1,16 +1,47 @@
-import requests
-
-from sync import sb
+from sync import sb, guards, integration, logs, metrics, tracing
+from sync.config import SYNC_EXPORT_BATCH_SIZE
 from sync.enums import EntityType
 
+logger = logs.get_logger(__name__)
+
 
 class Accounts:
-    def __init__(self, access_token: str, salesforce_id: str):
-        session = requests.session()
+    export_url = "https://api.integration.app/connections/salesforce/actions/create-accounts/run"
+    update_url = "https://api.integration.app/connections/salesforce/actions/update-account/run"
+    batch_create_url = "https://api.integration.app/connections/salesforce/actions/batch-create-accounts/run"
+    batch_update_url = "https://api.integration.app/connections/salesforce/actions/batch-update-accounts/run"
+    owner_column = "owner_id"
+    export_columns = "*, phone_book(*)"
+    import_url = "https://api.integration.app/connections/salesforce/actions/get-all-accounts/run"
+    # map_o keys written to their own table first, and the column linking them
+    import_parents = {"phone_book": ("phone_book", "phone_book_id")}
+    # Columns resolved from a Salesforce reference field through entity_integration
+    import_references = {}
+    # Columns of map_o compared by sync.reconcile, by map_o key; text, integer or boolean columns only
+    reconcile_columns = {
+        "account": ("domain", "industry", "no_of_employees"),
+        "phone_book": ("first_name", "phone", "website", "street", "city", "state", "country", "description",
+                       "company"),
+    }
+
+    def __init__(self, access_token: str, salesforce_id: str, journal=None, batch_size: int = None,
+                 since: str = None):
+        """
+        :param journal: Optional ``TenantJournal`` recording pending and failed exports for retry
+        :param batch_size: Records per batch action call on export, defaults to ``SYNC_EXPORT_BATCH_SIZE``;
+            1 exports each record with its own request
+        :param since: Import only records updated after this time, ISO 8601; all records by default
+        """
+        session = guards.GuardedSession()
         session.headers.update({'Authorization': f'Bearer {access_token}'})
         self.session = session
         self.salesforce_id = salesforce_id
+        self.journal = journal
+        self.batch_size = SYNC_EXPORT_BATCH_SIZE if batch_size is None else batch_size
+        self.since = since
 
+    @tracing.traced(entity="account")
+    @metrics.scope(entity="account")
     def delete_from_supabase(self, record_id: str):
         """
         Delete an account from Supabase, the entity_integration table, and Salesforce.
@@ -21,9 +52,8 @@ class Accounts:
         integration_response = sb.table('entity_integration').select('salesforce_id').eq('entity_based_id',
                                                                                          record_id).execute()
         if not integration_response.data:
-            print(
-                f"Failed to retrieve salesforce_id for account {record_id} from entity_integration: "
-                f"{integration_response.json()}")
+            logger.warning("Failed to retrieve salesforce_id from entity_integration",
+                           extra={"record_id": record_id, "response": integration_response.json()})
             return
 
         salesforce_id = integration_response.data[0]['salesforce_id']
@@ -31,49 +61,62 @@ class Accounts:
         # Attempt to delete from Salesforce using the retrieved salesforce_id
         self.delete_from_salesforce(salesforce_id)
 
-    def delete_from_salesforce(self, salesforce_id: str):
+    @tracing.traced(entity="account")
+    @metrics.scope(entity="account")
+    def delete_from_salesforce(self, salesforce_id: str) -> bool:
         """
         Delete an account from Salesforce and Supabase.
 
         :param salesforce_id: The Salesforce ID of the account to delete
+        :return: True if the account was deleted from Salesforce, False otherwise
         """
         url = "https://api.integration.app/connections/salesforce/actions/delete-records/run"
         payload = {
             "id": salesforce_id
         }
         salesforce_response = self.session.post(url, json=payload)
-        if salesforce_response.status_code == 200:
-            print(f"Successfully deleted account {salesforce_id} from Salesforce")
+        # 404: already deleted in Salesforce, which is what was asked for (as in integration._delete_linked)
+        if salesforce_response.status_code in (200, 404):
+            logger.info("Deleted account from Salesforce", extra={"salesforce_id": salesforce_id,
+                                                                  "status_code": salesforce_response.status_code})
+            if self.journal:
+                self.journal.done("account", "delete", salesforce_id)
         else:
-            print(f"Failed to delete account {salesforce_id} from Salesforce: {salesforce_response.json()}")
-            return
+            logger.error("Failed to delete account from Salesforce",
+                         extra={"salesforce_id": salesforce_id, "status_code": salesforce_response.status_code,
+                                "response": salesforce_response.json()})
+            if self.journal:
+                self.journal.failed("account", "delete", salesforce_id,
+                                    f"HTTP {salesforce_response.status_code}: {salesforce_response.text}")
+            return False
 
         # Retrieve the entity_based_id from the entity_integration table
         integration_response = sb.table('entity_integration').select('entity_based_id').eq('salesforce_id',
                                                                                            salesforce_id).execute()
         if not integration_response.data:
-            print(
-                f"Failed to retrieve entity_based_id for salesforce_id {salesforce_id} from entity_integration: "
-                f"{integration_response.json()}")
-            return
+            logger.warning("Failed to retrieve entity_based_id from entity_integration",
+                           extra={"salesforce_id": salesforce_id, "response": integration_response.json()})
+            return True
 
         entity_based_id = integration_response.data[0]['entity_based_id']
 
         # Delete from Supabase account table
         supabase_response = sb.table('account').delete().eq('id', entity_based_id).execute()
         if supabase_response.data:
-            print(f"Successfully deleted account {entity_based_id} from Supabase")
+            logger.info("Deleted account from Supabase", extra={"record_id": entity_based_id})
         else:
-            print(f"Failed to delete account {entity_based_id} from Supabase: {supabase_response.json()}")
+            logger.error("Failed to delete account from Supabase",
+                         extra={"record_id": entity_based_id, "response": supabase_response.json()})
 
         # Delete from entity_integration table
         integration_response = sb.table('entity_integration').delete().eq('entity_based_id', entity_based_id).execute()
+        integration.forget_links(EntityType.ACCOUNT, [salesforce_id])
         if integration_response.data:
-            print(f"Successfully deleted entity integration for account {entity_based_id} from Supabase")
+            logger.info("Deleted account entity integration from Supabase", extra={"record_id": entity_based_id})
         else:
-            print(
-                f"Failed to delete entity integration for account {entity_based_id} from Supabase: "
-                f"{integration_response.json()}")
+            logger.error("Failed to delete account entity integration from Supabase",
+                         extra={"record_id": entity_based_id, "response": integration_response.json()})
+        return True
 
     @staticmethod
     def map_i(row: dict) -> dict:
@@ -107,17 +150,9 @@ class Accounts:
 
         fields = row['fields']
 
-        # Get the group ID using the tenant ID
-        group_response = sb.table('entity_group').select('id').eq('tenant_id', tenant_id).limit(1).execute()
-        group_id = group_response.data[0]['id'] if group_response.data else None
-
-        # Get the stage ID using the group ID
-        stage_response = sb.table('entity_stage').select('id').eq('group_id', group_id).limit(1).execute()
-        stage_id = stage_response.data[0]['id'] if stage_response.data else None
-
-        # Get the priority ID using the group ID
-        priority_response = sb.table('entity_priority').select('id').eq('group_id', group_id).limit(1).execute()
-        priority_id = priority_response.data[0]['id'] if priority_response.data else None
+        # The tenant's group, stage and priority, looked up once per tenant rather than per record
+        references = integration.tenant_references(tenant_id)
+        group_id, stage_id, priority_id = references["group_id"], references["stage_id"], references["priority_id"]
 
         return {
             "phone_book": {
@@ -172,84 +207,83 @@ class Accounts:
         return bool(response.data)
 
     @staticmethod
-    def track_record(id_: str, salesforce_id):
-        is_in_db = sb.table("entity_integration").select("*").eq("entity_based_id", id_).execute().data
-        if not is_in_db:
-            data = {
+    def track_record(id_: str, salesforce_id, export_hash: str = None, linked: bool = None):
+        """
+        Link a supabase account to its Salesforce ID in the entity_integration table.
+
+        :param export_hash: Hash of the payload just exported, stored to skip the row while unchanged
+        :param linked: Whether the row already has an entity_integration row; looked up when None
+        """
+        data = {"salesforce_id": salesforce_id, **integration.exported()}
+        if export_hash is not None:
+            data["export_hash"] = export_hash
+        if linked is None:
+            linked = bool(sb.table("entity_integration").select("id").eq("entity_based_id", id_).execute().data)
+        if not linked:
+            data.update({
                 "entity_based_id": id_,
-                "salesforce_id": salesforce_id,
                 "entity_type_id": EntityType.ACCOUNT.value
-            }
+            })
             sb.table("entity_integration").insert(data).execute()
         else:
-            (sb.table("entity_integration").update({"salesforce_id": salesforce_id}).eq("entity_based_id", id_)
-             .execute())
+            (sb.table("entity_integration").update(data).eq("entity_type_id", EntityType.ACCOUNT.value)
+             .eq("entity_based_id", id_).execute())
 
+    @tracing.traced(entity="account")
+    @metrics.scope(entity="account")
     def to_salesforce(self, owner_id: str):
         """
         Export supabase accounts to Salesforce
         """
-        integration_url = "https://api.integration.app/connections/salesforce/actions/create-accounts/run"
-        accounts = sb.table("account").select("*, phone_book(*)").eq("owner_id", owner_id).execute().data
-        for account in accounts:
-            payload = self.map_i(account)
-            response = self.session.post(integration_url, json=payload)
-            if response.status_code == 200:
-                id_ = response.json()["output"]["id"]
-                self.track_record(account["id"], id_)
-            else:
-                res_json = response.json()
-                # duplicate_data = res_json.get("data", {}).get("response", {}).get("data", [])
-                # if response.status_code == 400 and duplicate_data:
-                #     salesforce_id = duplicate_data[0]["duplicateResult"]["matchResults"][0][
-                #         "matchRecords"][0]["record"]["Id"]
-                #     self.track_record(account["id"], salesforce_id)
-                res_json = response.json()
-                print(res_json)
+        accounts = sb.table("account").select(self.export_columns).eq(self.owner_column, owner_id).execute().data
+        integration.export_journaled(self, "account", accounts)
+
+    def export_by_id(self, record_id: str) -> bool:
+        """
+        Export a single supabase account to Salesforce.
+
+        :param record_id: The ID of the account to export
+        :return: True if the account was exported, False otherwise
+        """
+        return self.export_by_ids([record_id]).get(record_id, False)
+
+    @tracing.traced(entity="account")
+    @metrics.scope(entity="account")
+    def export_by_ids(self, record_ids: list) -> dict:
+        """
+        Export the given supabase accounts to Salesforce, selecting them in one query.
+
+        :param record_ids: The IDs of the accounts to export
+        :return: A dict mapping each ID to True if it was exported, False otherwise
+        """
+        rows = sb.table("account").select(self.export_columns).in_("id", list(record_ids)).execute().data
+        results = {record_id: False for record_id in record_ids}
+        missing = set(results) - {row["id"] for row in rows}
+        if missing:
+            logger.warning("Accounts to export not found", extra={"record_ids": sorted(missing)})
+        results.update(self.export_rows(rows))
+        return results
+
+    def export_rows(self, accounts: list) -> dict:
+        """
+        Export account rows, as selected with ``export_columns``. Rows already linked in entity_integration
+        are updated, the others are created, and rows unchanged since their last export are skipped.
+        With a ``batch_size`` above 1 they go through the batch actions, see ``integration.export_batched``.
+
+        :return: A dict mapping each row ID to True if it was exported or unchanged, False otherwise
+        """
+        links = integration.fetch_links(EntityType.ACCOUNT, [account["id"] for account in accounts])
+        integration.settle_imported(EntityType.ACCOUNT, accounts, links, self.map_i)
+        if self.batch_size > 1:
+            return integration.export_batched(self, "account", EntityType.ACCOUNT, accounts, links, self.batch_size)
+        return {account["id"]: integration.export_row(self, "account", account, links.get(account["id"]))
+                for account in accounts}
 
+    @tracing.traced(entity="account")
+    @metrics.scope(entity="account")
     def from_salesforce(self, owner_id: str, tenant_id):
         """
         Import salesforce accounts to Salesforce
         """
-        integration_url = "https://api.integration.app/connections/salesforce/actions/get-all-accounts/run"
-        accounts = self.session.post(integration_url).json()
-        for account in accounts["output"]["records"]:
-            account_id = account['id']
-
-            # Check if the salesforce_id exists before proceeding
-            if self.check_salesforce_id(account_id):
-                print(f"Salesforce ID {account_id} already exists in the entity_integration table.")
-                # Update the existing record
-                existing_record_response = sb.table('entity_integration').select('entity_based_id').eq('salesforce_id',
-                                                                                                       account_id).execute()
-                entity_based_id = existing_record_response.data[0]['entity_based_id']
-
-                # Get the phone_book_id from the account table
-                account_response = sb.table('account').select('phone_book_id').eq('id', entity_based_id).execute()
-                phone_book_id = account_response.data[0]['phone_book_id']
-                print("Phone book ID: ", phone_book_id, " Account ID: ", entity_based_id)
-
-                payload = self.map_o(account, tenant_id, owner_id)
-                print("phone payload: ", payload['phone_book'])
-                print("accounts payload: ", payload['account'])
-                print()
-                # Update the phone_book and account tables using the retrieved phone_book_id
-                sb.table("phone_book").update(payload['phone_book']).eq('id', phone_book_id).execute()
-                sb.table("account").update({**payload['account'], "phone_book_id": phone_book_id}).eq('id',
-                                                                                                      entity_based_id).execute()
-                print(f"Successfully updated Salesforce ID {account_id} in the phone_book and account tables.")
-                print()
-            else:
-                payload = self.map_o(account, tenant_id, owner_id)
-                print("phone payload: ", payload['phone_book'])
-                print("accounts payload: ", payload['account'])
-                phone_book_response = sb.table("phone_book").insert(payload['phone_book']).execute()
-                phone_book_id = phone_book_response.data[0]['id']
-                account_response = sb.table("account").insert(
-                    {**payload['account'], "phone_book_id": phone_book_id}).execute()
-                id_ = account_response.data[0]['id']
-                print("id ", id_, "salesforce id: ", account['id'])
-                print()
-                # Add/Update row to entity_integration table
-                sb.table("entity_integration").insert(
-                    {"entity_based_id": id_, "salesforce_id": account["id"], "entity_type_id": 2}).execute()
+        records = integration.list_records(self)
+        return integration.import_records(self, "account", EntityType.ACCOUNT, records, tenant_id, owner_id)
@@ -0,0 +1,338 @@
+"""
+Resumable initial load of a tenant's Salesforce records into Supabase.
+
+Pages through each entity's ``import_url`` action by cursor, maps records with the entity's
+``map_o`` and writes them in large batches: one insert per ``import_parents`` table, one for the
+entity table and one for entity_integration, per ``write_size`` records. Records that already
+have an entity_integration row are skipped, so a backfill can be re-run or resumed at any point
+without creating duplicates.
+
+Progress is checkpointed per entity type in a JSON file, replaced atomically: the cursor of the
+next page to fetch, and while a batch is written, its records with the ids given to their entity
+rows and the ids of the parent rows inserted for them. A resumed run first links the entity rows
+that were inserted and deletes the parent rows of those that weren't, then continues from the
+cursor. With a ``copyload.CopyLoader`` each batch is written in a single transaction instead.
+
+Links are written like the import writes them (``integration.imported_columns``), so the first
+export after a backfill takes the records as unchanged instead of sending them back.
+
+    python -m sync.backfill --tenant 7 --owner <user_id> --checkpoint backfill-7.json
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+import uuid
+
+from sync import sb, integration, logs, metrics, tracing
+from sync.enums import EntityType
+from sync.main import ENTITY_CLASSES, ENTITY_DEPENDENCIES, entity_types
+
+logger = logs.get_logger(__name__)
+
+ENTITY_TYPES = {
+    "account": EntityType.ACCOUNT,
+    "contact": EntityType.CONTACT,
+    "deal": EntityType.DEAL,
+    "lead": EntityType.LEAD,
+}
+
+BACKFILLED = metrics.registry.counter("sync_backfill_records_total", "Records seen by the backfill",
+                                      ("entity", "result"))
+
+
+class BackfillCheckpoint:
+    """Per-entity backfill state in a JSON file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        try:
+            with open(path) as f:
+                self.state = json.load(f)
+        except FileNotFoundError:
+            self.state = {}
+
+    def entity(self, name: str) -> dict:
+        return self.state.setdefault(name, {"cursor": None, "pages": 0, "imported": 0, "skipped": 0,
+                                            "done": False, "pending": {}})
+
+    def save(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".backfill-", suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+
+class Progress:
+    """Logs records per second and, when the total is known, the estimated time left."""
+
+    def __init__(self, entity: str, done: int = 0, total: int = None, interval: float = 10.0):
+        self.entity = entity
+        self.total = total
+        self.interval = interval
+        self._start = time.monotonic()
+        self._start_done = done
+        self._last = 0.0
+        self.done = done
+
+    def update(self, done: int, force: bool = False):
+        self.done = done
+        now = time.monotonic()
+        if not force and now - self._last < self.interval:
+            return
+        self._last = now
+        elapsed = now - self._start
+        rate = (done - self._start_done) / elapsed if elapsed > 0 else 0.0
+        extra = {"entity": self.entity, "records": done, "rate": round(rate, 1), "elapsed": round(elapsed)}
+        if self.total:
+            extra["total"] = self.total
+            extra["percent"] = round(100.0 * min(done, self.total) / self.total, 1)
+            if rate > 0:
+                extra["eta_seconds"] = round(max(self.total - done, 0) / rate)
+        logger.info("Backfill progress", extra=extra)
+
+
+class Backfill:
+    def __init__(self, tenant_id, owner_id: str, checkpoint: str, entities: tuple = None, write_size: int = 1000,
+                 access_token: str = None, expected: dict = None, progress_interval: float = 10.0, loader=None,
+                 session=None):
+        """
+        :param tenant_id: The tenant to load records into
+        :param owner_id: The user set as owner and author of the imported records
+        :param checkpoint: Path of the checkpoint file; created if missing, resumed from otherwise
+        :param entities: Entity types to load, all by default; accounts are always loaded before contacts
+        :param write_size: Records per batch of inserts
+        :param access_token: integration.app token, read from the tenant's integration_connection by default
+        :param expected: Optional entity to expected record count, used for the ETA when the actions don't
+            report a total
+        :param loader: Optional ``copyload.CopyLoader`` writing each batch straight to Postgres in one
+            transaction; batches are inserted through PostgREST otherwise
+        :param session: Optional session for the import actions in place of the entity's own, e.g. a
+            ``fakes.FakeIntegrationApp``
+        """
+        unknown = set(entities or ()) - set(ENTITY_CLASSES)
+        if unknown:
+            raise ValueError(f"Unknown entities: {sorted(unknown)}")
+        self.tenant_id = tenant_id
+        self.owner_id = owner_id
+        self.checkpoint = BackfillCheckpoint(checkpoint)
+        self.entities = [name for name in _dependency_order() if entities is None or name in entities]
+        self.write_size = write_size
+        self.access_token = access_token or integration.access_token(tenant_id)
+        self.expected = expected or {}
+        self.progress_interval = progress_interval
+        self.loader = loader
+        self.session = session
+
+    @tracing.traced("backfill")
+    def run(self) -> dict:
+        """
+        Load every selected entity type, resuming from the checkpoint.
+
+        :return: Entity name to its checkpoint state
+        """
+        with metrics.scope(tenant=self.tenant_id):
+            for name in self.entities:
+                with metrics.scope(entity=name), tracing.span("backfill.entity", entity=name):
+                    self.run_entity(name)
+        return {name: self.checkpoint.entity(name) for name in self.entities}
+
+    def run_entity(self, name: str):
+        state = self.checkpoint.entity(name)
+        if state["done"]:
+            logger.info("Backfill already finished", extra={"entity": name, "records": state["imported"]})
+            return
+        exporter = ENTITY_CLASSES[name](self.access_token, "")
+        if self.session is not None:
+            exporter.session = self.session
+        if state["pending"]:
+            self._resume(name, exporter, state)
+
+        progress = Progress(name, state["imported"] + state["skipped"], self.expected.get(name),
+                            self.progress_interval)
+        buffer, pages, cursor = [], 0, state["cursor"]
+        while True:
+            records, cursor, total = self._fetch_page(exporter, cursor)
+            progress.total = progress.total or total
+            buffer.extend(records)
+            pages += 1
+            if len(buffer) >= self.write_size or not cursor:
+                self._write(name, exporter, state, buffer)
+                # The cursor only moves once the buffered pages are written, so a crash refetches them
+                state["cursor"] = cursor
+                state["pages"] += pages
+                buffer, pages = [], 0
+                state["done"] = not cursor
+                self.checkpoint.save()
+            progress.update(state["imported"] + state["skipped"] + len(buffer))
+            if not cursor:
+                break
+        progress.update(state["imported"] + state["skipped"], force=True)
+
+    def _fetch_page(self, exporter, cursor) -> tuple:
+        with tracing.span("backfill.fetch", cursor=cursor):
+            response = exporter.session.post(exporter.import_url, json={"cursor": cursor} if cursor else {})
+        response.raise_for_status()
+        output = response.json()["output"]
+        return output.get("records") or [], output.get("cursor"), output.get("total")
+
+    def _write(self, name: str, exporter, state: dict, records: list):
+        entity_type = ENTITY_TYPES[name]
+        imported = integration.fetch_imported(entity_type, [record["id"] for record in records])
+        new = [record for record in records if record["id"] not in imported]
+        new = list({record["id"]: record for record in new}.values())
+        skipped = len(records) - len(new)
+
+        references = {}
+        for column, (field, ref_type) in exporter.import_references.items():
+            references[column] = integration.fetch_imported(
+                ref_type, [record["fields"].get(field) for record in new])
+        if references:
+            resolvable = [record for record in new
+                          if all(record["fields"].get(field) in references[column]
+                                 for column, (field, _) in exporter.import_references.items())]
+            if len(resolvable) < len(new):
+                logger.warning("Skipped records with unresolved references",
+                               extra={"entity": name, "count": len(new) - len(resolvable)})
+                BACKFILLED.inc(len(new) - len(resolvable), entity=name, result="unresolved")
+                skipped += len(new) - len(resolvable)
+            new = resolvable
+
+        BACKFILLED.inc(skipped, entity=name, result="skipped")
+        state["skipped"] += skipped
+        if not new:
+            return
+
+        with tracing.span("backfill.write", entity=name, records=len(new)):
+            payloads = [exporter.map_o(record, self.tenant_id, self.owner_id) for record in new]
+            rows = [dict(payload[name]) for payload in payloads]
+            for column, (field, _) in exporter.import_references.items():
+                for row, record in zip(rows, new):
+                    row[column] = references[column][record["fields"][field]]
+            if self.loader is not None:
+                parents = {column: (table, [payload[key] for payload in payloads])
+                           for key, (table, column) in exporter.import_parents.items()}
+                inserted = self.loader.load(entity_type, name, [record["id"] for record in new], parents, rows,
+                                            [integration.updated_at(record) for record in new])
+                skipped = len(new) - inserted
+                state["imported"] += inserted
+                state["skipped"] += skipped
+                BACKFILLED.inc(inserted, entity=name, result="imported")
+                BACKFILLED.inc(skipped, entity=name, result="skipped")
+                return
+
+            # Entity rows get their ids here and are recorded before anything is inserted, and each
+            # chunk of parent rows as soon as it is, so a resumed run finds what a crash left behind
+            for row in rows:
+                row["id"] = str(uuid.uuid4())
+            state["pending"] = {record["id"]: [row["id"], integration.updated_at(record), {}]
+                                for record, row in zip(new, rows)}
+            self.checkpoint.save()
+            for key, (table, column) in exporter.import_parents.items():
+                for chunk in integration.chunks(list(range(len(new))), self.write_size):
+                    parents = integration.insert_rows(table, [payloads[i][key] for i in chunk], self.write_size)
+                    for i, parent in zip(chunk, parents):
+                        rows[i][column] = parent["id"]
+                        state["pending"][new[i]["id"]][2][column] = parent["id"]
+                    self.checkpoint.save()
+            integration.insert_rows(name, rows, self.write_size)
+            self._link(name, state, state["pending"])
+        state["imported"] += len(new)
+        BACKFILLED.inc(len(new), entity=name, result="imported")
+
+    def _resume(self, name: str, exporter, state: dict):
+        """
+        Settle the rows of a ``_write`` interrupted by a crash: link the entity rows it inserted, and
+        delete the parent rows of those it didn't. Their records are fetched again from the checkpoint's
+        cursor and written anew.
+        """
+        pending = state["pending"]
+        ids = [entry[0] for entry in pending.values()]
+        written = set()
+        for chunk in integration.chunks(ids):
+            written.update(row["id"] for row in sb.table(name).select("id").in_("id", chunk).execute().data)
+        tables = {column: table for table, column in exporter.import_parents.values()}
+        orphans = {}
+        for entry in pending.values():
+            if entry[0] not in written:
+                for column, parent_id in entry[2].items():
+                    orphans.setdefault(tables[column], []).append(parent_id)
+        for table, parent_ids in orphans.items():
+            for chunk in integration.chunks(parent_ids):
+                sb.table(table).delete().in_("id", chunk).execute()
+        if len(written) < len(ids):
+            logger.info("Backfill resumed after an interrupted write",
+                        extra={"entity": name, "written": len(written), "unwritten": len(ids) - len(written)})
+        self._link(name, state, {salesforce_id: entry for salesforce_id, entry in pending.items()
+                                 if entry[0] in written})
+
+    def _link(self, name: str, state: dict, pending: dict):
+        """:param pending: Salesforce ID to ``[row id, updatedTime, parent ids]`` of the rows to link"""
+        entity_type = ENTITY_TYPES[name]
+        linked = integration.fetch_imported(entity_type, list(pending))
+        synced_at = integration.now()
+        integration.insert_rows("entity_integration",
+                [{"entity_based_id": entry[0], "salesforce_id": salesforce_id, "entity_type_id": entity_type.value,
+                  **integration.imported_columns(entry[1], synced_at)}
+                 for salesforce_id, entry in pending.items() if salesforce_id not in linked],
+                self.write_size)
+        state["pending"] = {}
+        self.checkpoint.save()
+
+
+def _dependency_order() -> list:
+    order = []
+
+    def visit(name):
+        if name not in order:
+            for dependency in ENTITY_DEPENDENCIES.get(name, ()):
+                visit(dependency)
+            order.append(name)
+
+    for name in ENTITY_CLASSES:
+        visit(name)
+    return order
+
+
+def main(argv: list = None):
+    from sync import capture
+    from sync.config import SYNC_LOG_LEVEL, SYNC_LOG_SAMPLE_EVERY, SYNC_CAPTURE_PATH, SYNC_INTEGRATION_APP_URL
+
+    parser = argparse.ArgumentParser(description="Load a tenant's Salesforce records into Supabase, resumably")
+    parser.add_argument("--tenant", required=True, type=int)
+    parser.add_argument("--owner", required=True, help="User ID set as owner of the imported records")
+    parser.add_argument("--checkpoint", required=True, help="Checkpoint file, resumed from if it exists")
+    parser.add_argument("--entities", type=entity_types, default=",".join(ENTITY_CLASSES),
+                        help="Comma-separated entity types, default: all")
+    parser.add_argument("--write-size", type=int, default=1000, help="Records per batch of inserts")
+    parser.add_argument("--expect", action="append", default=[], metavar="ENTITY=COUNT",
+                        help="Expected record count of an entity type, for the ETA")
+    parser.add_argument("--token", help="integration.app token, default: the tenant's salesforce connection")
+    parser.add_argument("--dsn", help="Postgres connection string; when set, batches are loaded with COPY")
+    args = parser.parse_args(argv)
+
+    logs.configure(SYNC_LOG_LEVEL, sample_every=SYNC_LOG_SAMPLE_EVERY)
+    capture.configure(SYNC_CAPTURE_PATH, SYNC_INTEGRATION_APP_URL)
+    expected = {name: int(count) for name, count in (item.split("=", 1) for item in args.expect)}
+    loader = None
+    if args.dsn:
+        from sync.copyload import CopyLoader
+
+        loader = CopyLoader(args.dsn)
+    backfill = Backfill(args.tenant, args.owner, args.checkpoint, args.entities,
+                        args.write_size, args.token, expected, loader=loader)
+    try:
+        for name, state in backfill.run().items():
+            logger.info("Backfill finished", extra={"entity": name, "imported": state["imported"],
+                                                    "skipped": state["skipped"], "pages": state["pages"]})
+    finally:
+        if loader:
+            loader.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+Circuit breakers for integration.app, per connection and per action.
+
+Every request of a :class:`sync.guards.GuardedSession` goes through :data:`breakers`. A
+request fails when it raises, or is answered 401, 403, 429 or 5xx; other answers, such as a 400
+for one invalid record, are the record's problem and count as successes. After ``threshold``
+failures in a row the action's breaker opens, and so does the connection's when they were 401s,
+403s or errors such as timeouts, since those mean its token or its org doesn't work for any
+action. While a breaker is open its requests raise :class:`CircuitOpenError` without being
+sent, which fails the running stage at once instead of record by record. After ``cooldown``
+seconds one request is let through as a probe: it closes the breaker if it succeeds and opens it
+again otherwise.
+
+The connection is the tenant of the current ``metrics.scope``, or the session's token when there
+is none. Open breakers and why they opened are in :meth:`Breakers.snapshot`.
+"""
+import hashlib
+import threading
+import time
+
+from sync import logs, metrics
+
+logger = logs.get_logger(__name__)
+
+TRANSITIONS = metrics.registry.counter("sync_breaker_transitions_total", "Circuit breakers opened and closed",
+                                       ("scope", "state"))
+REJECTED = metrics.registry.counter("sync_breaker_rejected_total", "Requests not sent because a breaker was open",
+                                    ("scope",))
+
+CONNECTION = "*"  # the action of a connection-wide breaker
+_AUTH_CODES = {401, 403}
+
+
+class CircuitOpenError(RuntimeError):
+    def __init__(self, connection: str, action: str, reason: str, retry_in: float):
+        scope = "connection" if action == CONNECTION else f"action {action}"
+        super().__init__(f"Circuit open for {scope} of {connection}: {reason}; next probe in {retry_in:.0f}s")
+        self.connection = connection
+        self.action = action
+        self.reason = reason
+
+
+class CircuitBreaker:
+    def __init__(self, threshold: int = 5, cooldown: float = 60.0):
+        """
+        :param threshold: Failures in a row that open the breaker
+        :param cooldown: Seconds an open breaker waits before letting a probe through
+        """
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.reason = None
+        self.opened_at = None
+        self._probing = False
+
+    def ready(self, now: float) -> bool:
+        """Whether a request may be sent: the breaker is closed, or due a probe and none is running."""
+        if self.state == "closed":
+            return True
+        return not self._probing and (self.state == "half_open" or now - self.opened_at >= self.cooldown)
+
+    def take(self):
+        """Mark a request allowed by :meth:`ready` as sent; unless closed, it's the probe."""
+        if self.state != "closed":
+            self.state, self._probing = "half_open", True
+
+    def success(self) -> bool:
+        """:return: True if this closed the breaker"""
+        closed = self.state != "closed"
+        self.state, self.failures, self.reason, self._probing = "closed", 0, None, False
+        return closed
+
+    def failure(self, reason: str, now: float) -> bool:
+        """:return: True if this opened the breaker"""
+        self.failures += 1
+        self.reason = reason
+        self._probing = False
+        if self.state == "half_open" or (self.state == "closed" and self.failures >= self.threshold):
+            self.state, self.opened_at = "open", now
+            return True
+        return False
+
+
+class Breakers:
+    def __init__(self, threshold: int = 5, cooldown: float = 60.0):
+        """
+        :param threshold: Failures in a row that open a breaker
+        :param cooldown: Seconds an open breaker waits before letting a probe through
+        """
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._breakers = {}  # (connection, action) -> CircuitBreaker
+        self._lock = threading.Lock()
+
+    def _get(self, connection: str, action: str) -> CircuitBreaker:
+        breaker = self._breakers.get((connection, action))
+        if breaker is None:
+            breaker = self._breakers[(connection, action)] = CircuitBreaker(self.threshold, self.cooldown)
+        return breaker
+
+    def check(self, connection: str, action: str):
+        """Raise :class:`CircuitOpenError` if the connection's or the action's breaker is open."""
+        now = time.monotonic()
+        with self._lock:
+            keys = ((connection, CONNECTION), (connection, action))
+            for key in keys:
+                breaker = self._get(*key)
+                if not breaker.ready(now):
+                    REJECTED.inc(scope="connection" if key[1] == CONNECTION else "action")
+                    raise CircuitOpenError(connection, key[1], breaker.reason,
+                                           max(breaker.cooldown - (now - breaker.opened_at), 0.0))
+            for key in keys:
+                self._get(*key).take()
+
+    def record(self, connection: str, action: str, status_code: int = None, error: str = None):
+        """Record the outcome of a request: its status code, or the error it raised."""
+        failed = error is not None or status_code in _AUTH_CODES or status_code == 429 or status_code >= 500
+        reason = error or f"HTTP {status_code}"
+        now = time.monotonic()
+        changes = []
+        with self._lock:
+            keys = [(connection, action)]
+            # A token rejected or a connection that can't be reached fails every action of the connection,
+            # and a probe of the connection's breaker decides it either way
+            if not failed or error is not None or status_code in _AUTH_CODES \
+                    or self._get(connection, CONNECTION).state == "half_open":
+                keys.append((connection, CONNECTION))
+            for key in keys:
+                breaker = self._get(*key)
+                if failed and breaker.failure(reason, now):
+                    changes.append((key, "open"))
+                elif not failed and breaker.success():
+                    changes.append((key, "closed"))
+        for (connection_, action_), state in changes:
+            scope = "connection" if action_ == CONNECTION else "action"
+            TRANSITIONS.inc(scope=scope, state=state)
+            log = logger.warning if state == "open" else logger.info
+            log(f"Circuit breaker {'opened' if state == 'open' else 'closed'}",
+                extra={"connection": connection_, "action": action_, "reason": reason if failed else None})
+
+    def snapshot(self) -> list:
+        """:return: ``{"connection", "action", "state", "failures", "reason"}`` of every breaker not closed"""
+        with self._lock:
+            return [{"connection": connection, "action": action, "state": breaker.state,
+                     "failures": breaker.failures, "reason": breaker.reason}
+                    for (connection, action), breaker in self._breakers.items() if breaker.state != "closed"]
+
+    def reset(self, connection: str = None):
+        """Close the breakers of a connection, such as after its token was replaced, or every breaker."""
+        with self._lock:
+            for key in [key for key in self._breakers if connection is None or key[0] == connection]:
+                del self._breakers[key]
+
+
+def connection_of(session) -> str:
+    """The connection a request belongs to: the current tenant, or a digest of the session's token."""
+    tenant = metrics.current_labels().get("tenant")
+    if tenant:
+        return tenant
+    token = session.headers.get("Authorization", "")
+    return "token:" + hashlib.sha256(token.encode()).hexdigest()[:12]
+
+
+def _configured() -> Breakers:
+    from sync.config import SYNC_BREAKER_THRESHOLD, SYNC_BREAKER_COOLDOWN
+
+    return Breakers(SYNC_BREAKER_THRESHOLD, SYNC_BREAKER_COOLDOWN)
+
+
+breakers = _configured()
@@ -0,0 +1,163 @@
+"""
+Round-trip budgets for the import, export and backfill paths.
+
+Runs each path over growing numbers of records against :class:`sync.fakes.MemoryClient` and
+:class:`sync.fakes.FakeIntegrationApp`, counts the Supabase and integration.app calls it makes,
+and checks them against a budget of a fixed number of calls plus a fixed number per 100 records.
+The per-100 allowances are far below 100, so a query or request added per record (an N+1
+pattern) fails the check at the larger sizes. The export at ``SYNC_EXPORT_BATCH_SIZE=1`` makes an
+action call and a tracking write per record by design; its ``export.row`` paths are allowed just
+over that, so an extra call per record still doubles them.
+
+    python -m sync.budget                  # exits with status 1 if a path is over budget
+    python -m sync.budget --sizes 100,5000 --json
+"""
+import argparse
+import json
+import math
+import sys
+
+from sync import integration
+from sync.backfill import Backfill
+from sync.clients import registry
+from sync.fakes import OWNER_ID, TENANT_ID, UPDATED, FakeIntegrationApp, MemoryClient, salesforce_records, seed
+from sync.main import ENTITY_CLASSES
+
+# Path -> (supabase fixed, supabase per 100 records, http fixed, http per 100 records)
+BUDGETS = {
+    "export.create": (4, 2, 0, 1),
+    "export.update": (4, 2, 0, 1),
+    # SYNC_EXPORT_BATCH_SIZE=1, the default: one action call and one tracking write per record
+    "export.row.create": (4, 102, 0, 100),
+    "export.row.update": (4, 102, 0, 100),
+    "import.insert": (8, 3, 0, 1),
+    "import.update": (8, 4, 0, 1),
+    "backfill": (8, 4, 0, 1),
+}
+
+DEFAULT_SIZES = (50, 400, 1000)
+
+
+def _listings(n: int) -> dict:
+    return {_action(cls.import_url): salesforce_records(n, entity) for entity, cls in ENTITY_CLASSES.items()}
+
+
+def _action(url: str) -> str:
+    return url.rsplit("/actions/", 1)[1].split("/")[0]
+
+
+def _exporters(fake: FakeIntegrationApp, batch_size: int) -> dict:
+    exporters = {}
+    for entity, cls in ENTITY_CLASSES.items():
+        exporters[entity] = cls("token", "", batch_size=batch_size)
+        exporters[entity].session = fake
+    return exporters
+
+
+def _export(exporters: dict):
+    exporters["account"].to_salesforce(OWNER_ID)
+    exporters["contact"].to_salesforce_contacts(OWNER_ID)
+    exporters["deal"].to_salesforce_deals(OWNER_ID)
+    exporters["lead"].to_salesforce_leads(OWNER_ID)
+
+
+def _import(exporters: dict):
+    exporters["account"].from_salesforce(OWNER_ID, TENANT_ID)
+    exporters["contact"].from_salesforce_contacts(OWNER_ID, TENANT_ID)
+    exporters["deal"].from_salesforce_deals(OWNER_ID, TENANT_ID)
+    exporters["lead"].from_salesforce_leads(OWNER_ID, TENANT_ID)
+
+
+def measure(n: int) -> dict:
+    """
+    Run every path over ``n`` records of each entity.
+
+    :return: Path to ``(supabase calls, integration.app calls)``
+    """
+    counts = {}
+
+    def count(path, client, fake, run):
+        client.reset_calls()
+        fake.calls = []
+        integration.clear_references()
+        run()
+        counts[path] = (client.round_trips, fake.request_count())
+
+    for prefix, batch_size in (("export", integration.MAX_BATCH_SIZE), ("export.row", 1)):
+        client, fake = MemoryClient(), FakeIntegrationApp()
+        seed(client, n)
+        fake.records = {row["salesforce_id"]: {} for row in client.tables["entity_integration"]}
+        with registry.use(client):
+            exporters = _exporters(fake, batch_size)
+            count(f"{prefix}.create", client, fake, lambda: _export(exporters))
+            for row in client.tables["phone_book"]:
+                row["description"] = "changed"
+            for row in client.tables["deal"]:
+                row["score"] = 60
+            count(f"{prefix}.update", client, fake, lambda: _export(exporters))
+
+    client, fake = MemoryClient(), FakeIntegrationApp(listings=_listings(n), page_size=100)
+    seed(client, n)
+    with registry.use(client):
+        exporters = _exporters(fake, 1)
+        count("import.insert", client, fake, lambda: _import(exporters))
+        # Changed in Salesforce since, or the import skips them as unchanged
+        for records in fake.listings.values():
+            for record in records:
+                record["updatedTime"] = UPDATED
+        count("import.update", client, fake, lambda: _import(exporters))
+
+    client, fake = MemoryClient(), FakeIntegrationApp(listings=_listings(n), page_size=100)
+    seed(client, n)
+    client.tables["entity_integration"] = []
+    with registry.use(client):
+        backfill = Backfill(TENANT_ID, OWNER_ID, ":memory:", write_size=500, access_token="token", session=fake)
+        backfill.checkpoint.save = lambda: None
+        count("backfill", client, fake, backfill.run)
+    return counts
+
+
+def budget(path: str, n: int) -> tuple:
+    """The allowed ``(supabase calls, integration.app calls)`` of a path over ``n`` records per entity."""
+    supabase_fixed, supabase_per_100, http_fixed, http_per_100 = BUDGETS[path]
+    batches = len(ENTITY_CLASSES) * math.ceil(n / 100)
+    return (len(ENTITY_CLASSES) * supabase_fixed + supabase_per_100 * batches,
+            len(ENTITY_CLASSES) * http_fixed + http_per_100 * batches)
+
+
+def check(sizes: tuple = DEFAULT_SIZES) -> list:
+    """
+    Measure every path at each size.
+
+    :return: One dict per path and size with the calls, the budget and whether it was kept
+    """
+    results = []
+    for n in sizes:
+        for path, (supabase_calls, http_calls) in measure(n).items():
+            supabase_budget, http_budget = budget(path, n)
+            results.append({"path": path, "records": n, "supabase": supabase_calls, "supabase_budget": supabase_budget,
+                            "http": http_calls, "http_budget": http_budget,
+                            "ok": supabase_calls <= supabase_budget and http_calls <= http_budget})
+    return results
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description="Check Supabase and integration.app round trips against budgets")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)),
+                        help="Comma-separated record counts per entity")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args(argv)
+
+    results = check(tuple(int(size) for size in args.sizes.split(",")))
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'path':<20}{'records':>8}{'supabase':>10}{'budget':>8}{'http':>8}{'budget':>8}  result")
+        for r in results:
+            print(f"{r['path']:<20}{r['records']:>8}{r['supabase']:>10}{r['supabase_budget']:>8}"
+                  f"{r['http']:>8}{r['http_budget']:>8}  {'ok' if r['ok'] else 'OVER BUDGET'}")
+    return 0 if all(r["ok"] for r in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
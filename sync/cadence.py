@@ -0,0 +1,123 @@
+"""
+Per-tenant sync intervals that follow how much changes in each Salesforce org.
+
+While a tenant is synced inside :func:`observe`, every imported record whose ``updatedTime`` is
+later than the tenant's previous sync counts as a change. :class:`Cadence` turns the changes of
+a run into a change rate, smoothed over runs, and picks the next interval so that about
+``target_changes`` records have changed by the next sync: busy tenants are synced every
+``min_interval`` seconds, dormant ones down to every ``max_interval`` seconds. An interval at
+most doubles from one run to the next, so a single quiet run doesn't park a busy tenant.
+
+:class:`sync.lease.LeaseWorker` keeps the rate and the interval of each tenant in its
+``sync_lease`` row (``sql/003_sync_lease_cadence.sql``)::
+
+    python -m sync.lease --min-interval 60 --max-interval 86400 --target-changes 50
+"""
+import contextlib
+import contextvars
+import threading
+import time
+from datetime import datetime
+
+from sync import metrics
+
+INTERVALS = metrics.registry.histogram("sync_interval_seconds", "Interval until a tenant's next sync", (),
+                                       buckets=(60, 300, 900, 1800, 3600, 4 * 3600, 12 * 3600, 86400))
+
+_changes = contextvars.ContextVar("sync_changes", default=None)
+
+
+class Changes:
+    """Count of records changed since ``since``, shared by the threads of a tenant's sync."""
+
+    def __init__(self, since: float = None):
+        self.since = since
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def add(self, records: list):
+        if self.since is None:
+            return
+        changed = sum(1 for record in records if (updated_time(record) or 0.0) > self.since)
+        with self._lock:
+            self.count += changed
+
+
+@contextlib.contextmanager
+def observe(since=None):
+    """
+    Count the changed records imported inside the block.
+
+    :param since: Time of the tenant's previous sync, as epoch seconds or an ISO 8601 string;
+        nothing is counted when None
+    """
+    changes = Changes(timestamp(since))
+    token = _changes.set(changes)
+    try:
+        yield changes
+    finally:
+        _changes.reset(token)
+
+
+def record_changes(records: list):
+    """Count the changed records of a page being imported, if inside :func:`observe`."""
+    changes = _changes.get()
+    if changes is not None:
+        changes.add(records)
+
+
+class Cadence:
+    def __init__(self, min_interval: float = 60.0, max_interval: float = 86400.0, target_changes: float = 50.0,
+                 smoothing: float = 0.5):
+        """
+        :param min_interval: Shortest interval between two syncs of a tenant, in seconds
+        :param max_interval: Longest interval between two syncs of a tenant, in seconds
+        :param target_changes: Changed records a sync should pick up
+        :param smoothing: Weight of the latest run in the change rate, between 0 and 1
+        """
+        if not 0 < min_interval <= max_interval:
+            raise ValueError("Expected 0 < min_interval <= max_interval")
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_changes = target_changes
+        self.smoothing = smoothing
+
+    def next(self, changes: int, since=None, rate: float = None, interval: float = None, now: float = None) -> tuple:
+        """
+        :param changes: Records changed since the previous sync
+        :param since: Time of the previous sync; the rate isn't updated on a tenant's first sync
+        :param rate: The tenant's change rate so far, in records per second
+        :param interval: The tenant's current interval
+        :return: The new ``(rate, interval)``
+        """
+        since = timestamp(since)
+        if since is not None:
+            elapsed = max((now or time.time()) - since, 1.0)
+            observed = changes / elapsed
+            rate = observed if rate is None else self.smoothing * observed + (1 - self.smoothing) * rate
+        if rate is None:
+            return None, self.min_interval
+        next_interval = self.target_changes / rate if rate > 0 else self.max_interval
+        if interval:
+            next_interval = min(next_interval, 2 * interval)
+        next_interval = min(max(next_interval, self.min_interval), self.max_interval)
+        INTERVALS.observe(next_interval)
+        return rate, next_interval
+
+
+def timestamp(value):
+    """Epoch seconds of a number or an ISO 8601 string, None if empty."""
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+
+def updated_time(record: dict):
+    """Epoch seconds of a Salesforce record's ``updatedTime``, None if missing or invalid."""
+    value = record.get("updatedTime") or (record.get("fields") or {}).get("updatedTime")
+    try:
+        return timestamp(value)
+    except (TypeError, ValueError):
+        return None
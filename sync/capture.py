@@ -0,0 +1,213 @@
+"""
+Capture of integration.app traffic, and a server replaying it for load tests.
+
+With capture enabled, every request made through :class:`sync.metrics.InstrumentedSession` is
+appended to a JSON lines file with its response and latency. Headers are not kept, and values
+under keys that look like credentials (tokens, secrets, passwords, keys) are replaced with
+``[REDACTED]`` in both bodies::
+
+    capture.configure(path="captures.jsonl")
+    Sync().sync_salesforce()
+
+The replay server answers the same actions from such a file: a request gets the recorded response
+to the same action and body if there is one, and otherwise the next recorded response of that
+action. Responses are delayed by their recorded latency, divided by ``speed`` in ``scaled``
+mode, so a tenant's run can be replayed at 1x to 100x. Point the sync package at it with
+``SYNC_INTEGRATION_APP_URL``::
+
+    python -m sync.capture captures.jsonl --port 8090 --speed 10 --latency scaled
+    SYNC_INTEGRATION_APP_URL=http://localhost:8090 python -m sync.main
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from sync import logs
+
+logger = logs.get_logger(__name__)
+
+INTEGRATION_APP_URL = "https://api.integration.app"
+REDACTED = "[REDACTED]"
+LATENCY_MODES = ("original", "scaled", "none")
+
+_SECRET_KEY = re.compile(r"token|secret|password|passwd|authorization|api_?key|credential", re.IGNORECASE)
+_ACTION = re.compile(r"/actions/([^/]+)/run")
+
+_recorder = None
+_base_url = None
+
+
+def redact(value):
+    """Copy of a JSON value with the values of credential-like keys replaced."""
+    if isinstance(value, dict):
+        return {key: REDACTED if _SECRET_KEY.search(str(key)) else redact(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [redact(item) for item in value]
+    return value
+
+
+class Recorder:
+    """Appends request/response pairs to a JSON lines file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, "a", encoding="utf-8")
+
+    def record(self, method: str, url: str, request_body, response, seconds: float):
+        try:
+            response_body = response.json()
+        except ValueError:
+            response_body = response.text
+        entry = {
+            "time": time.time(),
+            "method": method.upper(),
+            "path": urlsplit(url).path,
+            "action": _action(url),
+            "request": redact(request_body),
+            "status": response.status_code,
+            "response": redact(response_body),
+            "seconds": round(seconds, 6),
+        }
+        line = json.dumps(entry, default=str) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def configure(path: str = None, base_url: str = None):
+    """
+    :param path: Record integration.app traffic to this file; recording stops when None
+    :param base_url: Send integration.app requests to this URL instead, e.g. a replay server
+    """
+    global _recorder, _base_url
+    if _recorder is not None:
+        _recorder.close()
+    _recorder = Recorder(path) if path else None
+    _base_url = base_url.rstrip("/") if base_url else None
+
+
+def route(url: str) -> str:
+    """The URL a request to integration.app is actually sent to."""
+    if _base_url and url.startswith(INTEGRATION_APP_URL):
+        return _base_url + url[len(INTEGRATION_APP_URL):]
+    return url
+
+
+def record(method: str, url: str, request_body, response, seconds: float):
+    """Record a request if capture is enabled."""
+    if _recorder is not None:
+        _recorder.record(method, url, request_body, response, seconds)
+
+
+def _action(url: str) -> str:
+    match = _ACTION.search(url)
+    return match.group(1) if match else urlsplit(url).path
+
+
+def _body_key(action: str, body) -> str:
+    encoded = json.dumps(body, sort_keys=True, separators=(",", ":"), default=str)
+    return action + ":" + hashlib.sha256(encoded.encode()).hexdigest()
+
+
+class ReplayStore:
+    """Recorded responses by action, and by action and request body."""
+
+    def __init__(self, entries: list):
+        self.exact = {}
+        self.by_action = {}
+        for entry in entries:
+            self.exact.setdefault(_body_key(entry["action"], entry["request"]), entry)
+            self.by_action.setdefault(entry["action"], []).append(entry)
+        self._cycles = {action: itertools.cycle(items) for action, items in self.by_action.items()}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: str) -> "ReplayStore":
+        with open(path, encoding="utf-8") as f:
+            return cls([json.loads(line) for line in f if line.strip()])
+
+    def match(self, action: str, body):
+        entry = self.exact.get(_body_key(action, redact(body)))
+        if entry is not None:
+            return entry
+        with self._lock:
+            cycle = self._cycles.get(action)
+            return next(cycle) if cycle else None
+
+
+def make_replay_server(store: ReplayStore, host: str = "127.0.0.1", port: int = 8090, speed: float = 1.0,
+                       latency: str = "scaled") -> ThreadingHTTPServer:
+    """
+    :param speed: Replay speed, 1 to 100; recorded latencies are divided by it in ``scaled`` mode
+    :param latency: ``original`` keeps the recorded latencies, ``scaled`` divides them by ``speed``
+        and ``none`` answers at once
+    """
+    if latency not in LATENCY_MODES:
+        raise ValueError(f"Unknown latency mode {latency!r}, expected one of {LATENCY_MODES}")
+    if not 1 <= speed <= 100:
+        raise ValueError("speed must be between 1 and 100")
+    factor = {"original": 1.0, "scaled": 1.0 / speed, "none": 0.0}[latency]
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(length) if length else b""
+            try:
+                body = json.loads(raw) if raw else None
+            except ValueError:
+                body = raw.decode(errors="replace")
+            action = _action(self.path)
+            entry = store.match(action, body)
+            if entry is None:
+                return self._reply(404, {"message": f"No recorded responses for {action}"}, 0.0)
+            self._reply(entry["status"], entry["response"], entry["seconds"] * factor)
+
+        def _reply(self, status: int, payload, delay: float):
+            if delay > 0:
+                time.sleep(delay)
+            data = json.dumps(payload).encode() if not isinstance(payload, str) else payload.encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            logger.debug("Replayed request", extra={"request": format % args})
+
+    return ThreadingHTTPServer((host, port), Handler)
+
+
+if __name__ == "__main__":
+    from sync.config import SYNC_LOG_LEVEL
+
+    parser = argparse.ArgumentParser(description="Replay captured integration.app traffic")
+    parser.add_argument("capture", help="JSON lines file written with capture enabled")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--speed", type=float, default=1.0, help="1 to 100")
+    parser.add_argument("--latency", choices=LATENCY_MODES, default="scaled")
+    args = parser.parse_args()
+
+    logs.configure(SYNC_LOG_LEVEL)
+    replay_store = ReplayStore.load(args.capture)
+    server = make_replay_server(replay_store, args.host, args.port, args.speed, args.latency)
+    logger.info("Replaying captured traffic", extra={"actions": sorted(replay_store.by_action), "port": args.port,
+                                                     "speed": args.speed, "latency": args.latency})
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
@@ -0,0 +1,108 @@
+"""
+Lazily-created Supabase clients.
+
+Importing the sync package no longer builds a client: ``sync.sb`` is a :class:`LazyClient` that
+asks the :data:`registry` for the real client on first use. The registry holds one client per
+(url, key) pair, so several Supabase projects can be used side by side, and it drops every
+client in a forked child so workers never share the parent's HTTP connections.
+
+Any client with the same ``table()`` query builder can be put in place of the real ones with
+:meth:`ClientRegistry.use`, e.g. the in-memory :class:`sync.fakes.MemoryClient`::
+
+    with registry.use(MemoryClient()) as client:
+        Accounts(token, "").to_salesforce(owner_id)
+        print(client.round_trips)
+"""
+import contextlib
+import os
+import threading
+
+
+class ClientRegistry:
+    def __init__(self):
+        self._clients = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._override = None
+
+    def get(self, url: str = None, key: str = None):
+        """
+        Return the client for the given project, creating it on first use.
+
+        :param url: The Supabase project URL, ``SUPABASE_URL`` by default
+        :param key: The Supabase API key, ``SUPABASE_KEY`` by default
+        """
+        if self._override is not None:
+            return self._override
+        if url is None or key is None:
+            from sync.config import SUPABASE_URL, SUPABASE_KEY
+            url = url or SUPABASE_URL
+            key = key or SUPABASE_KEY
+
+        if self._pid != os.getpid():
+            self._after_fork()
+        client = self._clients.get((url, key))
+        if client is not None:
+            return client
+
+        with self._lock:
+            client = self._clients.get((url, key))
+            if client is None:
+                from supabase import create_client
+                from sync.guards import GuardedClient
+                from sync.metrics import InstrumentedClient
+
+                client = self._clients[(url, key)] = GuardedClient(InstrumentedClient(create_client(url, key)))
+            return client
+
+    def lazy(self, url: str = None, key: str = None) -> "LazyClient":
+        """Return a proxy that resolves to :meth:`get` ``(url, key)`` on each use."""
+        return LazyClient(self, url, key)
+
+    @contextlib.contextmanager
+    def use(self, client):
+        """
+        Serve ``client`` instead of the real clients, for every project, inside the block.
+
+        The client is instrumented and guarded like the real ones, so metrics and traces still record
+        its calls and a lost tenant lease still stops them.
+        """
+        from sync.guards import GuardedClient
+        from sync.metrics import InstrumentedClient
+
+        previous = self._override
+        self._override = GuardedClient(InstrumentedClient(client))
+        try:
+            yield client
+        finally:
+            self._override = previous
+
+    def clear(self):
+        with self._lock:
+            self._clients.clear()
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._pid = os.getpid()
+
+
+class LazyClient:
+    """Stands in for a Supabase ``Client`` and forwards every attribute to the registry's client."""
+
+    def __init__(self, registry_: ClientRegistry, url: str = None, key: str = None):
+        self._registry = registry_
+        self._url = url
+        self._key = key
+
+    def table(self, name: str):
+        return self._registry.get(self._url, self._key).table(name)
+
+    def __getattr__(self, name):
+        return getattr(self._registry.get(self._url, self._key), name)
+
+
+registry = ClientRegistry()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=registry._after_fork)
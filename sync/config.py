@@ -6,3 +6,34 @@ load_dotenv()
 
 SUPABASE_URL = os.getenv('SUPABASE_URL')
 SUPABASE_KEY = os.getenv('SUPABASE_KEY')
+
+SYNC_LOG_LEVEL = os.getenv('SYNC_LOG_LEVEL', 'INFO')
+SYNC_LOG_SAMPLE_EVERY = int(os.getenv('SYNC_LOG_SAMPLE_EVERY', '100'))
+
+# Shared secret change events to sync.service must carry; the service won't start without it
+SYNC_SERVICE_SECRET = os.getenv('SYNC_SERVICE_SECRET')
+
+# SQLite file journaling pending and failed exports for retry; disabled when unset
+SYNC_JOURNAL_PATH = os.getenv('SYNC_JOURNAL_PATH')
+
+# Records per integration.app batch action call on export; 1 keeps one create/update request per record
+SYNC_EXPORT_BATCH_SIZE = int(os.getenv('SYNC_EXPORT_BATCH_SIZE', '1'))
+
+# Record integration.app traffic to this JSON lines file, see sync.capture; disabled when unset
+SYNC_CAPTURE_PATH = os.getenv('SYNC_CAPTURE_PATH')
+# Send integration.app requests here instead, e.g. to a sync.capture replay server
+SYNC_INTEGRATION_APP_URL = os.getenv('SYNC_INTEGRATION_APP_URL')
+
+# Bounds and target of adaptive per-tenant sync intervals, see sync.cadence
+SYNC_MIN_INTERVAL = float(os.getenv('SYNC_MIN_INTERVAL', '60'))
+SYNC_MAX_INTERVAL = float(os.getenv('SYNC_MAX_INTERVAL', '86400'))
+SYNC_TARGET_CHANGES = float(os.getenv('SYNC_TARGET_CHANGES', '50'))
+
+# Schedule and warm tenant bounds of the long-running sync, see sync.daemon
+SYNC_DAEMON_INTERVAL = float(os.getenv('SYNC_DAEMON_INTERVAL', '300'))
+SYNC_DAEMON_MAX_TENANTS = int(os.getenv('SYNC_DAEMON_MAX_TENANTS', '200'))
+SYNC_DAEMON_IDLE_TTL = float(os.getenv('SYNC_DAEMON_IDLE_TTL', '3600'))
+
+# Failures in a row that open an integration.app circuit breaker, and seconds before it probes again
+SYNC_BREAKER_THRESHOLD = int(os.getenv('SYNC_BREAKER_THRESHOLD', '5'))
+SYNC_BREAKER_COOLDOWN = float(os.getenv('SYNC_BREAKER_COOLDOWN', '60'))
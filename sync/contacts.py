@@ -1,15 +1,47 @@
-import requests
-from sync import sb
+import functools
+
+from sync import sb, guards, integration, logs, metrics, tracing
+from sync.config import SYNC_EXPORT_BATCH_SIZE
 from sync.enums import EntityType
 
+logger = logs.get_logger(__name__)
+
 
 class Contacts:
-    def __init__(self, access_token: str, salesforce_id: str):
-        session = requests.session()
+    export_url = "https://api.integration.app/connections/salesforce/actions/create-contact/run"
+    update_url = "https://api.integration.app/connections/salesforce/actions/update-contact/run"
+    batch_create_url = "https://api.integration.app/connections/salesforce/actions/batch-create-contacts/run"
+    batch_update_url = "https://api.integration.app/connections/salesforce/actions/batch-update-contacts/run"
+    owner_column = "created_by"
+    export_columns = "*, phone_book(*)"
+    import_url = "https://api.integration.app/connections/salesforce/actions/get-contacts/run"
+    # map_o keys written to their own table first, and the column linking them
+    import_parents = {"phone_book": ("phone_book", "phone_book_id")}
+    # Columns resolved from a Salesforce reference field through entity_integration
+    import_references = {"account_id": ("companyId", EntityType.ACCOUNT)}
+    # Columns of map_o compared by sync.reconcile, by map_o key; text, integer or boolean columns only
+    reconcile_columns = {
+        "phone_book": ("first_name", "last_name", "email", "phone", "street", "city", "state", "country", "title"),
+    }
+
+    def __init__(self, access_token: str, salesforce_id: str, journal=None, batch_size: int = None,
+                 since: str = None):
+        """
+        :param journal: Optional ``TenantJournal`` recording pending and failed exports for retry
+        :param batch_size: Records per batch action call on export, defaults to ``SYNC_EXPORT_BATCH_SIZE``;
+            1 exports each record with its own request
+        :param since: Import only records updated after this time, ISO 8601; all records by default
+        """
+        session = guards.GuardedSession()
         session.headers.update({'Authorization': f'Bearer {access_token}'})
         self.session = session
         self.salesforce_id = salesforce_id
+        self.journal = journal
+        self.batch_size = SYNC_EXPORT_BATCH_SIZE if batch_size is None else batch_size
+        self.since = since
 
+    @tracing.traced(entity="contact")
+    @metrics.scope(entity="contact")
     def delete_from_supabase(self, record_id: str):
         """
         Delete a contact from Supabase, the entity_integration table, and Salesforce.
@@ -20,9 +52,8 @@ class Contacts:
         integration_response = sb.table('entity_integration').select('salesforce_id').eq('entity_based_id',
                                                                                          record_id).execute()
         if not integration_response.data:
-            print(
-                f"Failed to retrieve salesforce_id for contact {record_id} from entity_integration: "
-                f"{integration_response.json()}")
+            logger.warning("Failed to retrieve salesforce_id from entity_integration",
+                           extra={"record_id": record_id, "response": integration_response.json()})
             return
 
         salesforce_id = integration_response.data[0]['salesforce_id']
@@ -30,61 +61,76 @@ class Contacts:
         # Attempt to delete from Salesforce using the retrieved salesforce_id
         self.delete_from_salesforce(salesforce_id)
 
-    def delete_from_salesforce(self, salesforce_id: str):
+    @tracing.traced(entity="contact")
+    @metrics.scope(entity="contact")
+    def delete_from_salesforce(self, salesforce_id: str) -> bool:
         """
         Delete a contact from Salesforce and Supabase.
 
         :param salesforce_id: The Salesforce ID of the contact to delete
+        :return: True if the contact was deleted from Salesforce, False otherwise
         """
         url = "https://api.integration.app/connections/salesforce/actions/delete-contacts/run"
         payload = {
             "id": salesforce_id
         }
         salesforce_response = self.session.post(url, json=payload)
-        if salesforce_response.status_code == 200:
-            print(f"Successfully deleted contact {salesforce_id} from Salesforce")
+        # 404: already deleted in Salesforce, which is what was asked for (as in integration._delete_linked)
+        if salesforce_response.status_code in (200, 404):
+            logger.info("Deleted contact from Salesforce", extra={"salesforce_id": salesforce_id,
+                                                                  "status_code": salesforce_response.status_code})
+            if self.journal:
+                self.journal.done("contact", "delete", salesforce_id)
         else:
-            print(f"Failed to delete contact {salesforce_id} from Salesforce: {salesforce_response.json()}")
-            return
+            logger.error("Failed to delete contact from Salesforce",
+                         extra={"salesforce_id": salesforce_id, "status_code": salesforce_response.status_code,
+                                "response": salesforce_response.json()})
+            if self.journal:
+                self.journal.failed("contact", "delete", salesforce_id,
+                                    f"HTTP {salesforce_response.status_code}: {salesforce_response.text}")
+            return False
 
         # Retrieve the entity_based_id from the entity_integration table
         integration_response = sb.table('entity_integration').select('entity_based_id').eq('salesforce_id',
                                                                                            salesforce_id).execute()
         if not integration_response.data:
-            print(
-                f"Failed to retrieve entity_based_id for salesforce_id {salesforce_id} from entity_integration: "
-                f"{integration_response.json()}")
-            return
+            logger.warning("Failed to retrieve entity_based_id from entity_integration",
+                           extra={"salesforce_id": salesforce_id, "response": integration_response.json()})
+            return True
 
         entity_based_id = integration_response.data[0]['entity_based_id']
 
         # Delete from Supabase contact table
         supabase_response = sb.table('contact').delete().eq('id', entity_based_id).execute()
         if supabase_response.data:
-            print(f"Successfully deleted contact {entity_based_id} from Supabase")
+            logger.info("Deleted contact from Supabase", extra={"record_id": entity_based_id})
         else:
-            print(f"Failed to delete contact {entity_based_id} from Supabase: {supabase_response.json()}")
+            logger.error("Failed to delete contact from Supabase",
+                         extra={"record_id": entity_based_id, "response": supabase_response.json()})
 
         # Delete from entity_integration table
         integration_response = sb.table('entity_integration').delete().eq('entity_based_id', entity_based_id).execute()
+        integration.forget_links(EntityType.CONTACT, [salesforce_id])
         if integration_response.data:
-            print(f"Successfully deleted entity integration for contact {entity_based_id} from Supabase")
+            logger.info("Deleted contact entity integration from Supabase", extra={"record_id": entity_based_id})
         else:
-            print(
-                f"Failed to delete entity integration for contact {entity_based_id} from Supabase: "
-                f"{integration_response.json()}")
+            logger.error("Failed to delete contact entity integration from Supabase",
+                         extra={"record_id": entity_based_id, "response": integration_response.json()})
+        return True
 
     @staticmethod
-    def map_i(row: dict) -> dict:
+    def map_i(row: dict, account_links: dict = None) -> dict:
         """
         Field mapping from supabase to salesforce
+
+        :param account_links: The entity_integration rows of the contacts' accounts, from
+            ``integration.fetch_links``; the account is looked up on its own when not given
         """
         # Get the salesforce account ID using the supabase account ID
         account_id = row['account_id']
-        account_response = (sb.table('entity_integration').select('salesforce_id')
-                            .eq('entity_based_id', account_id)
-                            .eq('entity_type_id', 1).limit(1).execute())
-        salesforce_account_id = account_response.data[0]['salesforce_id'] if account_response.data else None
+        if account_links is None:
+            account_links = integration.fetch_links(EntityType.ACCOUNT, [account_id] if account_id else [])
+        salesforce_account_id = account_links[account_id]['salesforce_id'] if account_id in account_links else None
 
         return {
             "fullName": f"{row['phone_book'].get('first_name', '')} {row['phone_book'].get('last_name', '')}".strip(),
@@ -115,17 +161,9 @@ class Contacts:
         """Field mapping from salesforce to supabase"""
         fields = row['fields']
 
-        # Get the group ID using the tenant ID
-        group_response = sb.table('entity_group').select('id').eq('tenant_id', tenant_id).limit(1).execute()
-        group_id = group_response.data[0]['id'] if group_response.data else None
-
-        # Get the stage ID using the group ID
-        stage_response = sb.table('entity_stage').select('id').eq('group_id', group_id).limit(1).execute()
-        stage_id = stage_response.data[0]['id'] if stage_response.data else None
-
-        # Get the priority ID using the group ID
-        priority_response = sb.table('entity_priority').select('id').eq('group_id', group_id).limit(1).execute()
-        priority_id = priority_response.data[0]['id'] if priority_response.data else None
+        # The tenant's group, stage and priority, looked up once per tenant rather than per record
+        references = integration.tenant_references(tenant_id)
+        group_id, stage_id, priority_id = references["group_id"], references["stage_id"], references["priority_id"]
 
         return {
             "phone_book": {
@@ -174,98 +212,87 @@ class Contacts:
         return bool(response.data)
 
     @staticmethod
-    def track_record(id_: str, salesforce_id):
-        is_in_db = sb.table("entity_integration").select("*").eq("entity_based_id", id_).execute().data
-        if not is_in_db:
-            data = {
+    def track_record(id_: str, salesforce_id, export_hash: str = None, linked: bool = None):
+        """
+        Link a supabase contact to its Salesforce ID in the entity_integration table.
+
+        :param export_hash: Hash of the payload just exported, stored to skip the row while unchanged
+        :param linked: Whether the row already has an entity_integration row; looked up when None
+        """
+        data = {"salesforce_id": salesforce_id, **integration.exported()}
+        if export_hash is not None:
+            data["export_hash"] = export_hash
+        if linked is None:
+            linked = bool(sb.table("entity_integration").select("id").eq("entity_based_id", id_).execute().data)
+        if not linked:
+            data.update({
                 "entity_based_id": id_,
-                "salesforce_id": salesforce_id,
                 "entity_type_id": EntityType.CONTACT.value
-            }
+            })
             sb.table("entity_integration").insert(data).execute()
         else:
-            sb.table("entity_integration").update({"salesforce_id": salesforce_id}).eq("entity_based_id", id_).execute()
+            (sb.table("entity_integration").update(data).eq("entity_type_id", EntityType.CONTACT.value)
+             .eq("entity_based_id", id_).execute())
 
+    @tracing.traced(entity="contact")
+    @metrics.scope(entity="contact")
     def to_salesforce_contacts(self, user_id: str):
         """
         Export supabase contacts to Salesforce
         """
-        integration_url = "https://api.integration.app/connections/salesforce/actions/create-contact/run"
-        contacts = sb.table("contact").select("*, phone_book(*)").eq("created_by", user_id).execute().data
-        for contact in contacts:
-            payload = self.map_i(contact)
-            response = self.session.post(integration_url, json=payload)
-            if response.status_code == 200:
-                print(f"Successfully exported contact {payload['fullName']}")
-                id_ = response.json()["output"]["id"]
-                self.track_record(contact["id"], id_)
-            else:
-                res_json = response.json()
-                print(res_json)
+        contacts = sb.table("contact").select(self.export_columns).eq(self.owner_column, user_id).execute().data
+        integration.export_journaled(self, "contact", contacts)
+
+    def export_by_id(self, record_id: str) -> bool:
+        """
+        Export a single supabase contact to Salesforce.
 
+        :param record_id: The ID of the contact to export
+        :return: True if the contact was exported, False otherwise
+        """
+        return self.export_by_ids([record_id]).get(record_id, False)
+
+    @tracing.traced(entity="contact")
+    @metrics.scope(entity="contact")
+    def export_by_ids(self, record_ids: list) -> dict:
+        """
+        Export the given supabase contacts to Salesforce, selecting them in one query.
+
+        :param record_ids: The IDs of the contacts to export
+        :return: A dict mapping each ID to True if it was exported, False otherwise
+        """
+        rows = sb.table("contact").select(self.export_columns).in_("id", list(record_ids)).execute().data
+        results = {record_id: False for record_id in record_ids}
+        missing = set(results) - {row["id"] for row in rows}
+        if missing:
+            logger.warning("Contacts to export not found", extra={"record_ids": sorted(missing)})
+        results.update(self.export_rows(rows))
+        return results
+
+    def export_rows(self, contacts: list) -> dict:
+        """
+        Export contact rows, as selected with ``export_columns``. Rows already linked in entity_integration
+        are updated, the others are created, and rows unchanged since their last export are skipped.
+        With a ``batch_size`` above 1 they go through the batch actions, see ``integration.export_batched``.
+
+        :return: A dict mapping each row ID to True if it was exported or unchanged, False otherwise
+        """
+        links = integration.fetch_links(EntityType.CONTACT, [contact["id"] for contact in contacts])
+        account_links = integration.fetch_links(EntityType.ACCOUNT, [contact["account_id"] for contact in contacts
+                                                                     if contact["account_id"]])
+        mapper = functools.partial(self.map_i, account_links=account_links)
+        integration.settle_imported(EntityType.CONTACT, contacts, links, mapper)
+        if self.batch_size > 1:
+            return integration.export_batched(self, "contact", EntityType.CONTACT, contacts, links, self.batch_size,
+                                              mapper=mapper)
+        return {contact["id"]: integration.export_row(self, "contact", contact, links.get(contact["id"]), mapper)
+                for contact in contacts}
+
+    @tracing.traced(entity="contact")
+    @metrics.scope(entity="contact")
     def from_salesforce_contacts(self, owner_id: str, tenant_id):
         """
         Import salesforce contacts to Salesforce
         """
-        integration_url = "https://api.integration.app/connections/salesforce/actions/get-contacts/run"
-        contacts = self.session.post(integration_url).json()
-        for contact in contacts["output"]["records"]:
-            salesforce_id = contact['id']
-            company_id = contact['fields']['companyId']
-
-            account_data = sb.table('entity_integration').select('entity_based_id') \
-                .eq('salesforce_id', company_id) \
-                .eq('entity_type_id', 2) \
-                .limit(1).execute()
-
-            # Check if the salesforce_id exists before proceeding
-            if self.check_salesforce_id(salesforce_id):
-                print(f"Salesforce ID {salesforce_id} already exists in the entity_integration table.")
-                # Update the existing record
-                existing_record_response = sb.table('entity_integration').select('entity_based_id').eq('salesforce_id',
-                                                                                                       salesforce_id).execute()
-                entity_based_id = existing_record_response.data[0]['entity_based_id']
-
-                # Get the phone_book_id from the contact table
-                contact_response = sb.table('contact').select('phone_book_id').eq('id',
-                                                                                  entity_based_id).execute()
-                phone_book_id = contact_response.data[0]['phone_book_id']
-
-                # Query the contact table to get the account_id
-                contact_id_response = sb.table('contact').select('account_id').eq('id', entity_based_id).execute()
-                acc_id = contact_id_response.data[0]['account_id']
-
-                payload = self.map_o(contact, tenant_id, owner_id)
-                print("phone payload: ", payload['phone_book'])
-                print("contact payload: ", payload['contact'])
-
-                # Update the phone_book and contact tables using the retrieved phone_book_id
-                sb.table("phone_book").update(payload['phone_book']).eq('id', phone_book_id).execute()
-                sb.table("contact").update(
-                    {**payload['contact'], "phone_book_id": phone_book_id, "account_id": acc_id}).eq('id',
-                                                                                                     entity_based_id).execute()
-
-                print(f"Successfully updated Salesforce ID {salesforce_id} in the phone_book and contact tables.")
-                print()
-            else:
-                entity_based_ids = account_data.data
-                payload = self.map_o(contact, tenant_id, owner_id)
-                if entity_based_ids:
-                    account_id = entity_based_ids[0]['entity_based_id']
-                    print(f"Entity Based ID: {account_id}")
-                    phone_book_response = sb.table("phone_book").insert(payload['phone_book']).execute()
-                    phone_book_id = phone_book_response.data[0]['id']
-                    contact_response = sb.table("contact").insert(
-                        {**payload['contact'], "phone_book_id": phone_book_id, "account_id": account_id}).execute()
-                    id_ = contact_response.data[0]['id']
-                    print("id ", id_, "salesforce id: ", contact['id'])
-                    # Add/Update row to entity_integration table
-                    sb.table("entity_integration").insert(
-                        {"entity_based_id": id_, "salesforce_id": contact["id"], "entity_type_id":
-                            1}).execute()
-
-                    print(
-                        f"Successfully inserted Salesforce ID {salesforce_id} into the phone_book, contact, and "
-                        f"entity_integration tables.")
-                else:
-                    print("No records found.")
+        records = integration.list_records(self)
+        return integration.import_records(self, "contact", EntityType.CONTACT, records, tenant_id, owner_id)
@@ -0,0 +1,161 @@
+"""
+Direct Postgres loader for the backfill, bypassing PostgREST.
+
+:class:`CopyLoader` streams a batch of mapped rows with ``COPY`` into temporary staging tables
+shaped like the target tables, then merges them in the same transaction: parent rows
+(``phone_book``, ``deal_lead_source``) first, then the entity rows pointing at them, then their
+entity_integration links, marked as imported like ``integration.imported_columns`` marks them.
+Records linked by another run in the meantime are dropped from the staging tables before the
+merge, and a failed batch leaves nothing behind.
+
+Ids are assigned in the staging tables, from the target table's sequence or column default, so
+entity rows can be joined to their parents before anything is inserted. Requires ``psycopg2``
+and a connection string of the Supabase database, e.g. its direct or session pooler URL::
+
+    python -m sync.backfill --tenant 7 --owner <user_id> --checkpoint backfill-7.json --dsn postgresql://...
+"""
+import json
+
+from sync import logs, metrics, tracing
+
+logger = logs.get_logger(__name__)
+
+COPY_ROWS = metrics.registry.counter("sync_copy_rows_total", "Rows merged by the COPY loader", ("table",))
+
+_KEY = "_sync_key"
+
+
+class CopyLoader:
+    def __init__(self, dsn: str, schema: str = "public"):
+        """
+        :param dsn: Postgres connection string of the Supabase database
+        :param schema: Schema of the target tables
+        """
+        import psycopg2
+
+        self._connection = psycopg2.connect(dsn)
+        self.schema = schema
+        self._sequences = {}
+
+    def load(self, entity_type, table: str, keys: list, parents: dict, rows: list, updated_at: list = None) -> int:
+        """
+        Insert a batch of records in one transaction.
+
+        :param entity_type: The ``EntityType`` of the records
+        :param table: The entity table
+        :param keys: The Salesforce ID of each row
+        :param parents: Column of ``rows`` to ``(parent table, parent rows)``, one parent row per row
+        :param rows: Entity rows, without their parent columns
+        :param updated_at: The ``updatedTime`` of each record, saved as its link's ``salesforce_updated_at``
+        :return: The number of entity rows inserted
+        """
+        with tracing.span("copy.load", table=table, rows=len(rows)), self._connection, \
+                self._connection.cursor() as cursor:
+            entity_stage = self._stage(cursor, table, keys, rows)
+            cursor.execute(
+                f'DELETE FROM {entity_stage} s USING {self._table("entity_integration")} ei'
+                f' WHERE ei.entity_type_id = %s AND ei.salesforce_id = s.{_KEY}', (entity_type.value,))
+            if cursor.rowcount:
+                logger.info("Dropped records linked by another run", extra={"table": table, "count": cursor.rowcount})
+
+            for column, (parent_table, parent_rows) in parents.items():
+                parent_stage = self._stage(cursor, parent_table, keys, parent_rows)
+                cursor.execute(f"DELETE FROM {parent_stage} p WHERE NOT EXISTS"
+                               f" (SELECT 1 FROM {entity_stage} s WHERE s.{_KEY} = p.{_KEY})")
+                cursor.execute(f'UPDATE {entity_stage} s SET "{column}" = p.id FROM {parent_stage} p'
+                               f" WHERE p.{_KEY} = s.{_KEY}")
+                self._merge(cursor, parent_table)
+
+            inserted = self._merge(cursor, table)
+            cursor.execute(
+                f"INSERT INTO {self._table('entity_integration')} (entity_based_id, salesforce_id, entity_type_id,"
+                f" sync_origin, salesforce_updated_at, synced_at)"
+                f" SELECT s.id, s.{_KEY}, %s, 'salesforce', u.updated_at, now() FROM {entity_stage} s"
+                f" LEFT JOIN unnest(%s::text[], %s::timestamptz[]) AS u(key, updated_at) ON u.key = s.{_KEY}",
+                (entity_type.value, list(keys), list(updated_at or [None] * len(keys))))
+            COPY_ROWS.inc(cursor.rowcount, table="entity_integration")
+        return inserted
+
+    def _table(self, table: str) -> str:
+        return f'"{self.schema}"."{table}"'
+
+    def _stage(self, cursor, table: str, keys: list, rows: list) -> str:
+        stage = f'"_sync_stage_{table}"'
+        columns = list(dict.fromkeys(column for row in rows for column in row if column != "id"))
+        cursor.execute(f"CREATE TEMP TABLE {stage} (LIKE {self._table(table)} INCLUDING DEFAULTS) ON COMMIT DROP")
+        # LIKE copies NOT NULL, but identity ids and parent columns are only filled in below; the merge
+        # into the table checks every constraint
+        cursor.execute("SELECT attname FROM pg_attribute WHERE attrelid = %s::regclass AND attnum > 0"
+                       " AND attnotnull AND NOT attisdropped", (stage,))
+        alterations = [f'ALTER COLUMN "{row[0]}" DROP NOT NULL' for row in cursor.fetchall()]
+        cursor.execute(f"ALTER TABLE {stage} {', '.join(alterations + [f'ADD COLUMN {_KEY} text'])}")
+        column_list = ", ".join(f'"{column}"' for column in columns + [_KEY])
+        lines = (_copy_line([row.get(column) for column in columns] + [key]) for row, key in zip(rows, keys))
+        cursor.copy_expert(f"COPY {stage} ({column_list}) FROM STDIN", _LineStream(lines))
+        sequence = self._sequence(cursor, table)
+        if sequence:
+            cursor.execute(f"UPDATE {stage} SET id = nextval(%s) WHERE id IS NULL", (sequence,))
+        return stage
+
+    def _merge(self, cursor, table: str) -> int:
+        stage = f'"_sync_stage_{table}"'
+        cursor.execute("SELECT attname FROM pg_attribute WHERE attrelid = %s::regclass AND attnum > 0"
+                       " AND NOT attisdropped AND attname <> %s ORDER BY attnum", (stage, _KEY))
+        column_list = ", ".join(f'"{row[0]}"' for row in cursor.fetchall())
+        cursor.execute(f"INSERT INTO {self._table(table)} ({column_list}) OVERRIDING SYSTEM VALUE"
+                       f" SELECT {column_list} FROM {stage}")
+        COPY_ROWS.inc(cursor.rowcount, table=table)
+        return cursor.rowcount
+
+    def _sequence(self, cursor, table: str):
+        if table not in self._sequences:
+            cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", (f"{self.schema}.{table}",))
+            self._sequences[table] = cursor.fetchone()[0]
+        return self._sequences[table]
+
+    def close(self):
+        self._connection.close()
+
+
+def _copy_value(value) -> str:
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value)
+    return (str(value).replace("\\", "\\\\").replace("\t", "\\t")
+            .replace("\n", "\\n").replace("\r", "\\r"))
+
+
+def _copy_line(values: list) -> str:
+    """One row in COPY's text format."""
+    return "\t".join(_copy_value(value) for value in values) + "\n"
+
+
+class _LineStream:
+    """File-like object over an iterator of lines, so COPY reads rows as they are produced."""
+
+    def __init__(self, lines):
+        self._lines = iter(lines)
+        self._buffer = ""
+
+    def read(self, size: int = -1) -> str:
+        while size < 0 or len(self._buffer) < size:
+            line = next(self._lines, None)
+            if line is None:
+                break
+            self._buffer += line
+        if size < 0:
+            data, self._buffer = self._buffer, ""
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def readline(self, size: int = -1) -> str:
+        if not self._buffer:
+            self._buffer = next(self._lines, "")
+        index = self._buffer.find("\n")
+        end = len(self._buffer) if index < 0 else index + 1
+        data, self._buffer = self._buffer[:end], self._buffer[end:]
+        return data
@@ -0,0 +1,232 @@
+"""
+Long-running sync that keeps its state warm between cycles.
+
+A one-off ``python -m sync.main`` builds the entity instances, their integration.app sessions and
+every lookup again for each run. :class:`Daemon` runs cycles on a schedule in one process and
+keeps, per tenant, in a :class:`TenantState`:
+
+* the entity instances, so their ``requests`` sessions keep their connection pools;
+* an :class:`sync.integration.IdMap` of the tenant's entity_integration links, so a cycle only
+  looks up the Salesforce IDs it hasn't seen before;
+* the tenant's references, cached by :func:`sync.integration.tenant_references`.
+
+The Supabase client is already kept for the life of the process by :data:`sync.clients.registry`.
+Connections are read from integration_connection at the start of each cycle, and a tenant whose
+access token changed gets it on its warm sessions. At most ``max_tenants`` tenants are kept: the
+least recently synced are evicted first, as are tenants idle for more than ``idle_ttl`` seconds::
+
+    python -m sync.daemon --interval 300 --max-tenants 200
+"""
+import argparse
+import collections
+import signal
+import threading
+import time
+
+from sync import breaker, integration, logs, metrics
+from sync.main import Sync, DIRECTIONS, ENTITY_CLASSES, entity_types
+
+logger = logs.get_logger(__name__)
+
+TENANTS = metrics.registry.counter("sync_daemon_tenants_total", "Tenant states loaded, evicted and re-tokened",
+                                   ("event",))
+CYCLES = metrics.registry.histogram("sync_daemon_cycle_seconds", "Wall-clock time of a daemon cycle", ("outcome",))
+
+
+class TenantState:
+    """What the daemon keeps of a tenant between cycles."""
+
+    def __init__(self, tenant_id, access_token: str, max_links: int = 100_000):
+        self.tenant_id = tenant_id
+        self.access_token = access_token
+        self.entities = {}  # entity class -> instance
+        self.ids = integration.IdMap(max_links)
+        self.last_used = time.monotonic()
+
+    def set_token(self, access_token: str):
+        self.access_token = access_token
+        for instance in self.entities.values():
+            instance.session.headers.update({"Authorization": f"Bearer {access_token}"})
+        # The new token deserves a try, even if the old one had opened the tenant's breakers
+        breaker.breakers.reset(str(self.tenant_id))
+
+    def close(self):
+        for instance in self.entities.values():
+            instance.session.close()
+        self.entities.clear()
+        integration.clear_references(self.tenant_id)
+
+
+class WarmSync(Sync):
+    """``Sync`` reusing each tenant's :class:`TenantState` across runs."""
+
+    def __init__(self, *args, max_tenants: int = 200, idle_ttl: float = 3600.0, max_links: int = 100_000,
+                 **kwargs):
+        """
+        Takes the arguments of ``Sync``, and:
+
+        :param max_tenants: Tenant states kept at most, the least recently synced evicted first
+        :param idle_ttl: Seconds after which a tenant not synced since is evicted
+        :param max_links: entity_integration links kept per tenant
+        """
+        super().__init__(*args, **kwargs)
+        self.max_tenants = max_tenants
+        self.idle_ttl = idle_ttl
+        self.max_links = max_links
+        self.tenants = collections.OrderedDict()  # tenant_id -> TenantState
+        self._lock = threading.Lock()
+
+    def tenant(self, connection: dict) -> TenantState:
+        """The state of a connection's tenant, loaded on first use and given the connection's current token."""
+        tenant_id = connection["tenant_id"]
+        access_token = connection["connection_details"]["access_token"]
+        with self._lock:
+            state = self.tenants.get(tenant_id)
+            if state is None:
+                state = self.tenants[tenant_id] = TenantState(tenant_id, access_token, self.max_links)
+                TENANTS.inc(event="loaded")
+            self.tenants.move_to_end(tenant_id)
+            state.last_used = time.monotonic()
+        if state.access_token != access_token:
+            logger.info("Reloaded access token", extra={"tenant_id": tenant_id})
+            TENANTS.inc(event="token_reloaded")
+            state.set_token(access_token)
+        return state
+
+    def entity(self, cls, connection: dict):
+        state = self.tenant(connection)
+        instance = state.entities.get(cls)
+        if instance is None:
+            instance = state.entities[cls] = super().entity(cls, connection)
+        elif self.mode == "incremental":
+            instance.since = self.since_for(connection["tenant_id"])
+        return instance
+
+    def sync_connection(self, connection: dict, directions: tuple = ("import", "export")) -> dict:
+        with integration.use_id_map(self.tenant(connection).ids):
+            return super().sync_connection(connection, directions)
+
+    def evict(self, now: float = None) -> list:
+        """
+        Drop the tenants idle for more than ``idle_ttl`` seconds, then the least recently synced beyond
+        ``max_tenants``.
+
+        :return: The evicted tenant IDs
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            evicted = [state for state in self.tenants.values() if now - state.last_used > self.idle_ttl]
+            for state in evicted:
+                del self.tenants[state.tenant_id]
+            while len(self.tenants) > self.max_tenants:
+                evicted.append(self.tenants.popitem(last=False)[1])
+        for state in evicted:
+            state.close()
+        if evicted:
+            TENANTS.inc(len(evicted), event="evicted")
+            logger.info("Evicted idle tenants", extra={"tenants": [state.tenant_id for state in evicted],
+                                                       "kept": len(self.tenants)})
+        return [state.tenant_id for state in evicted]
+
+
+class Daemon:
+    def __init__(self, sync: WarmSync, interval: float = 300.0, directions: tuple = ("import", "export"),
+                 tenant_ids: tuple = None, parallel: int = 1):
+        """
+        :param sync: The ``WarmSync`` run each cycle
+        :param interval: Seconds from the start of a cycle to the start of the next
+        :param directions: Directions synced each cycle
+        :param tenant_ids: Only sync these tenants, all by default
+        :param parallel: Tenants synced at once
+        """
+        self.sync = sync
+        self.interval = interval
+        self.directions = directions
+        self.tenant_ids = tenant_ids
+        self.parallel = parallel
+        self.cycles = 0
+        self._stop = threading.Event()
+
+    def run_cycle(self) -> dict:
+        """:return: The results of ``Sync.sync_salesforce``, empty if the cycle failed"""
+        start = time.perf_counter()
+        outcome, results = "ok", {}
+        try:
+            results = self.sync.sync_salesforce(self.directions, self.tenant_ids, self.parallel)
+        except Exception:
+            outcome = "failed"
+            logger.exception("Sync cycle failed", extra={"cycle": self.cycles})
+        self.sync.evict()
+        self.cycles += 1
+        seconds = time.perf_counter() - start
+        CYCLES.observe(seconds, outcome=outcome)
+        logger.info("Sync cycle finished", extra={"cycle": self.cycles, "outcome": outcome, "tenants": len(results),
+                                                  "warm_tenants": len(self.sync.tenants),
+                                                  "seconds": round(seconds, 3)})
+        return results
+
+    def run_forever(self, cycles: int = None):
+        """Run a cycle every ``interval`` seconds until :meth:`stop`, or for ``cycles`` cycles."""
+        while not self._stop.is_set() and (cycles is None or self.cycles < cycles):
+            started = time.monotonic()
+            self.run_cycle()
+            self._stop.wait(max(self.interval - (time.monotonic() - started), 0.0))
+
+    def stop(self):
+        self._stop.set()
+
+    def close(self):
+        """Close the sessions of every warm tenant."""
+        self.sync.evict(float("inf"))
+
+
+if __name__ == "__main__":
+    from sync import capture
+    from sync.config import (SYNC_LOG_LEVEL, SYNC_LOG_SAMPLE_EVERY, SYNC_JOURNAL_PATH, SYNC_CAPTURE_PATH,
+                             SYNC_INTEGRATION_APP_URL, SYNC_DAEMON_INTERVAL, SYNC_DAEMON_MAX_TENANTS,
+                             SYNC_DAEMON_IDLE_TTL)
+    from sync.journal import ExportJournal, RetryWorker
+
+    parser = argparse.ArgumentParser(description="Sync Salesforce connections on a schedule, keeping state warm")
+    parser.add_argument("--interval", type=float, default=SYNC_DAEMON_INTERVAL,
+                        help="Seconds from the start of a cycle to the next")
+    parser.add_argument("--max-tenants", type=int, default=SYNC_DAEMON_MAX_TENANTS,
+                        help="Tenants kept warm, the least recently synced evicted first")
+    parser.add_argument("--idle-ttl", type=float, default=SYNC_DAEMON_IDLE_TTL,
+                        help="Seconds after which a tenant not synced since is evicted")
+    parser.add_argument("--tenant", type=int, action="append", help="Tenant to sync, repeatable; default: all")
+    parser.add_argument("--entities", type=entity_types, default=",".join(ENTITY_CLASSES),
+                        help="Comma-separated entity types")
+    parser.add_argument("--direction", choices=DIRECTIONS, action="append",
+                        help="Direction to sync, repeatable; default: import then export")
+    parser.add_argument("--mode", choices=("full", "incremental"), default="full")
+    parser.add_argument("--concurrency", type=int, default=4, help="Entity stages run at once per user")
+    parser.add_argument("--tenant-concurrency", type=int, default=1, help="Tenants synced at once")
+    parser.add_argument("--batch-size", type=int, help="Records per integration.app batch call on export")
+    parser.add_argument("--timeout", type=float, help="Seconds before an integration.app request times out")
+    parser.add_argument("--cycles", type=int, help="Exit after this many cycles")
+    args = parser.parse_args()
+
+    logs.configure(SYNC_LOG_LEVEL, sample_every=SYNC_LOG_SAMPLE_EVERY)
+    capture.configure(SYNC_CAPTURE_PATH, SYNC_INTEGRATION_APP_URL)
+    export_journal = ExportJournal(SYNC_JOURNAL_PATH) if SYNC_JOURNAL_PATH else None
+    daemon = Daemon(WarmSync(export_journal, args.entities, args.batch_size, args.concurrency,
+                             args.timeout, args.mode, max_tenants=args.max_tenants, idle_ttl=args.idle_ttl),
+                    args.interval, tuple(args.direction or ("import", "export")),
+                    tuple(args.tenant) if args.tenant else None, args.tenant_concurrency)
+    retry_worker = None
+    if export_journal:
+        from sync.service import ExportService
+
+        retry_worker = RetryWorker(export_journal, ExportService())
+        retry_worker.start()
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+    logger.info("Sync daemon started", extra={"interval": args.interval, "max_tenants": args.max_tenants})
+    try:
+        daemon.run_forever(args.cycles)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.close()
+        if retry_worker:
+            retry_worker.stop()
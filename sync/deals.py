@@ -1,16 +1,47 @@
-import requests
 from datetime import datetime
-from sync import sb
+from sync import sb, guards, integration, logs, metrics, tracing
+from sync.config import SYNC_EXPORT_BATCH_SIZE
 from sync.enums import EntityType
 
+logger = logs.get_logger(__name__)
+
 
 class Deals:
-    def __init__(self, access_token: str, salesforce_id: str):
-        session = requests.session()
+    export_url = "https://api.integration.app/connections/salesforce/actions/create-deal/run"
+    update_url = "https://api.integration.app/connections/salesforce/actions/update-deal/run"
+    batch_create_url = "https://api.integration.app/connections/salesforce/actions/batch-create-deals/run"
+    batch_update_url = "https://api.integration.app/connections/salesforce/actions/batch-update-deals/run"
+    owner_column = "owner_id"
+    export_columns = "*, entity_stage(*), deal_lead_source(*)"
+    import_url = "https://api.integration.app/connections/salesforce/actions/get-deals/run"
+    # map_o keys written to their own table first, and the column linking them
+    import_parents = {"source": ("deal_lead_source", "source_id")}
+    # Columns resolved from a Salesforce reference field through entity_integration
+    import_references = {}
+    # Columns of map_o compared by sync.reconcile, by map_o key; text, integer or boolean columns only
+    reconcile_columns = {
+        "deal": ("name", "score"),
+        "source": ("name",),
+    }
+
+    def __init__(self, access_token: str, salesforce_id: str, journal=None, batch_size: int = None,
+                 since: str = None):
+        """
+        :param journal: Optional ``TenantJournal`` recording pending and failed exports for retry
+        :param batch_size: Records per batch action call on export, defaults to ``SYNC_EXPORT_BATCH_SIZE``;
+            1 exports each record with its own request
+        :param since: Import only records updated after this time, ISO 8601; all records by default
+        """
+        session = guards.GuardedSession()
         session.headers.update({'Authorization': f'Bearer {access_token}'})
         self.session = session
         self.salesforce_id = salesforce_id
+        self.journal = journal
+        self.batch_size = SYNC_EXPORT_BATCH_SIZE if batch_size is None else batch_size
+        self.since = since
 
+    @tracing.traced(entity="deal")
+    @metrics.scope(entity="deal")
     def delete_from_supabase(self, record_id: str):
         """
         Delete a deal from Supabase, the entity_integration table, and Salesforce.
@@ -21,9 +52,8 @@ class Deals:
         integration_response = sb.table('entity_integration').select('salesforce_id').eq('entity_based_id',
                                                                                          record_id).execute()
         if not integration_response.data:
-            print(
-                f"Failed to retrieve salesforce_id for deal {record_id} from entity_integration: "
-                f"{integration_response.json()}")
+            logger.warning("Failed to retrieve salesforce_id from entity_integration",
+                           extra={"record_id": record_id, "response": integration_response.json()})
             return
 
         salesforce_id = integration_response.data[0]['salesforce_id']
@@ -31,49 +61,62 @@ class Deals:
         # Attempt to delete from Salesforce using the retrieved salesforce_id
         self.delete_from_salesforce(salesforce_id)
 
-    def delete_from_salesforce(self, salesforce_id: str):
+    @tracing.traced(entity="deal")
+    @metrics.scope(entity="deal")
+    def delete_from_salesforce(self, salesforce_id: str) -> bool:
         """
         Delete a deal from Salesforce and Supabase.
 
         :param salesforce_id: The Salesforce ID of the deal to delete
+        :return: True if the deal was deleted from Salesforce, False otherwise
         """
         url = "https://api.integration.app/connections/salesforce/actions/delete-deals/run"
         payload = {
             "id": salesforce_id
         }
         salesforce_response = self.session.post(url, json=payload)
-        if salesforce_response.status_code == 200:
-            print(f"Successfully deleted deal {salesforce_id} from Salesforce")
+        # 404: already deleted in Salesforce, which is what was asked for (as in integration._delete_linked)
+        if salesforce_response.status_code in (200, 404):
+            logger.info("Deleted deal from Salesforce", extra={"salesforce_id": salesforce_id,
+                                                               "status_code": salesforce_response.status_code})
+            if self.journal:
+                self.journal.done("deal", "delete", salesforce_id)
         else:
-            print(f"Failed to delete deal {salesforce_id} from Salesforce: {salesforce_response.json()}")
-            return
+            logger.error("Failed to delete deal from Salesforce",
+                         extra={"salesforce_id": salesforce_id, "status_code": salesforce_response.status_code,
+                                "response": salesforce_response.json()})
+            if self.journal:
+                self.journal.failed("deal", "delete", salesforce_id,
+                                    f"HTTP {salesforce_response.status_code}: {salesforce_response.text}")
+            return False
 
         # Retrieve the entity_based_id from the entity_integration table
         integration_response = sb.table('entity_integration').select('entity_based_id').eq('salesforce_id',
                                                                                            salesforce_id).execute()
         if not integration_response.data:
-            print(
-                f"Failed to retrieve entity_based_id for salesforce_id {salesforce_id} from entity_integration: "
-                f"{integration_response.json()}")
-            return
+            logger.warning("Failed to retrieve entity_based_id from entity_integration",
+                           extra={"salesforce_id": salesforce_id, "response": integration_response.json()})
+            return True
 
         entity_based_id = integration_response.data[0]['entity_based_id']
 
         # Delete from Supabase deal table
         supabase_response = sb.table('deal').delete().eq('id', entity_based_id).execute()
         if supabase_response.data:
-            print(f"Successfully deleted deal {entity_based_id} from Supabase")
+            logger.info("Deleted deal from Supabase", extra={"record_id": entity_based_id})
         else:
-            print(f"Failed to delete deal {entity_based_id} from Supabase: {supabase_response.json()}")
+            logger.error("Failed to delete deal from Supabase",
+                         extra={"record_id": entity_based_id, "response": supabase_response.json()})
 
         # Delete from entity_integration table
         integration_response = sb.table('entity_integration').delete().eq('entity_based_id', entity_based_id).execute()
+        integration.forget_links(EntityType.DEAL, [salesforce_id])
         if integration_response.data:
-            print(f"Successfully deleted entity integration for deal {entity_based_id} from Supabase")
+            logger.info("Deleted deal entity integration from Supabase", extra={"record_id": entity_based_id})
         else:
-            print(
-                f"Failed to delete entity integration for deal {entity_based_id} from Supabase: "
-                f"{integration_response.json()}")
+            logger.error("Failed to delete deal entity integration from Supabase",
+                         extra={"record_id": entity_based_id, "response": integration_response.json()})
+        return True
 
     @staticmethod
     def map_i(row: dict) -> dict:
@@ -101,13 +144,9 @@ class Deals:
         """Field mapping from salesforce to supabase"""
         fields = row['fields']
 
-        # Get the group ID using the tenant ID
-        group_response = sb.table('entity_group').select('id').eq('tenant_id', tenant_id).limit(1).execute()
-        group_id = group_response.data[0]['id'] if group_response.data else None
-
-        # Get the stage ID using the group ID
-        stage_response = sb.table('entity_stage').select('id').eq('group_id', group_id).limit(1).execute()
-        stage_id = stage_response.data[0]['id'] if stage_response.data else None
+        # The tenant's group and stage, looked up once per tenant rather than per record
+        references = integration.tenant_references(tenant_id)
+        group_id, stage_id = references["group_id"], references["stage_id"]
 
         return {
             "deal": {
@@ -144,83 +183,82 @@ class Deals:
         return bool(response.data)
 
     @staticmethod
-    def track_record(id_: str, salesforce_id):
-        is_in_db = sb.table("entity_integration").select("*").eq("entity_based_id", id_).execute().data
-        if not is_in_db:
-            data = {
+    def track_record(id_: str, salesforce_id, export_hash: str = None, linked: bool = None):
+        """
+        Link a supabase deal to its Salesforce ID in the entity_integration table.
+
+        :param export_hash: Hash of the payload just exported, stored to skip the row while unchanged
+        :param linked: Whether the row already has an entity_integration row; looked up when None
+        """
+        data = {"salesforce_id": salesforce_id, **integration.exported()}
+        if export_hash is not None:
+            data["export_hash"] = export_hash
+        if linked is None:
+            linked = bool(sb.table("entity_integration").select("id").eq("entity_based_id", id_).execute().data)
+        if not linked:
+            data.update({
                 "entity_based_id": id_,
-                "salesforce_id": salesforce_id,
                 "entity_type_id": EntityType.DEAL.value
-            }
+            })
             sb.table("entity_integration").insert(data).execute()
         else:
-            sb.table("entity_integration").update({"salesforce_id": salesforce_id}).eq("entity_based_id", id_).execute()
+            (sb.table("entity_integration").update(data).eq("entity_type_id", EntityType.DEAL.value)
+             .eq("entity_based_id", id_).execute())
 
+    @tracing.traced(entity="deal")
+    @metrics.scope(entity="deal")
     def to_salesforce_deals(self, owner_id: str):
         """
         Export supabase deals to Salesforce
         """
-        integration_url = "https://api.integration.app/connections/salesforce/actions/create-deal/run"
-        deals = sb.table("deal").select("*, entity_stage(*), deal_lead_source(*)").eq("owner_id",
-                                                                                      owner_id).execute().data
-        for deal in deals:
-            payload = self.map_i(deal)
-            response = self.session.post(integration_url, json=payload)
-            if response.status_code == 200:
-                print(f"Successfully exported deal {payload['name']}")
-                id_ = response.json()["output"]["id"]
-                self.track_record(deal["id"], id_)
-            else:
-                res_json = response.json()
-                print(res_json)
+        deals = sb.table("deal").select(self.export_columns).eq(self.owner_column, owner_id).execute().data
+        integration.export_journaled(self, "deal", deals)
+
+    def export_by_id(self, record_id: str) -> bool:
+        """
+        Export a single supabase deal to Salesforce.
+
+        :param record_id: The ID of the deal to export
+        :return: True if the deal was exported, False otherwise
+        """
+        return self.export_by_ids([record_id]).get(record_id, False)
+
+    @tracing.traced(entity="deal")
+    @metrics.scope(entity="deal")
+    def export_by_ids(self, record_ids: list) -> dict:
+        """
+        Export the given supabase deals to Salesforce, selecting them in one query.
+
+        :param record_ids: The IDs of the deals to export
+        :return: A dict mapping each ID to True if it was exported, False otherwise
+        """
+        rows = sb.table("deal").select(self.export_columns).in_("id", list(record_ids)).execute().data
+        results = {record_id: False for record_id in record_ids}
+        missing = set(results) - {row["id"] for row in rows}
+        if missing:
+            logger.warning("Deals to export not found", extra={"record_ids": sorted(missing)})
+        results.update(self.export_rows(rows))
+        return results
+
+    def export_rows(self, deals: list) -> dict:
+        """
+        Export deal rows, as selected with ``export_columns``. Rows already linked in entity_integration
+        are updated, the others are created, and rows unchanged since their last export are skipped.
+        With a ``batch_size`` above 1 they go through the batch actions, see ``integration.export_batched``.
+
+        :return: A dict mapping each row ID to True if it was exported or unchanged, False otherwise
+        """
+        links = integration.fetch_links(EntityType.DEAL, [deal["id"] for deal in deals])
+        integration.settle_imported(EntityType.DEAL, deals, links, self.map_i)
+        if self.batch_size > 1:
+            return integration.export_batched(self, "deal", EntityType.DEAL, deals, links, self.batch_size)
+        return {deal["id"]: integration.export_row(self, "deal", deal, links.get(deal["id"])) for deal in deals}
 
+    @tracing.traced(entity="deal")
+    @metrics.scope(entity="deal")
     def from_salesforce_deals(self, owner_id: str, tenant_id):
         """
         Import salesforce deals to Salesforce
         """
-        integration_url = "https://api.integration.app/connections/salesforce/actions/get-deals/run"
-        deals = self.session.post(integration_url).json()
-        for deal in deals["output"]["records"]:
-            salesforce_id = deal['id']
-
-            # Check if the salesforce_id exists before proceeding
-            if self.check_salesforce_id(salesforce_id):
-                print(f"Salesforce ID {salesforce_id} already exists in the entity_integration table.")
-                # Update the existing record
-                existing_record_response = (sb.table('entity_integration').
-                                            select('entity_based_id').eq('salesforce_id', salesforce_id).execute())
-                entity_based_id = existing_record_response.data[0]['entity_based_id']
-
-                # Get the source_id from the deal table
-                deal_response = sb.table('deal').select('source_id').eq('id', entity_based_id).execute()
-                source_id = deal_response.data[0]['source_id']
-
-                payload = self.map_o(deal, tenant_id, owner_id)
-                print("source payload: ", payload['source'])
-                print("deal payload: ", payload['deal'])
-
-                # Update the deal_lead_source and deal tables using the retrieved source_id
-                sb.table("deal_lead_source").update(payload['source']).eq('id', source_id).execute()
-                sb.table("deal").update({**payload['deal'], "source_id": source_id}).eq('id', entity_based_id).execute()
-
-                print(f"Successfully updated Salesforce ID {salesforce_id} in the deal_lead_source and deal tables.")
-                print()
-            else:
-                payload = self.map_o(deal, tenant_id, owner_id)
-                print("source payload: ", payload['source'])
-                print("deal payload: ", payload['deal'])
-                source_response = sb.table("deal_lead_source").insert(payload['source']).execute()
-                source_id = source_response.data[0]['id']
-                deal_response = sb.table("deal").insert(
-                    {**payload['deal'], "source_id": source_id}).execute()
-                id_ = deal_response.data[0]['id']
-                print("id ", id_, "salesforce id: ", deal['id'])
-                # Add/Update row to entity_integration table
-                sb.table("entity_integration").insert(
-                    {"entity_based_id": id_, "salesforce_id": deal["id"],
-                     "entity_type_id": 3}).execute()
-
-                print(
-                    f"Successfully inserted Salesforce ID {salesforce_id} into the deal_lead_source, deal, and "
-                    f"entity_integration tables.")
-                print()
+        records = integration.list_records(self)
+        return integration.import_records(self, "deal", EntityType.DEAL, records, tenant_id, owner_id)
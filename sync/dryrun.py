@@ -0,0 +1,140 @@
+"""
+Dry runs: every read goes through, no write does.
+
+:class:`DryRunClient` wraps a Supabase client and answers inserts, upserts, updates and deletes
+with their payload instead of sending them, inserted rows getting placeholder IDs; calls of the
+database functions in :data:`WRITE_FUNCTIONS` are held back too.
+:class:`DryRunSession` wraps an entity's session and answers integration.app create, update,
+delete and batch actions as if every record was saved, while list actions still reach
+Salesforce. Both count the writes they hold back in :data:`PLANNED`::
+
+    with registry.use(DryRunClient(registry.get())):
+        accounts.session = DryRunSession(accounts.session)
+        accounts.to_salesforce(owner_id)
+    print(planned())
+"""
+import itertools
+import re
+import threading
+
+from sync import guards, metrics
+from sync.fakes import FakeResponse, MemoryResponse
+
+PLANNED = metrics.registry.counter("sync_dry_run_writes_total", "Writes held back by a dry run",
+                                   ("backend", "target", "operation"))
+
+_WRITES = ("insert", "upsert", "update", "delete")
+# Database functions that write, by name: the table and operation they are counted as, and the parameter
+# holding their rows; a table of None is given by the ``p_table`` parameter
+WRITE_FUNCTIONS = {"update_entity_integration": ("entity_integration", "update", "p_rows"),
+                   "update_rows": (None, "update", "p_rows")}
+_ACTION = re.compile(r"/actions/([^/]+)/run")
+_ids = itertools.count(1)
+_ids_lock = threading.Lock()
+
+
+def _placeholder_id() -> str:
+    with _ids_lock:
+        return f"dry-run-{next(_ids)}"
+
+
+class DryRunQuery:
+    def __init__(self, builder, table: str):
+        self._builder = builder
+        self._table = table
+        self._write = None
+
+    def execute(self):
+        if self._write is None:
+            return self._builder.execute()
+        operation, payload = self._write
+        rows = [dict(row) for row in (payload if isinstance(payload, list) else [payload] if payload else [])]
+        if operation == "insert":
+            for row in rows:
+                row.setdefault("id", _placeholder_id())
+        PLANNED.inc(max(len(rows), 1), backend="supabase", target=self._table, operation=operation)
+        return MemoryResponse(rows)
+
+    def __getattr__(self, name):
+        if self._write is not None:
+            # Filters of a held back write don't matter
+            return lambda *args, **kwargs: self
+        attr = getattr(self._builder, name)
+        if name in _WRITES:
+            def write(payload=None, *args, **kwargs):
+                self._write = (name, payload)
+                return self
+
+            return write
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            if hasattr(result, "execute"):
+                self._builder = result
+                return self
+            return result
+
+        return call
+
+
+class DryRunClient:
+    def __init__(self, client):
+        """
+        :param client: The client reads go to; the ``GuardedClient`` and ``InstrumentedClient`` layers
+            are unwrapped, since ``registry.use`` puts them around the dry-run client again
+        """
+        self._client = guards.unwrap(client)
+
+    def table(self, name: str) -> DryRunQuery:
+        return DryRunQuery(self._client.table(name), name)
+
+    def rpc(self, function: str, params: dict = None):
+        if function not in WRITE_FUNCTIONS:
+            return self._client.rpc(function, params)
+        return DryRunRpc(function, params or {})
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+class DryRunRpc:
+    def __init__(self, function: str, params: dict):
+        self._function = function
+        self._params = params
+
+    def execute(self):
+        table, operation, rows = WRITE_FUNCTIONS[self._function]
+        count = len(self._params.get(rows) or [])
+        PLANNED.inc(max(count, 1), backend="supabase", target=table or self._params.get("p_table"),
+                    operation=operation)
+        return MemoryResponse(count)
+
+
+class DryRunSession:
+    def __init__(self, session):
+        self._session = session
+
+    def post(self, url: str, json: dict = None, **kwargs):
+        match = _ACTION.search(url)
+        action = match.group(1) if match else url
+        kind = action.split("-")[1] if action.startswith("batch-") else action.split("-")[0]
+        if kind not in ("create", "update", "delete"):
+            return self._session.post(url, json=json, **kwargs)
+        if action.startswith("batch-"):
+            records = (json or {}).get("records", [])
+            PLANNED.inc(len(records), backend="integration_app", target=action, operation=kind)
+            return FakeResponse(200, {"output": [{"id": record.get("id") or _placeholder_id(), "success": True,
+                                                  "errors": []} for record in records]})
+        PLANNED.inc(backend="integration_app", target=action, operation=kind)
+        return FakeResponse(200, {"output": {"id": (json or {}).get("id") or _placeholder_id()}})
+
+    def __getattr__(self, name):
+        return getattr(self._session, name)
+
+
+def planned() -> list:
+    """The writes held back so far, as ``{"backend", "target", "operation", "count"}`` dicts."""
+    samples = sorted(PLANNED.samples(), key=lambda sample: sorted(sample[0].items()))
+    return [{**labels, "count": int(count)} for labels, count in samples]
@@ -0,0 +1,522 @@
+"""
+In-process fakes of the external services, for tests and local runs.
+
+:class:`FakeIntegrationApp` stands in for the ``requests`` session of an entity instance and
+answers integration.app action calls from an in-memory record store::
+
+    accounts = Accounts("token", "")
+    accounts.session = FakeIntegrationApp(fail=lambda action, record: "REQUIRED_FIELD_MISSING"
+                                                 if not record.get("name") else None)
+
+:class:`MemoryClient` stands in for the Supabase client, with tables kept in dicts, and is put
+in place of ``sync.sb`` with :meth:`sync.clients.ClientRegistry.use`. Its ``rpc()`` runs Python
+versions of the database functions in ``sql/``. Both count their round trips.
+
+:func:`seed` fills a :class:`MemoryClient` with the rows of one tenant, and :func:`salesforce_records`
+makes the matching records of the import actions, for :mod:`sync.budget` and the tests.
+"""
+import collections
+import copy
+import itertools
+import json
+import re
+import threading
+import time
+
+import requests
+
+_ACTION = re.compile(r"/actions/([^/]+)/run")
+
+
+class FakeResponse:
+    def __init__(self, status_code: int, body):
+        self.status_code = status_code
+        self._body = body
+        self.text = json.dumps(body)
+
+    def json(self):
+        return self._body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} error: {self.text}", response=self)
+
+
+class FakeIntegrationApp:
+    """
+    Answers ``create-*``, ``update-*``, ``delete-*`` and ``batch-create-*``/``batch-update-*`` actions,
+    and list actions such as ``get-contacts`` from ``listings``.
+
+    Batch actions answer like Salesforce sObject Collections: one ``{"id", "success", "errors"}``
+    result per record, in request order, with HTTP 200 even when some records failed.
+    """
+
+    def __init__(self, fail=None, duplicates=None, listings: dict = None, page_size: int = None):
+        """
+        :param fail: Optional ``fail(action, record)`` returning a Salesforce status code to reject the record
+            with, or None to accept it
+        :param duplicates: Optional ``duplicates(record)`` returning the ID of an existing record a create
+            matches under duplicate rules, or None
+        :param listings: Records returned by list actions, by action name
+        :param page_size: Records per page of a list action, followed by a ``cursor``; all at once by default
+        """
+        self.fail = fail or (lambda action, record: None)
+        self.duplicates = duplicates or (lambda record: None)
+        self.listings = listings or {}
+        self.page_size = page_size
+        self.records = {}  # salesforce id -> fields
+        self.calls = []  # (action, number of records)
+        self.headers = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def post(self, url: str, json: dict = None, **kwargs) -> FakeResponse:
+        match = _ACTION.search(url)
+        action = match.group(1) if match else url
+        json = json or {}
+        with self._lock:
+            if action.startswith("batch-"):
+                records = json.get("records", [])
+                self.calls.append((action, len(records)))
+                kind = action.split("-")[1]
+                return FakeResponse(200, {"output": [self._save(kind, record) for record in records]})
+            self.calls.append((action, 1))
+            kind = action.split("-")[0]
+            if kind == "delete":
+                if self.records.pop(json.get("id"), None) is None:
+                    return FakeResponse(404, {"message": "not found"})
+                return FakeResponse(200, {"output": {}})
+            if kind not in ("create", "update"):
+                return FakeResponse(200, {"output": self._page(action, json.get("cursor"))})
+            result = self._save(kind, json)
+            if result["success"]:
+                return FakeResponse(200, {"output": {"id": result["id"]}})
+            code = result["errors"][0]["statusCode"]
+            if code in ("ENTITY_IS_DELETED", "NOT_FOUND"):
+                return FakeResponse(404, {"message": code})
+            return FakeResponse(400, {"data": {"response": {"data": result["errors"]}}})
+
+    def _save(self, kind: str, record: dict) -> dict:
+        code = self.fail(kind, record)
+        if code:
+            return {"id": None, "success": False, "errors": [{"statusCode": code, "message": code}]}
+        fields = {key: value for key, value in record.items() if key != "id"}
+        if kind == "update":
+            if record.get("id") not in self.records:
+                return {"id": None, "success": False,
+                        "errors": [{"statusCode": "ENTITY_IS_DELETED", "message": "entity is deleted"}]}
+            self.records[record["id"]].update(fields)
+            return {"id": record["id"], "success": True, "errors": []}
+        duplicate = self.duplicates(record)
+        if duplicate:
+            match = {"matchResults": [{"matchRecords": [{"record": {"Id": duplicate}}]}]}
+            return {"id": None, "success": False, "errors": [
+                {"statusCode": "DUPLICATES_DETECTED", "message": "duplicate", "duplicateResult": match}]}
+        id_ = f"FAKE{next(self._ids):014d}"
+        self.records[id_] = fields
+        return {"id": id_, "success": True, "errors": []}
+
+    def _page(self, action: str, cursor) -> dict:
+        records = self.listings.get(action, [])
+        if not self.page_size:
+            return {"records": records, "total": len(records)}
+        start = int(cursor or 0)
+        end = start + self.page_size
+        return {"records": records[start:end], "cursor": str(end) if end < len(records) else None,
+                "total": len(records)}
+
+    def request_count(self) -> int:
+        return len(self.calls)
+
+    def close(self):
+        pass
+
+
+# Embedded resources whose foreign key column isn't named ``<table>_id``
+RELATIONS = {
+    ("deal", "deal_lead_source"): "source_id",
+    ("lead", "deal_lead_source"): "source_id",
+}
+
+_EMBED = re.compile(r"(\w+)\(([^)]*)\)")
+
+
+class MemoryResponse:
+    def __init__(self, data: list, count: int = None):
+        self.data = data
+        self.count = count
+
+    def json(self) -> str:
+        return json.dumps({"data": self.data, "count": self.count}, default=str)
+
+
+class MemoryQuery:
+    """
+    The subset of the postgrest request builder used by the package: ``select``, ``insert``,
+    ``update``, ``upsert`` and ``delete``, filtered with ``eq`` and ``in_`` and cut with ``limit``.
+    """
+
+    def __init__(self, client: "MemoryClient", table: str):
+        self._client = client
+        self._table = table
+        self._operation = None
+        self._columns = "*"
+        self._payload = None
+        self._on_conflict = "id"
+        self._filters = []
+        self._limit = None
+
+    def select(self, *columns, count: str = None):
+        self._operation = "select"
+        self._columns = ",".join(columns) or "*"
+        return self
+
+    def insert(self, payload, **kwargs):
+        self._operation, self._payload = "insert", payload
+        return self
+
+    def update(self, payload: dict, **kwargs):
+        self._operation, self._payload = "update", payload
+        return self
+
+    def upsert(self, payload, on_conflict: str = "id", **kwargs):
+        self._operation, self._payload, self._on_conflict = "upsert", payload, on_conflict
+        return self
+
+    def delete(self, **kwargs):
+        self._operation = "delete"
+        return self
+
+    def eq(self, column: str, value):
+        self._filters.append(lambda row: row.get(column) == value)
+        return self
+
+    def in_(self, column: str, values):
+        values = set(values)
+        self._filters.append(lambda row: row.get(column) in values)
+        return self
+
+    def limit(self, size: int, **kwargs):
+        self._limit = size
+        return self
+
+    def execute(self) -> MemoryResponse:
+        return self._client.execute(self)
+
+    def _matches(self, row: dict) -> bool:
+        return all(predicate(row) for predicate in self._filters)
+
+
+class MemoryClient:
+    """
+    In-memory Supabase client. Tables are lists of row dicts in :attr:`tables`; inserted rows
+    without an ``id`` get the next integer of their table. Selects support embedded resources
+    such as ``"*, phone_book(*)"``, resolved through ``<table>_id`` or :data:`RELATIONS`.
+    """
+
+    def __init__(self, tables: dict = None, relations: dict = None, functions: dict = None):
+        """
+        :param tables: Optional initial rows by table name
+        :param relations: Extra ``(table, embedded table)`` to foreign key column entries
+        :param functions: Extra database functions for :meth:`rpc`, by name, in addition to
+            :data:`FUNCTIONS`; each is called as ``function(tables, params)`` and returns the result
+        """
+        self.tables = {name: [dict(row) for row in rows] for name, rows in (tables or {}).items()}
+        self.relations = {**RELATIONS, **(relations or {})}
+        self.functions = {**FUNCTIONS, **(functions or {})}
+        self.calls = []  # (table, operation)
+        self._ids = {}
+        self._lock = threading.RLock()
+
+    def table(self, name: str) -> MemoryQuery:
+        return MemoryQuery(self, name)
+
+    def rpc(self, function: str, params: dict = None) -> "MemoryRpc":
+        return MemoryRpc(self, function, params or {})
+
+    def call(self, function: str, params: dict) -> MemoryResponse:
+        with self._lock:
+            self.calls.append((function, "rpc"))
+            return MemoryResponse(copy.deepcopy(self.functions[function](self.tables, params)))
+
+    @property
+    def round_trips(self) -> int:
+        return len(self.calls)
+
+    def reset_calls(self):
+        with self._lock:
+            self.calls = []
+
+    def execute(self, query: MemoryQuery) -> MemoryResponse:
+        with self._lock:
+            self.calls.append((query._table, query._operation))
+            rows = self.tables.setdefault(query._table, [])
+            if query._operation == "insert":
+                return MemoryResponse([self._insert(query._table, row) for row in _as_list(query._payload)])
+            if query._operation == "upsert":
+                keys = query._on_conflict.split(",")
+                index = {tuple(row.get(k) for k in keys): row for row in rows}
+                saved = []
+                for payload in _as_list(query._payload):
+                    existing = index.get(tuple(payload.get(k) for k in keys))
+                    if existing is None:
+                        saved.append(self._insert(query._table, payload))
+                    else:
+                        existing.update(copy.deepcopy(payload))
+                        saved.append(copy.deepcopy(existing))
+                return MemoryResponse(saved)
+
+            matched = [row for row in rows if query._matches(row)]
+            if query._operation == "update":
+                for row in matched:
+                    row.update(copy.deepcopy(query._payload))
+                return MemoryResponse(copy.deepcopy(matched))
+            if query._operation == "delete":
+                self.tables[query._table] = [row for row in rows if not query._matches(row)]
+                return MemoryResponse(matched)
+            if query._limit is not None:
+                matched = matched[:query._limit]
+            indexes = {}
+            return MemoryResponse([self._project(query._table, row, query._columns, indexes) for row in matched],
+                                  len(matched))
+
+    def _insert(self, table: str, payload: dict) -> dict:
+        row = copy.deepcopy(payload)
+        if row.get("id") is None:
+            if table not in self._ids:
+                self._ids[table] = itertools.count(
+                    max((r["id"] for r in self.tables[table] if isinstance(r.get("id"), int)), default=0) + 1)
+            row["id"] = next(self._ids[table])
+        self.tables[table].append(row)
+        return copy.deepcopy(row)
+
+    def _project(self, table: str, row: dict, columns: str, indexes: dict) -> dict:
+        result = {}
+        embeds = _EMBED.findall(columns)
+        plain = [column.strip() for column in _EMBED.sub("", columns).split(",") if column.strip()]
+        for column in plain:
+            if column == "*":
+                result.update(copy.deepcopy(row))
+            else:
+                result[column] = copy.deepcopy(row.get(column))
+        for embedded, inner in embeds:
+            foreign_key = self.relations.get((table, embedded), f"{embedded}_id")
+            if embedded not in indexes:
+                indexes[embedded] = {r.get("id"): r for r in self.tables.get(embedded, [])}
+            target = indexes[embedded].get(row.get(foreign_key))
+            result[embedded] = self._project(embedded, target, inner or "*", indexes) if target is not None else None
+        return result
+
+
+class MemoryRpc:
+    def __init__(self, client: MemoryClient, function: str, params: dict):
+        self._client = client
+        self._function = function
+        self._params = params
+
+    def execute(self) -> MemoryResponse:
+        return self._client.call(self._function, self._params)
+
+
+def _register_sync_tenants(tables: dict, params: dict) -> int:
+    leases = tables.setdefault("sync_lease", [])
+    known = {lease["tenant_id"] for lease in leases}
+    added = 0
+    for connection in tables.get("integration_connection", []):
+        if connection.get("connection_key") == "salesforce" and connection["tenant_id"] not in known:
+            known.add(connection["tenant_id"])
+            leases.append({"tenant_id": connection["tenant_id"], "owner": None, "expires_at": None,
+                           "started_at": None, "heartbeat_at": None, "next_sync_at": 0.0, "synced_at": None,
+                           "last_error": None, "change_rate": None, "sync_interval": None, "last_changes": None})
+            added += 1
+    return added
+
+
+def _claim_sync_leases(tables: dict, params: dict) -> list:
+    now, leases = time.time(), tables.setdefault("sync_lease", [])
+    due = sorted((lease for lease in leases if lease["next_sync_at"] <= now), key=lambda lease: lease["next_sync_at"])
+    claimed = [lease for lease in due if lease["owner"] is None or lease["expires_at"] < now][:params["p_limit"]]
+    if len(claimed) < params["p_limit"]:
+        queued = collections.Counter(lease["owner"] for lease in leases
+                                     if lease["owner"] not in (None, params["p_owner"])
+                                     and lease["started_at"] is None and lease["expires_at"] >= now)
+        stealable = [lease for lease in sorted(leases, key=lambda lease: lease["next_sync_at"])
+                     if queued[lease["owner"]] > 1 and lease["started_at"] is None and lease["expires_at"] >= now]
+        claimed += stealable[:params["p_limit"] - len(claimed)]
+    for lease in claimed:
+        lease.update(owner=params["p_owner"], expires_at=now + params["p_ttl_seconds"], started_at=None,
+                     heartbeat_at=now)
+    return claimed
+
+
+def _start_sync_lease(tables: dict, params: dict) -> bool:
+    now = time.time()
+    for lease in tables.get("sync_lease", []):
+        if lease["tenant_id"] == params["p_tenant_id"] and lease["owner"] == params["p_owner"]:
+            lease.update(started_at=now, expires_at=now + params["p_ttl_seconds"], heartbeat_at=now)
+            return True
+    return False
+
+
+def _renew_sync_leases(tables: dict, params: dict) -> list:
+    now, renewed = time.time(), []
+    tenant_ids = set(params["p_tenant_ids"])
+    for lease in tables.get("sync_lease", []):
+        if lease["owner"] == params["p_owner"] and lease["tenant_id"] in tenant_ids:
+            lease.update(expires_at=now + params["p_ttl_seconds"], heartbeat_at=now)
+            renewed.append(lease["tenant_id"])
+    return renewed
+
+
+def _release_sync_lease(tables: dict, params: dict) -> bool:
+    now = time.time()
+    for lease in tables.get("sync_lease", []):
+        if lease["tenant_id"] == params["p_tenant_id"] and lease["owner"] == params["p_owner"]:
+            started_at = lease["started_at"]
+            lease.update(owner=None, expires_at=None, started_at=None, heartbeat_at=None)
+            if params["p_synced"]:
+                lease.update(next_sync_at=now + params["p_next_sync_seconds"], last_error=params["p_error"],
+                             sync_interval=params["p_next_sync_seconds"])
+                if params["p_error"] is None:
+                    lease.update(synced_at=now if started_at is None else started_at,
+                                 last_changes=params.get("p_changes"))
+                if params.get("p_change_rate") is not None:
+                    lease["change_rate"] = params["p_change_rate"]
+            return True
+    return False
+
+
+def _reconcile_leaves(tables: dict, params: dict) -> list:
+    from sync import reconcile
+
+    indexes = {}
+    for spec in params["p_columns"]:
+        if spec["via"] and spec["via"] not in indexes:
+            indexes[spec["via"]] = {row.get("id"): row for row in tables.get(spec["table"], [])}
+    entities = {row.get("id"): row for row in tables.get(params["p_table"], [])}
+    users = {role["user_id"] for role in tables.get("user_role", []) if role["tenant_id"] == params["p_tenant_id"]}
+    leaves = []
+    for link in tables.get("entity_integration", []):
+        key = reconcile.bucket_key(link["salesforce_id"])
+        row = entities.get(link["entity_based_id"])
+        if link.get("entity_type_id") != params["p_entity_type"] or row is None \
+                or row.get(params["p_owner_column"]) not in users or not key.startswith(params["p_prefix"]):
+            continue
+        values = [(indexes[spec["via"]].get(row.get(spec["via"])) or {} if spec["via"] else row).get(spec["column"])
+                  for spec in params["p_columns"]]
+        leaves.append({"key": key, "salesforce_id": link["salesforce_id"],
+                       "entity_based_id": str(link["entity_based_id"]),
+                       "hash": reconcile.leaf_hash(link["salesforce_id"], values)})
+    return leaves
+
+
+def _reconcile_buckets(tables: dict, params: dict) -> list:
+    from sync import reconcile
+
+    buckets = {}
+    for leaf in _reconcile_leaves(tables, params):
+        buckets.setdefault(leaf["key"][:len(params["p_prefix"]) + 1], []).append(leaf["hash"])
+    return [{"bucket": bucket, "records": len(hashes), "hash": reconcile.bucket_hash(hashes)}
+            for bucket, hashes in buckets.items()]
+
+
+def _update_entity_integration(tables: dict, params: dict) -> int:
+    links = {link.get("id"): link for link in tables.get("entity_integration", [])}
+    updated = 0
+    for row in params["p_rows"]:
+        link = links.get(row["id"])
+        if link is not None:
+            link.update({column: value for column, value in row.items() if column != "id"})
+            updated += 1
+    return updated
+
+
+def _update_rows(tables: dict, params: dict) -> int:
+    rows = {row.get("id"): row for row in tables.get(params["p_table"], [])}
+    updated = 0
+    for values in params["p_rows"]:
+        row = rows.get(values["id"])
+        if row is not None:
+            row.update({column: value for column, value in values.items() if column != "id"})
+            updated += 1
+    return updated
+
+
+# The database functions of sql/, over the in-memory tables; timestamps are epoch seconds
+FUNCTIONS = {
+    "register_sync_tenants": _register_sync_tenants,
+    "claim_sync_leases": _claim_sync_leases,
+    "start_sync_lease": _start_sync_lease,
+    "renew_sync_leases": _renew_sync_leases,
+    "release_sync_lease": _release_sync_lease,
+    "reconcile_buckets": _reconcile_buckets,
+    "reconcile_leaves": _reconcile_leaves,
+    "update_entity_integration": _update_entity_integration,
+    "update_rows": _update_rows,
+}
+
+
+def _as_list(payload) -> list:
+    return payload if isinstance(payload, list) else [payload]
+
+
+# Records of one tenant and owner, shared by sync.budget and the tests
+TENANT_ID = 7
+OWNER_ID = "00000000-0000-0000-0000-000000000001"
+CREATED = "2024-05-29T09:24:16.023915+00:00"
+UPDATED = "2024-06-03T14:02:51.000000+00:00"
+
+
+def seed(client: MemoryClient, n: int):
+    """Reference data, and ``n`` rows of each entity owned by :data:`OWNER_ID`, ready to export."""
+    tables = client.tables
+    tables["entity_group"] = [{"id": 1, "tenant_id": TENANT_ID}]
+    tables["entity_stage"] = [{"id": 1, "group_id": 1, "name": "New"}]
+    tables["entity_priority"] = [{"id": 1, "group_id": 1}]
+    tables["phone_book"] = [{
+        "id": i, "first_name": f"First {i}", "last_name": f"Last {i}", "email": f"p{i}@example.com",
+        "phone": "555-0100", "website": "example.com", "street": "1 Main St", "city": "Springfield",
+        "state": "IL", "country": "US", "created_at": CREATED, "description": "", "do_not_call": False,
+        "department": None, "company": "Example", "title": "Buyer",
+    } for i in range(1, 3 * n + 1)]
+    tables["deal_lead_source"] = [{"id": i, "name": "Web", "created_at": CREATED} for i in range(1, 2 * n + 1)]
+    tables["account"] = [{"id": f"acc-{i}", "phone_book_id": i, "owner_id": OWNER_ID, "domain": "example.com",
+                          "industry": "Technology", "no_of_employees": 10} for i in range(1, n + 1)]
+    tables["contact"] = [{"id": f"con-{i}", "phone_book_id": n + i, "created_by": OWNER_ID,
+                          "account_id": f"acc-{i}"} for i in range(1, n + 1)]
+    tables["deal"] = [{"id": f"deal-{i}", "owner_id": OWNER_ID, "name": f"Deal {i}", "score": 50,
+                       "close_date": "2024-06-01T00:00:00", "source_id": i, "entity_stage_id": 1}
+                      for i in range(1, n + 1)]
+    tables["lead"] = [{"id": f"lead-{i}", "owner_id": OWNER_ID, "phone_book_id": 2 * n + i, "source_id": n + i}
+                      for i in range(1, n + 1)]
+    # Contacts are exported with the Salesforce IDs of their accounts
+    tables["entity_integration"] = [{"id": i, "entity_based_id": f"acc-{i}", "salesforce_id": f"001{i:012d}",
+                                     "entity_type_id": 2} for i in range(1, n + 1)]
+
+
+def salesforce_records(n: int, entity: str) -> list:
+    """``n`` records as returned by the entity's import action; contacts point at the seeded accounts."""
+    address = {"street": "1 Main St", "city": "Springfield", "state": "IL", "country": "US"}
+    records = []
+    for i in range(1, n + 1):
+        if entity == "account":
+            fields = {"Phone": "555-0100", "Website": "example.com", "BillingStreet": "1 Main St",
+                      "BillingCity": "Springfield", "BillingState": "IL", "BillingCountry": "US",
+                      "Description": "", "Industry": "Technology", "NumberOfEmployees": 10}
+            id_ = f"001{i:012d}"
+        elif entity == "contact":
+            fields = {"primaryEmail": f"c{i}@example.com", "primaryPhone": "555-0100", "primaryAddress": address,
+                      "firstName": "First", "lastName": f"Last {i}", "jobTitle": "Buyer",
+                      "companyId": f"001{i:012d}"}
+            id_ = f"003{i:012d}"
+        elif entity == "deal":
+            fields = {"amount": 1000, "closeTime": "2024-06-01", "probability": 50, "source": "Web"}
+            id_ = f"006{i:012d}"
+        else:
+            fields = {"createdTime": CREATED, "updatedTime": CREATED, "primaryEmail": f"l{i}@example.com",
+                      "primaryPhone": "555-0100", "primaryAddress": address, "firstName": "First",
+                      "lastName": f"Last {i}", "jobTitle": "Buyer", "companyName": "Example", "source": "Web"}
+            id_ = f"00Q{i:012d}"
+        records.append({"id": id_, "name": f"{entity} {i}", "createdTime": CREATED, "updatedTime": CREATED,
+                        "fields": fields})
+    return records
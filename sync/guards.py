@@ -0,0 +1,76 @@
+"""
+Enforcement around the Supabase clients and the integration.app sessions.
+
+:mod:`sync.metrics` only counts and times round trips; this layer, wrapped around it, decides
+whether a round trip may be made at all:
+
+- :class:`GuardedClient` is put around every Supabase client by ``clients.registry``. Queries of
+  a sync whose tenant lease was lost raise ``sync.lease.LeaseLostError`` instead of being sent.
+- :class:`GuardedSession` is the session of the entity classes. Its requests raise
+  ``LeaseLostError`` the same way, and ``sync.breaker.CircuitOpenError`` while the circuit breaker
+  of their connection or action is open; each answer is recorded with the breakers.
+"""
+from sync import lease, metrics
+from sync.breaker import breakers, connection_of
+
+
+class GuardedQuery:
+    """Wraps a request builder and checks the tenant lease before ``execute()``."""
+
+    def __init__(self, builder):
+        self._builder = builder
+
+    def execute(self):
+        lease.check()
+        return self._builder.execute()
+
+    def __getattr__(self, name):
+        attr = getattr(self._builder, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            return GuardedQuery(result) if hasattr(result, "execute") else result
+
+        return call
+
+
+class GuardedClient:
+    """Proxy around a Supabase ``Client`` whose ``table()`` queries and ``rpc()`` calls check the tenant lease."""
+
+    def __init__(self, client):
+        self._client = client
+
+    def table(self, name: str) -> GuardedQuery:
+        return GuardedQuery(self._client.table(name))
+
+    def rpc(self, function: str, params: dict = None) -> GuardedQuery:
+        return GuardedQuery(self._client.rpc(function, params))
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+class GuardedSession(metrics.InstrumentedSession):
+    """``metrics.InstrumentedSession`` whose requests check the tenant lease and the circuit breakers."""
+
+    def request(self, method, url, *args, **kwargs):
+        lease.check()
+        target = metrics.target_of(url)
+        connection = connection_of(self)
+        breakers.check(connection, target)
+        try:
+            response = super().request(method, url, *args, **kwargs)
+        except Exception as exc:
+            breakers.record(connection, target, error=repr(exc))
+            raise
+        breakers.record(connection, target, response.status_code)
+        return response
+
+
+def unwrap(client):
+    """The client inside the :class:`GuardedClient` and ``metrics.InstrumentedClient`` layers, if any."""
+    while isinstance(client, (GuardedClient, metrics.InstrumentedClient)):
+        client = client._client
+    return client
@@ -0,0 +1,907 @@
+"""
+Bulk helpers for the entity_integration table, which links Supabase rows to Salesforce IDs.
+
+Exports look up the links of a whole page of rows with :func:`fetch_links` instead of one
+query per row, and compare :func:`payload_hash` with the hash stored at the last export to skip
+unchanged rows. The ``export_hash`` column is added by ``sql/001_entity_integration_export_hash.sql``.
+
+Both directions skip the changes the other one made (``sql/005_entity_integration_sync_origin.sql``).
+Each link records which side it was last synced from and when, and the ``updatedTime`` last
+imported. An import skips records not updated since, and records updated by the last export,
+up to :data:`ECHO_WINDOW` seconds after it. An export takes rows not changed since their import
+as exported, see :func:`settle_imported`.
+
+Inside :func:`use_id_map`, :func:`fetch_imported` answers from an :class:`IdMap` of the links it
+has already read or written, and only looks up the Salesforce IDs it doesn't know, so a process
+syncing a tenant again (see :mod:`sync.daemon`) doesn't read its links again. A link another
+worker, CDC or reconcile deleted stays in the map until it is used: the import's references
+(:func:`fetch_imported_rows`) and :func:`delete_removed` check the rows of the links they get, and
+look those whose row is gone up again in the same run.
+
+With a batch size above 1, :func:`export_batched` sends the rows of a page through the entity's
+batch actions instead of one create or update request per row. The batch actions take
+``{"records": [...]}`` and return Salesforce's sObject Collections result list as ``output``, one
+``{"id", "success", "errors"}`` entry per record in request order, so a failed record doesn't
+fail the rest of its batch.
+"""
+import collections
+import contextlib
+import contextvars
+import hashlib
+import json
+import threading
+import time
+from datetime import datetime, timezone
+
+from sync import sb, cadence, logs, metrics, tracing, workqueue
+
+logger = logs.get_logger(__name__)
+
+# Keeps in_() filters well below PostgREST's URL length limit
+IN_CHUNK_SIZE = 200
+
+# Rows per bulk insert or upsert request
+WRITE_CHUNK_SIZE = 500
+
+# How long a tenant's group, stage and priority are reused by the map_o functions
+REFERENCE_TTL = 300.0
+
+# Seconds of clock difference allowed between Salesforce's updatedTime and our export time when
+# telling an export's echo from a change made in Salesforce
+ECHO_WINDOW = 5.0
+
+# Largest groups of rows with the same changes written with one update statement each, see update_changed
+MAX_SHARED_UPDATES = 8
+
+# sObject Collections accept at most 200 records per request
+MAX_BATCH_SIZE = 200
+
+DELETE_URL = "https://api.integration.app/connections/salesforce/actions/delete-records/run"
+
+# Update errors meaning the Salesforce record is gone, so the row is created again
+_MISSING_CODES = {"ENTITY_IS_DELETED", "NOT_FOUND"}
+
+EXPORTS = metrics.registry.counter("sync_export_rows_total", "Exported rows by action", ("entity", "action"))
+IMPORTS = metrics.registry.counter("sync_import_rows_total", "Imported records by action", ("entity", "action"))
+ECHOES = metrics.registry.counter("sync_echo_skipped_total", "Records skipped as changes made by the sync itself",
+                                 ("entity", "direction"))
+COLUMNS = metrics.registry.counter("sync_import_columns_total", "Changed columns written to existing rows by import",
+                                  ("table",))
+BATCHES = metrics.registry.counter("sync_export_batches_total", "Batch action calls by action and outcome",
+                                   ("entity", "action", "outcome"))
+
+
+def chunks(values: list, size: int = IN_CHUNK_SIZE):
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def payload_hash(payload: dict) -> str:
+    """Stable hash of an export payload, independent of key order."""
+    encoded = json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+class IdMap:
+    """Salesforce ID to ``entity_based_id`` links, per entity type, the least recently used dropped first."""
+
+    def __init__(self, max_links: int = 100_000):
+        self.max_links = max_links
+        self._links = collections.OrderedDict()  # (entity type, salesforce id) -> entity_based_id
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._links)
+
+    def get(self, entity_type, salesforce_ids) -> dict:
+        found = {}
+        with self._lock:
+            for salesforce_id in salesforce_ids:
+                key = (entity_type.value, salesforce_id)
+                if key in self._links:
+                    self._links.move_to_end(key)
+                    found[salesforce_id] = self._links[key]
+        return found
+
+    def add(self, entity_type, links: dict):
+        with self._lock:
+            for salesforce_id, record_id in links.items():
+                self._links[(entity_type.value, salesforce_id)] = record_id
+                self._links.move_to_end((entity_type.value, salesforce_id))
+            while len(self._links) > self.max_links:
+                self._links.popitem(last=False)
+
+    def discard(self, entity_type, salesforce_ids):
+        with self._lock:
+            for salesforce_id in salesforce_ids:
+                self._links.pop((entity_type.value, salesforce_id), None)
+
+
+_id_map = contextvars.ContextVar("sync_id_map", default=None)
+
+
+@contextlib.contextmanager
+def use_id_map(id_map: IdMap):
+    """Read and remember entity_integration links through ``id_map`` inside the block."""
+    token = _id_map.set(id_map)
+    try:
+        yield id_map
+    finally:
+        _id_map.reset(token)
+
+
+def remember_links(entity_type, links: dict):
+    """Add links just written to entity_integration to the :class:`IdMap` in use, if any."""
+    id_map = _id_map.get()
+    if id_map is not None and links:
+        id_map.add(entity_type, links)
+
+
+def forget_links(entity_type, salesforce_ids):
+    """Drop links removed from entity_integration from the :class:`IdMap` in use, if any."""
+    id_map = _id_map.get()
+    if id_map is not None:
+        id_map.discard(entity_type, salesforce_ids)
+
+
+def fetch_links(entity_type, record_ids: list) -> dict:
+    """
+    Fetch the entity_integration rows of the given Supabase rows.
+
+    :param record_ids: The Supabase IDs of the rows
+    :return: A dict mapping each linked ID to its entity_integration ``id``, ``salesforce_id``, ``export_hash``,
+        ``sync_origin`` and ``salesforce_updated_at``
+    """
+    links = {}
+    for chunk in chunks(list(dict.fromkeys(record_ids))):
+        rows = (sb.table("entity_integration")
+                .select("id,entity_based_id,salesforce_id,export_hash,sync_origin,salesforce_updated_at")
+                .eq("entity_type_id", entity_type.value).in_("entity_based_id", chunk).execute().data)
+        for row in rows:
+            links[row["entity_based_id"]] = row
+    return links
+
+
+def fetch_imported(entity_type, salesforce_ids: list) -> dict:
+    """
+    Find which Salesforce records are already linked to a Supabase row.
+
+    :param entity_type: The ``EntityType`` of the records
+    :param salesforce_ids: The Salesforce IDs of the records
+    :return: A dict mapping each linked Salesforce ID to its ``entity_based_id``
+    """
+    salesforce_ids = [id_ for id_ in dict.fromkeys(salesforce_ids) if id_]
+    id_map = _id_map.get()
+    imported = id_map.get(entity_type, salesforce_ids) if id_map is not None else {}
+    fetched = {}
+    for chunk in chunks([id_ for id_ in salesforce_ids if id_ not in imported]):
+        rows = (sb.table("entity_integration").select("entity_based_id,salesforce_id")
+                .eq("entity_type_id", entity_type.value).in_("salesforce_id", chunk).execute().data)
+        for row in rows:
+            fetched[row["salesforce_id"]] = row["entity_based_id"]
+    remember_links(entity_type, fetched)
+    imported.update(fetched)
+    return imported
+
+
+def fetch_imported_rows(entity_type, salesforce_ids: list) -> dict:
+    """
+    Like :func:`fetch_imported`, for links about to be written as references: inside
+    :func:`use_id_map`, the rows of the links the map answered with are checked, and links whose row
+    is gone, deleted with its link by another worker, CDC or reconcile since it was cached, are
+    looked up again. Links still pointing at a missing row are left out.
+    """
+    imported = fetch_imported(entity_type, salesforce_ids)
+    if _id_map.get() is None:
+        return imported
+    stale = _missing_rows(entity_type.name.lower(), imported)
+    if stale:
+        forget_links(entity_type, list(stale))
+        refetched = fetch_imported(entity_type, list(stale))
+        imported = {salesforce_id: record_id for salesforce_id, record_id in imported.items()
+                    if salesforce_id not in stale}
+        imported.update({salesforce_id: record_id for salesforce_id, record_id in refetched.items()
+                         if record_id != stale[salesforce_id]})
+    return imported
+
+
+def _missing_rows(table: str, links: dict) -> dict:
+    """The links, Salesforce ID to Supabase ID, whose row isn't in ``table``."""
+    existing = set()
+    for chunk in chunks(list(set(links.values()))):
+        existing.update(row["id"] for row in sb.table(table).select("id").in_("id", chunk).execute().data)
+    return {salesforce_id: record_id for salesforce_id, record_id in links.items() if record_id not in existing}
+
+
+def fetch_sync_state(entity_type, salesforce_ids: list) -> dict:
+    """
+    Like :func:`fetch_imported`, with what each link last synced.
+
+    :return: A dict mapping each linked Salesforce ID to its entity_integration ``id``, ``entity_based_id``,
+        ``sync_origin``, ``salesforce_updated_at`` and ``synced_at``
+    """
+    state = {}
+    for chunk in chunks([id_ for id_ in dict.fromkeys(salesforce_ids) if id_]):
+        rows = (sb.table("entity_integration")
+                .select("id,entity_based_id,salesforce_id,sync_origin,salesforce_updated_at,synced_at")
+                .eq("entity_type_id", entity_type.value).in_("salesforce_id", chunk).execute().data)
+        for row in rows:
+            state[row["salesforce_id"]] = row
+    remember_links(entity_type, {salesforce_id: row["entity_based_id"] for salesforce_id, row in state.items()})
+    return state
+
+
+def now() -> str:
+    """The current time, ISO 8601 in UTC, as stored in ``synced_at``."""
+    return datetime.now(timezone.utc).isoformat()
+
+
+def exported() -> dict:
+    """The entity_integration columns marking a record as just exported."""
+    return {"sync_origin": "supabase", "synced_at": now()}
+
+
+def is_echo(record: dict, link: dict) -> bool:
+    """
+    Whether a Salesforce record's change was made by the sync: it wasn't updated since it was last
+    imported, or was last updated by an export.
+
+    :param link: The record's entity_integration row, from :func:`fetch_sync_state`
+    """
+    updated = cadence.updated_time(record)
+    if updated is None:
+        return False
+    imported_at = _timestamp(link.get("salesforce_updated_at"))
+    if imported_at is not None and updated <= imported_at:
+        return True
+    synced_at = _timestamp(link.get("synced_at"))
+    return link.get("sync_origin") == "supabase" and synced_at is not None and updated <= synced_at + ECHO_WINDOW
+
+
+def settle_imported(entity_type, rows: list, links: dict, mapper) -> int:
+    """
+    Take the rows not changed since they were imported as exported, so an import isn't sent back to
+    Salesforce: their payload hash is stored as their ``export_hash``, with :func:`update_links`, and
+    updated in ``links``, so the export skips them as unchanged.
+
+    A row counts as unchanged when its link was last synced from Salesforce and its ``last_updated_at``
+    is still the imported record's ``updatedTime``; later edits in Supabase are expected to move it.
+
+    :param rows: Rows as selected with the entity's ``export_columns``
+    :param links: The rows' entity_integration rows, from :func:`fetch_links`
+    :param mapper: Maps a row to its payload, like the entity's ``map_i``
+    :return: The number of rows settled
+    """
+    settled = []
+    for row in rows:
+        link = links.get(row["id"])
+        if not link or link.get("sync_origin") != "salesforce":
+            continue
+        imported_at = _timestamp(link.get("salesforce_updated_at"))
+        updated = _timestamp(row.get("last_updated_at"))
+        if imported_at is None or updated is None or updated > imported_at:
+            continue
+        export_hash = payload_hash(mapper(row))
+        if link.get("export_hash") != export_hash:
+            link["export_hash"] = export_hash
+            settled.append({"id": link["id"], "export_hash": export_hash})
+    update_links(settled)
+    if settled:
+        ECHOES.inc(len(settled), entity=entity_type.name.lower(), direction="export")
+    return len(settled)
+
+
+def _timestamp(value):
+    try:
+        return cadence.timestamp(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def insert_rows(table: str, rows: list, size: int = WRITE_CHUNK_SIZE) -> list:
+    """Insert rows in chunks; return the inserted rows in order."""
+    inserted = []
+    for chunk in chunks(rows, size):
+        inserted.extend(sb.table(table).insert(chunk).execute().data)
+    if len(inserted) != len(rows):
+        raise RuntimeError(f"Inserted {len(inserted)} of {len(rows)} rows into {table}")
+    return inserted
+
+
+def upsert_rows(table: str, rows: list, size: int = WRITE_CHUNK_SIZE):
+    """Write rows that carry their ``id`` back in chunks, one request per chunk."""
+    for chunk in chunks(rows, size):
+        sb.table(table).upsert(chunk).execute()
+
+
+def update_links(rows: list, size: int = WRITE_CHUNK_SIZE):
+    """
+    Update entity_integration rows by their ``id``, each with its own columns, one call of
+    ``update_entity_integration`` (``sql/008_update_entity_integration.sql``) per chunk.
+    """
+    for chunk in chunks(rows, size):
+        sb.rpc("update_entity_integration", {"p_rows": chunk}).execute()
+
+
+def column_diff(stored: dict, values: dict) -> dict:
+    """The ``values`` that differ from a stored row; timestamps are compared as instants."""
+    return {column: value for column, value in values.items()
+            if column not in stored or not _same(stored[column], value)}
+
+
+def _same(stored, value) -> bool:
+    if stored == value:
+        return True
+    if isinstance(stored, str) and isinstance(value, str):
+        # Postgres returns timestamps in its own format, e.g. "+00:00" where Salesforce sends "Z"
+        try:
+            return cadence.timestamp(stored) == cadence.timestamp(value)
+        except ValueError:
+            return False
+    return False
+
+
+def update_changed(table: str, rows: list, stored: dict = None) -> int:
+    """
+    Write only the changed columns of existing rows.
+
+    Each row's values are compared with its stored row. Rows with the same changes share one
+    ``update ... in (ids)`` statement, for the :data:`MAX_SHARED_UPDATES` largest such groups. The
+    others are updated by ID, each with its own columns, with one call of ``update_rows``
+    (``sql/009_update_rows.sql``) per :data:`WRITE_CHUNK_SIZE` rows. Partial rows are never upserted:
+    an upsert's insert path checks the columns left out against the table's NOT NULL constraints.
+
+    :param rows: ``(id, values)`` pairs
+    :param stored: Row ID to the stored row, with at least the columns of ``values``; fetched in bulk when None
+    :return: The number of rows with a changed column
+    """
+    if stored is None:
+        columns = sorted({column for _, values in rows for column in values})
+        stored = {}
+        for chunk in chunks(list({id_ for id_, _ in rows})):
+            for row in sb.table(table).select(",".join(["id", *columns])).in_("id", chunk).execute().data:
+                stored[row["id"]] = row
+    diffs = {id_: diff for id_, diff in ((id_, column_diff(stored.get(id_, {}), values)) for id_, values in rows)
+             if diff}
+
+    groups = {}
+    for id_, diff in diffs.items():
+        key = tuple(sorted((column, json.dumps(value, sort_keys=True, default=str)) for column, value in diff.items()))
+        groups.setdefault(key, []).append(id_)
+    shared = sorted((ids for ids in groups.values() if len(ids) > 1), key=len, reverse=True)[:MAX_SHARED_UPDATES]
+    for ids in shared:
+        for chunk in chunks(ids):
+            sb.table(table).update(diffs[ids[0]]).in_("id", chunk).execute()
+    shared_ids = {id_ for ids in shared for id_ in ids}
+    rest = [{"id": id_, **diff} for id_, diff in diffs.items() if id_ not in shared_ids]
+    for chunk in chunks(rest, WRITE_CHUNK_SIZE):
+        sb.rpc("update_rows", {"p_table": table, "p_rows": chunk}).execute()
+    COLUMNS.inc(sum(len(diff) for diff in diffs.values()), table=table)
+    return len(diffs)
+
+
+def track_records(entity_type, tracked: list):
+    """
+    Link exported rows to their Salesforce IDs, with one insert for new links and one upsert for
+    the existing ones.
+
+    :param tracked: Dicts with ``entity_based_id``, ``salesforce_id``, ``export_hash`` and ``link``,
+        the row's entity_integration row from :func:`fetch_links` or None
+    """
+    new, linked = [], []
+    for item in tracked:
+        row = {"entity_based_id": item["entity_based_id"], "salesforce_id": item["salesforce_id"],
+               "export_hash": item["export_hash"], "entity_type_id": entity_type.value, **exported()}
+        if item["link"]:
+            linked.append({"id": item["link"]["id"], **row})
+        else:
+            new.append(row)
+    if new:
+        insert_rows("entity_integration", new)
+        remember_links(entity_type, {row["salesforce_id"]: row["entity_based_id"] for row in new})
+    if linked:
+        upsert_rows("entity_integration", linked)
+
+
+_references = {}  # tenant_id -> (references, fetched_at)
+_references_lock = threading.Lock()
+
+
+def access_token(tenant_id) -> str:
+    """The integration.app token of a tenant's Salesforce connection."""
+    rows = (sb.table("integration_connection").select("connection_details")
+            .eq("connection_key", "salesforce").eq("tenant_id", tenant_id).limit(1).execute().data)
+    if not rows:
+        raise LookupError(f"No salesforce connection for tenant {tenant_id}")
+    return rows[0]["connection_details"]["access_token"]
+
+
+def tenant_references(tenant_id) -> dict:
+    """
+    The group of a tenant and the first stage and priority of that group, which imported records
+    are put in. Cached for :data:`REFERENCE_TTL` seconds, so mapping a page of records doesn't
+    look them up once per record.
+
+    :return: A dict with ``group_id``, ``stage_id`` and ``priority_id``, None where missing
+    """
+    with _references_lock:
+        cached = _references.get(tenant_id)
+    if cached and time.monotonic() - cached[1] < REFERENCE_TTL:
+        return cached[0]
+
+    group_response = sb.table('entity_group').select('id').eq('tenant_id', tenant_id).limit(1).execute()
+    group_id = group_response.data[0]['id'] if group_response.data else None
+    stage_response = sb.table('entity_stage').select('id').eq('group_id', group_id).limit(1).execute()
+    priority_response = sb.table('entity_priority').select('id').eq('group_id', group_id).limit(1).execute()
+    references = {
+        "group_id": group_id,
+        "stage_id": stage_response.data[0]['id'] if stage_response.data else None,
+        "priority_id": priority_response.data[0]['id'] if priority_response.data else None,
+    }
+    with _references_lock:
+        _references[tenant_id] = (references, time.monotonic())
+    return references
+
+
+def clear_references(tenant_id=None):
+    """Forget the cached references of one tenant, or of all of them."""
+    with _references_lock:
+        if tenant_id is None:
+            _references.clear()
+        else:
+            _references.pop(tenant_id, None)
+
+
+def import_records(importer, entity: str, entity_type, records: list, tenant_id, owner_id) -> dict:
+    """
+    Write a page of Salesforce records to Supabase. Records already linked in entity_integration
+    update their rows, the others are inserted with their ``import_parents`` rows and their links.
+    Linked records whose change was made by the sync itself are skipped, see :func:`is_echo`.
+
+    The round trips depend on the number of chunks, not of records: one lookup of the links and one
+    of the linked rows per :data:`IN_CHUNK_SIZE` records, and one insert or update per table per
+    :data:`WRITE_CHUNK_SIZE` records.
+
+    :param importer: An entity instance such as ``Accounts``
+    :param entity: The entity table
+    :param entity_type: The ``EntityType`` of the records
+    :param records: Records as returned by the entity's ``import_url`` action; with the importer's ``since``
+        set, only those updated after it are written
+    Inside ``workqueue.use``, the records are imported in batches through the work queue.
+
+    :return: A dict with the number of records ``inserted``, ``updated`` and ``skipped``
+    """
+    records = list({record["id"]: record for record in records}.values())
+    results = workqueue.run_batches(
+        lambda batch: _import_batch(importer, entity, entity_type, batch, tenant_id, owner_id), records)
+    return {key: sum(result[key] for result in results) for key in ("inserted", "updated", "skipped")}
+
+
+def _import_batch(importer, entity: str, entity_type, records: list, tenant_id, owner_id) -> dict:
+    entity_logger = logs.get_logger(type(importer).__module__)
+    if importer.since:
+        since = cadence.timestamp(importer.since)
+        # Records without a valid updatedTime are kept
+        records = [record for record in records if (cadence.updated_time(record) or since + 1) > since]
+    state = fetch_sync_state(entity_type, [record["id"] for record in records])
+    echoes = [record for record in records if record["id"] in state and is_echo(record, state[record["id"]])]
+    if echoes:
+        # Remember the versions echoing an export, so they're skipped as unchanged from now on
+        versions = []
+        for record in echoes:
+            link = state[record["id"]]
+            imported_at = _timestamp(link.get("salesforce_updated_at"))
+            if imported_at is None or cadence.updated_time(record) > imported_at:
+                versions.append({"id": link["id"], "salesforce_updated_at": updated_at(record)})
+        update_links(versions)
+        ECHOES.inc(len(echoes), entity=entity, direction="import")
+        echoed = {record["id"] for record in echoes}
+        records = [record for record in records if record["id"] not in echoed]
+    # Echoes aren't changes, so they don't speed up the tenant's cadence
+    cadence.record_changes(records)
+    imported = {record["id"]: state[record["id"]]["entity_based_id"] for record in records if record["id"] in state}
+    keep_columns = [column for _, column in importer.import_parents.values()] + list(importer.import_references)
+    payloads = {record["id"]: importer.map_o(record, tenant_id, owner_id) for record in records}
+    compared = sorted({column for salesforce_id in imported for column in payloads[salesforce_id][entity]}
+                      - set(keep_columns))
+    existing = {}
+    for chunk in chunks(list(set(imported.values()))):
+        for row in (sb.table(entity).select(",".join(["id", *keep_columns, *compared])).in_("id", chunk)
+                    .execute().data):
+            existing[row["id"]] = row
+
+    updates, inserts, skipped = [], [], len(echoes)
+    for record in records:
+        payload = payloads[record["id"]]
+        entity_logger.debug(f"{entity.capitalize()} payload", extra={"salesforce_id": record["id"], "payload": payload})
+        if record["id"] not in imported:
+            inserts.append((record, payload))
+        elif imported[record["id"]] in existing:
+            updates.append((record, payload, existing[imported[record["id"]]]))
+        else:
+            entity_logger.warning(f"Skipped {entity} linked to a missing row",
+                                  extra={"salesforce_id": record["id"], "record_id": imported[record["id"]]})
+            forget_links(entity_type, [record["id"]])
+            skipped += 1
+
+    # Updated rows keep their parents and references, as before, and only their changed columns are written
+    for key, (table, column) in importer.import_parents.items():
+        update_changed(table, [(row[column], payload[key]) for _, payload, row in updates if row[column] is not None])
+    update_changed(entity, [(row["id"], {column: value for column, value in payload[entity].items()
+                                         if column not in keep_columns}) for _, payload, row in updates], existing)
+    synced_at = now()
+    update_links([{"id": state[record["id"]]["id"], **imported_columns(updated_at(record), synced_at)}
+                  for record, _, _ in updates])
+    for record, _, row in updates:
+        entity_logger.info(f"Updated {entity} from Salesforce",
+                           extra={"salesforce_id": record["id"], "record_id": row["id"], "sample": True})
+
+    references = {}
+    for column, (field, ref_type) in importer.import_references.items():
+        references[column] = fetch_imported_rows(ref_type, [record["fields"].get(field) for record, _ in inserts])
+    resolvable = []
+    for record, payload in inserts:
+        missing = [field for column, (field, _) in importer.import_references.items()
+                   if record["fields"].get(field) not in references[column]]
+        if missing:
+            entity_logger.warning(f"Skipped {entity} without a synced reference",
+                                  extra={"salesforce_id": record["id"],
+                                         **{field: record["fields"].get(field) for field in missing}})
+            skipped += 1
+        else:
+            resolvable.append((record, payload))
+
+    rows = [dict(payload[entity]) for _, payload in resolvable]
+    for key, (table, column) in importer.import_parents.items():
+        parents = insert_rows(table, [payload[key] for _, payload in resolvable])
+        for row, parent in zip(rows, parents):
+            row[column] = parent["id"]
+    for column, (field, _) in importer.import_references.items():
+        for row, (record, _) in zip(rows, resolvable):
+            row[column] = references[column][record["fields"][field]]
+    inserted = insert_rows(entity, rows)
+    insert_rows("entity_integration", [{"entity_based_id": row["id"], "salesforce_id": record["id"],
+                                        "entity_type_id": entity_type.value,
+                                        **imported_columns(updated_at(record), synced_at)}
+                                       for (record, _), row in zip(resolvable, inserted)])
+    remember_links(entity_type, {record["id"]: row["id"] for (record, _), row in zip(resolvable, inserted)})
+    for (record, _), row in zip(resolvable, inserted):
+        entity_logger.info(f"Inserted {entity} from Salesforce",
+                           extra={"salesforce_id": record["id"], "record_id": row["id"], "sample": True})
+
+    IMPORTS.inc(len(inserted), entity=entity, action="insert")
+    IMPORTS.inc(len(updates), entity=entity, action="update")
+    IMPORTS.inc(skipped, entity=entity, action="skip")
+    return {"inserted": len(inserted), "updated": len(updates), "skipped": skipped}
+
+
+def imported_columns(salesforce_updated_at, synced_at: str = None) -> dict:
+    """
+    The entity_integration columns marking a Salesforce record as just imported, by the import or
+    the backfill.
+
+    :param salesforce_updated_at: The record's ``updatedTime``, see :func:`updated_at`
+    :param synced_at: When it was written to Supabase, now by default
+    """
+    return {"sync_origin": "salesforce", "synced_at": synced_at or now(),
+            "salesforce_updated_at": salesforce_updated_at}
+
+
+def updated_at(record: dict):
+    """The ``updatedTime`` of a record as returned by an ``import_url`` action."""
+    return record.get("updatedTime") or (record.get("fields") or {}).get("updatedTime")
+
+
+def export_journaled(exporter, entity: str, rows: list) -> dict:
+    """
+    ``export_queued``, recording the rows in the exporter's journal first, if it has one.
+
+    Rows the export leaves ``running``, because it raised part way, are released as failed for the
+    journal's ``RetryWorker``.
+
+    :return: A dict mapping each row ID to True if it was exported or unchanged, False otherwise
+    """
+    if not exporter.journal:
+        return export_queued(exporter, rows)
+    record_ids = [row["id"] for row in rows]
+    exporter.journal.start(entity, "export", record_ids)
+    error = "Export ended before the row was settled"
+    try:
+        return export_queued(exporter, rows)
+    except Exception as exc:
+        error = repr(exc)
+        raise
+    finally:
+        exporter.journal.release(entity, "export", record_ids, error)
+
+
+def export_queued(exporter, rows: list) -> dict:
+    """
+    ``exporter.export_rows``, in batches through the work queue inside ``workqueue.use``.
+
+    :return: A dict mapping each row ID to True if it was exported or unchanged, False otherwise
+    """
+    exported_rows = {}
+    for result in workqueue.run_batches(exporter.export_rows, rows):
+        exported_rows.update(result)
+    return exported_rows
+
+
+def list_records(exporter) -> list:
+    """All records of the entity's ``import_url`` action, following its ``cursor`` from page to page."""
+    records, cursor = [], None
+    while True:
+        response = exporter.session.post(exporter.import_url, json={"cursor": cursor} if cursor else {})
+        response.raise_for_status()
+        output = response.json()["output"]
+        records.extend(output.get("records") or [])
+        cursor = output.get("cursor")
+        if not cursor:
+            return records
+
+
+def delete_removed(exporter, entity: str, entity_type) -> dict:
+    """
+    Delete from Salesforce the records whose linked Supabase row was deleted, and their links.
+
+    The Salesforce records are listed with the entity's ``import_url`` action, so only records of the
+    exporter's connection are considered.
+
+    :param exporter: An entity instance such as ``Accounts``
+    :param entity: The entity table
+    :param entity_type: The ``EntityType`` of the records
+    :return: A dict with the number of records ``deleted`` and ``failed``
+    """
+    salesforce_ids = [record["id"] for record in list_records(exporter)]
+    removed = _missing_rows(entity, fetch_imported(entity_type, salesforce_ids))
+    if removed and _id_map.get() is not None:
+        # Links cached by the IdMap may have been replaced since; only delete what entity_integration still has
+        forget_links(entity_type, list(removed))
+        removed = _missing_rows(entity, fetch_imported(entity_type, list(removed)))
+    return _delete_linked(exporter, entity, entity_type, removed)
+
+
+def delete_deleted(exporter, entity: str, entity_type, record_ids: list) -> dict:
+    """
+    Delete from Salesforce the records linked to Supabase rows that are already deleted, and their links.
+
+    :param exporter: An entity instance such as ``Accounts``
+    :param entity: The entity table
+    :param entity_type: The ``EntityType`` of the rows
+    :param record_ids: The Supabase IDs of the deleted rows
+    :return: A dict with the number of records ``deleted`` and ``failed``
+    """
+    links = fetch_links(entity_type, record_ids)
+    return _delete_linked(exporter, entity, entity_type,
+                          {link["salesforce_id"]: record_id for record_id, link in links.items()})
+
+
+def _delete_linked(exporter, entity: str, entity_type, linked: dict) -> dict:
+    """Delete the given Salesforce records, by Salesforce ID to Supabase ID, and their links."""
+    deleted, failed = [], 0
+    for salesforce_id, record_id in linked.items():
+        response = exporter.session.post(DELETE_URL, json={"id": salesforce_id})
+        if response.status_code in (200, 404):
+            deleted.append(salesforce_id)
+            EXPORTS.inc(entity=entity, action="delete")
+            logger.info(f"Deleted {entity} removed from Supabase",
+                        extra={"salesforce_id": salesforce_id, "record_id": record_id, "sample": True})
+            if exporter.journal:
+                exporter.journal.done(entity, "delete", salesforce_id)
+        else:
+            failed += 1
+            logger.error(f"Failed to delete {entity} from Salesforce",
+                         extra={"salesforce_id": salesforce_id, "status_code": response.status_code,
+                                "response": response.text})
+            if exporter.journal:
+                exporter.journal.failed(entity, "delete", salesforce_id,
+                                        f"HTTP {response.status_code}: {response.text}")
+    for chunk in chunks(deleted):
+        sb.table("entity_integration").delete().eq("entity_type_id", entity_type.value).in_("salesforce_id",
+                                                                                             chunk).execute()
+    forget_links(entity_type, deleted)
+    return {"deleted": len(deleted), "failed": failed}
+
+
+def duplicate_id(response):
+    """
+    Return the ID of the existing Salesforce record a create was rejected as a duplicate of, if any.
+
+    :param response: The integration.app response to a create action
+    """
+    if response.status_code != 400:
+        return None
+    try:
+        duplicates = response.json().get("data", {}).get("response", {}).get("data", [])
+        return duplicates[0]["duplicateResult"]["matchResults"][0]["matchRecords"][0]["record"]["Id"]
+    except (ValueError, AttributeError, LookupError, TypeError):
+        return None
+
+
+def batch_results(response, size: int) -> list:
+    """
+    Split the response of a batch action into one result per record.
+
+    :param response: The integration.app response to a batch action
+    :param size: The number of records sent
+    :return: A list of ``size`` dicts with ``success``, ``id``, ``errors`` and, when a record was rejected
+        as a duplicate, ``duplicate_id``
+    """
+    if response.status_code != 200:
+        error = {"statusCode": f"HTTP_{response.status_code}", "message": response.text[:500]}
+        return [{"success": False, "id": None, "errors": [error], "duplicate_id": None} for _ in range(size)]
+    try:
+        output = response.json()["output"]
+        results = output if isinstance(output, list) else output["results"]
+    except (ValueError, LookupError, TypeError):
+        results = None
+    if not isinstance(results, list) or len(results) != size:
+        # Without one result per record there is no telling which records were saved
+        error = {"statusCode": "BAD_BATCH_RESPONSE", "message": response.text[:500]}
+        return [{"success": False, "id": None, "errors": [error], "duplicate_id": None} for _ in range(size)]
+
+    parsed = []
+    for result in results:
+        errors = result.get("errors") or []
+        duplicate = None
+        for error in errors:
+            try:
+                duplicate = error["duplicateResult"]["matchResults"][0]["matchRecords"][0]["record"]["Id"]
+                break
+            except (LookupError, TypeError):
+                continue
+        parsed.append({"success": bool(result.get("success")), "id": result.get("id"), "errors": errors,
+                       "duplicate_id": duplicate})
+    return parsed
+
+
+def _error_codes(result: dict) -> set:
+    return {error.get("statusCode") for error in result["errors"] if isinstance(error, dict)}
+
+
+def _error_text(result: dict) -> str:
+    return "; ".join(f"{error.get('statusCode')}: {error.get('message')}" if isinstance(error, dict) else str(error)
+                     for error in result["errors"]) or "batch action failed"
+
+
+def export_batched(exporter, entity: str, entity_type, rows: list, links: dict, batch_size: int,
+                   mapper=None) -> dict:
+    """
+    Export rows through an entity's batch actions, ``batch_size`` records per request.
+
+    Rows unchanged since their last export are skipped, linked rows go to ``batch_update_url`` and
+    the rest to ``batch_create_url``. Updates of records deleted in Salesforce are retried as
+    creates, and creates rejected as duplicates are retried as updates of the matched record.
+    The records saved by each batch are linked with one :func:`track_records` call, and every
+    record's outcome is passed back to the journal one by one.
+
+    :param exporter: An entity instance such as ``Accounts``
+    :param entity: The entity name used in metrics and the journal
+    :param entity_type: The ``EntityType`` of the rows
+    :param rows: Rows as selected with the entity's ``export_columns``
+    :param links: The rows' entity_integration rows, from :func:`fetch_links`
+    :param batch_size: Records per batch call, at most :data:`MAX_BATCH_SIZE`
+    :param mapper: Maps a row to its payload, ``exporter.map_i`` by default
+    :return: A dict mapping each row ID to True if it was exported or unchanged, False otherwise
+    """
+    batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+    mapper = mapper or exporter.map_i
+    results = {}
+    creates, updates = [], []  # (row, payload, export_hash, salesforce_id)
+    for row in rows:
+        payload = mapper(row)
+        export_hash = payload_hash(payload)
+        link = links.get(row["id"])
+        if link and link.get("export_hash") == export_hash:
+            EXPORTS.inc(entity=entity, action="skip")
+            _done(exporter, entity, row["id"])
+            results[row["id"]] = True
+        elif link:
+            updates.append((row, payload, export_hash, link["salesforce_id"]))
+        else:
+            creates.append((row, payload, export_hash, None))
+
+    def send(action: str, items: list, retry_other: bool) -> list:
+        """Post ``items`` in batches; return the items to retry with the other action, if allowed."""
+        url = exporter.batch_create_url if action == "create" else exporter.batch_update_url
+        retry = []
+        for batch in chunks(items, batch_size):
+            records = [payload if action == "create" else {"id": salesforce_id, **payload}
+                       for _, payload, _, salesforce_id in batch]
+            with tracing.span("batch", action=action, records=len(records)):
+                response = exporter.session.post(url, json={"records": records})
+            outcomes = batch_results(response, len(batch))
+            BATCHES.inc(entity=entity, action=action,
+                        outcome="ok" if all(o["success"] for o in outcomes) else
+                        "partial" if any(o["success"] for o in outcomes) else "failed")
+            saved = []
+            for (row, payload, export_hash, salesforce_id), outcome in zip(batch, outcomes):
+                if outcome["success"]:
+                    saved.append({"entity_based_id": row["id"], "export_hash": export_hash,
+                                  "salesforce_id": salesforce_id if action == "update" else outcome["id"],
+                                  "link": links.get(row["id"])})
+                elif retry_other and action == "update" and _error_codes(outcome) & _MISSING_CODES:
+                    retry.append((row, payload, export_hash, None))
+                elif retry_other and action == "create" and outcome["duplicate_id"]:
+                    retry.append((row, payload, export_hash, outcome["duplicate_id"]))
+                else:
+                    error = _error_text(outcome)
+                    logger.error(f"Failed to export {entity}", extra={"record_id": row["id"], "action": action,
+                                                                      "response": error})
+                    if exporter.journal:
+                        exporter.journal.failed(entity, "export", row["id"], error)
+                    results[row["id"]] = False
+            track_records(entity_type, saved)
+            for item in saved:
+                EXPORTS.inc(entity=entity, action=action)
+                logger.info(f"Exported {entity}", extra={"record_id": item["entity_based_id"], "action": action,
+                                                         "salesforce_id": item["salesforce_id"], "sample": True})
+                _done(exporter, entity, item["entity_based_id"])
+                results[item["entity_based_id"]] = True
+        return retry
+
+    # Each record is retried with the other action at most once
+    recreated = send("update", updates, retry_other=True)
+    duplicates = send("create", creates, retry_other=True)
+    send("create", recreated, retry_other=False)
+    send("update", duplicates, retry_other=False)
+    return results
+
+
+def export_row(exporter, entity: str, row: dict, link: dict = None, mapper=None) -> bool:
+    """
+    Export one row with the entity's single-record actions, as :func:`export_batched` does with its
+    batch actions, and track its Salesforce ID with ``exporter.track_record``.
+
+    :param exporter: An entity instance such as ``Accounts``
+    :param entity: The entity name used in metrics and the journal
+    :param row: A row as selected with the entity's ``export_columns``
+    :param link: The row's entity_integration row from :func:`fetch_links`, if it has one
+    :param mapper: Maps the row to its payload, ``exporter.map_i`` by default
+    :return: True if the row was exported or unchanged, False otherwise
+    """
+    with tracing.span("record", record_id=row["id"]):
+        payload = (mapper or exporter.map_i)(row)
+        export_hash = payload_hash(payload)
+        logger.debug(f"{entity.capitalize()} export payload", extra={"record_id": row["id"], "payload": payload})
+        if link and link.get("export_hash") == export_hash:
+            EXPORTS.inc(entity=entity, action="skip")
+            _done(exporter, entity, row["id"])
+            return True
+
+        action = "update" if link else "create"
+        salesforce_id = link["salesforce_id"] if link else None
+        if link:
+            response = exporter.session.post(exporter.update_url, json={"id": salesforce_id, **payload})
+            if response.status_code == 404:
+                # Deleted in Salesforce since the last export, create it again
+                action, salesforce_id = "create", None
+        if action == "create":
+            response = exporter.session.post(exporter.export_url, json=payload)
+            salesforce_id = duplicate_id(response)
+            if salesforce_id:
+                # Salesforce matched an existing record with its duplicate rules; link and update that one
+                action = "update"
+                response = exporter.session.post(exporter.update_url, json={"id": salesforce_id, **payload})
+
+        if response.status_code == 200:
+            id_ = salesforce_id or response.json()["output"]["id"]
+            tracing.current_span().set_attribute("salesforce_id", id_)
+            exporter.track_record(row["id"], id_, export_hash, linked=link is not None)
+            EXPORTS.inc(entity=entity, action=action)
+            logger.info(f"Exported {entity}", extra={"record_id": row["id"], "salesforce_id": id_, "action": action,
+                                                     "sample": True})
+            _done(exporter, entity, row["id"])
+            return True
+
+        logger.error(f"Failed to export {entity}", extra={"record_id": row["id"], "action": action,
+                                                          "status_code": response.status_code,
+                                                          "response": response.text})
+        if exporter.journal:
+            exporter.journal.failed(entity, "export", row["id"], f"HTTP {response.status_code}: {response.text}")
+        return False
+
+
+def _done(exporter, entity: str, record_id):
+    if exporter.journal:
+        exporter.journal.done(entity, "export", record_id)
@@ -0,0 +1,273 @@
+"""
+Durable journal of pending and failed exports, backed by SQLite.
+
+An export run first records every row it is about to export as ``running``; each row is removed
+from the journal once Salesforce accepted it, or marked ``failed`` with a backoff delay if not.
+Rows a run leaves ``running``, because it raised part way, are marked ``failed`` as it ends (see
+:meth:`ExportJournal.release`). After a crash, :meth:`ExportJournal.recover` turns the rows left
+``running`` by a dead process back into ``pending``, and a :class:`RetryWorker` exports pending
+and failed rows on their own, without re-scanning the tenant. Deletes from Salesforce are
+journaled the same way, keyed by Salesforce ID.
+
+Rows that keep failing are marked ``dead`` after ``max_attempts`` and left for inspection.
+"""
+import os
+import random
+import sqlite3
+import threading
+import time
+
+from sync import logs, metrics
+
+logger = logs.get_logger(__name__)
+
+EXPORT = "export"
+DELETE = "delete"
+
+JOURNAL_JOBS = metrics.registry.counter("sync_journal_jobs_total", "Journaled exports by result",
+                                        ("entity", "op", "result"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS export_job (
+    id INTEGER PRIMARY KEY,
+    tenant_id TEXT NOT NULL,
+    entity TEXT NOT NULL,
+    op TEXT NOT NULL,
+    record_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL DEFAULT 0,
+    claimed_by INTEGER,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    UNIQUE (tenant_id, entity, op, record_id)
+);
+CREATE INDEX IF NOT EXISTS export_job_due ON export_job (status, next_attempt_at);
+"""
+
+
+class ExportJournal:
+    def __init__(self, path: str, max_attempts: int = 8, base_delay: float = 30.0, max_delay: float = 3600.0):
+        """
+        :param path: The SQLite database file
+        :param max_attempts: Failures after which a row is marked ``dead``
+        :param base_delay: Delay in seconds before the first retry; doubled on each further failure
+        :param max_delay: Upper bound on the retry delay, in seconds
+        """
+        self.path = path
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+
+    def for_tenant(self, tenant_id) -> "TenantJournal":
+        return TenantJournal(self, tenant_id)
+
+    def start(self, tenant_id, entity: str, op: str, record_ids: list):
+        """Record rows this process is about to export; they stay ``running`` until done or failed."""
+        now = time.time()
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT INTO export_job (tenant_id, entity, op, record_id, status, claimed_by, created_at, updated_at)"
+                " VALUES (?, ?, ?, ?, 'running', ?, ?, ?)"
+                " ON CONFLICT (tenant_id, entity, op, record_id) DO UPDATE SET"
+                " status = 'running', claimed_by = excluded.claimed_by, updated_at = excluded.updated_at",
+                [(str(tenant_id), entity, op, str(record_id), os.getpid(), now, now) for record_id in record_ids])
+
+    def done(self, tenant_id, entity: str, op: str, record_id):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM export_job WHERE tenant_id = ? AND entity = ? AND op = ? AND record_id = ?",
+                             (str(tenant_id), entity, op, str(record_id)))
+        JOURNAL_JOBS.inc(entity=entity, op=op, result="done")
+
+    def failed(self, tenant_id, entity: str, op: str, record_id, error: str):
+        """Record a failure and schedule the next attempt with exponential backoff and jitter."""
+        with self._lock, self._db:
+            status = self._fail((str(tenant_id), entity, op, str(record_id)), error, time.time())
+        JOURNAL_JOBS.inc(entity=entity, op=op, result=status)
+
+    def release(self, tenant_id, entity: str, op: str, record_ids: list, error: str) -> int:
+        """
+        Mark the rows of ``record_ids`` this process still has ``running`` as failed, scheduling their retry.
+
+        Called once an export run returns or raises, so rows it never settled, such as the rest of a run
+        stopped by a ``CircuitOpenError`` or ``LeaseLostError``, are retried without waiting for a restart
+        to :meth:`recover` them.
+
+        :return: The number of released rows
+        """
+        now = time.time()
+        record_ids = {str(record_id) for record_id in record_ids}
+        with self._lock, self._db:
+            running = [row[0] for row in self._db.execute(
+                "SELECT record_id FROM export_job WHERE tenant_id = ? AND entity = ? AND op = ?"
+                " AND status = 'running' AND claimed_by = ?", (str(tenant_id), entity, op, os.getpid()))
+                if row[0] in record_ids]
+            statuses = [self._fail((str(tenant_id), entity, op, record_id), error, now) for record_id in running]
+        for status in statuses:
+            JOURNAL_JOBS.inc(entity=entity, op=op, result=status)
+        if running:
+            logger.warning("Released unfinished exports", extra={"entity": entity, "count": len(running)})
+        return len(running)
+
+    def _fail(self, key: tuple, error: str, now: float) -> str:
+        row = self._db.execute(
+            "SELECT attempts FROM export_job WHERE tenant_id = ? AND entity = ? AND op = ? AND record_id = ?",
+            key).fetchone()
+        attempts = (row[0] if row else 0) + 1
+        status = "dead" if attempts >= self.max_attempts else "failed"
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1)) * random.uniform(0.8, 1.2)
+        self._db.execute(
+            "INSERT INTO export_job (tenant_id, entity, op, record_id, status, attempts, next_attempt_at,"
+            " last_error, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+            " ON CONFLICT (tenant_id, entity, op, record_id) DO UPDATE SET status = excluded.status,"
+            " attempts = excluded.attempts, next_attempt_at = excluded.next_attempt_at, claimed_by = NULL,"
+            " last_error = excluded.last_error, updated_at = excluded.updated_at",
+            (*key, status, attempts, now + delay, str(error)[:2000], now, now))
+        return status
+
+    def claim(self, limit: int = 500) -> list:
+        """
+        Claim up to ``limit`` pending or failed rows that are due.
+
+        :return: A list of dicts with ``id``, ``tenant_id``, ``entity``, ``op``, ``record_id`` and ``attempts``
+        """
+        now = time.time()
+        with self._lock, self._db:
+            rows = self._db.execute(
+                "SELECT id, tenant_id, entity, op, record_id, attempts FROM export_job"
+                " WHERE status IN ('pending', 'failed') AND next_attempt_at <= ?"
+                " ORDER BY next_attempt_at LIMIT ?", (now, limit)).fetchall()
+            self._db.executemany("UPDATE export_job SET status = 'running', claimed_by = ?, updated_at = ?"
+                                 " WHERE id = ?", [(os.getpid(), now, row[0]) for row in rows])
+        return [dict(zip(("id", "tenant_id", "entity", "op", "record_id", "attempts"), row)) for row in rows]
+
+    def recover(self) -> int:
+        """
+        Return rows left ``running`` by processes that no longer exist to ``pending``.
+
+        :return: The number of recovered rows
+        """
+        with self._lock, self._db:
+            owners = [row[0] for row in self._db.execute(
+                "SELECT DISTINCT claimed_by FROM export_job WHERE status = 'running'")]
+            dead = [owner for owner in owners if owner is None or not _pid_alive(owner)]
+            recovered = 0
+            for owner in dead:
+                recovered += self._db.execute(
+                    "UPDATE export_job SET status = 'pending', claimed_by = NULL, next_attempt_at = 0"
+                    " WHERE status = 'running' AND claimed_by IS ?", (owner,)).rowcount
+        if recovered:
+            logger.info("Recovered interrupted exports", extra={"count": recovered})
+        return recovered
+
+    def counts(self) -> dict:
+        """Number of journaled rows by status."""
+        with self._lock:
+            return dict(self._db.execute("SELECT status, COUNT(*) FROM export_job GROUP BY status").fetchall())
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class TenantJournal:
+    """An :class:`ExportJournal` bound to one tenant, as passed to the entity classes."""
+
+    def __init__(self, journal: ExportJournal, tenant_id):
+        self.journal = journal
+        self.tenant_id = tenant_id
+
+    def start(self, entity: str, op: str, record_ids: list):
+        self.journal.start(self.tenant_id, entity, op, record_ids)
+
+    def done(self, entity: str, op: str, record_id):
+        self.journal.done(self.tenant_id, entity, op, record_id)
+
+    def failed(self, entity: str, op: str, record_id, error: str):
+        self.journal.failed(self.tenant_id, entity, op, record_id, error)
+
+    def release(self, entity: str, op: str, record_ids: list, error: str) -> int:
+        return self.journal.release(self.tenant_id, entity, op, record_ids, error)
+
+
+class RetryWorker:
+    """Background thread exporting due journal rows through an ``ExportService``."""
+
+    def __init__(self, journal: ExportJournal, service, interval: float = 5.0, batch_size: int = 500):
+        self.journal = journal
+        self.service = service
+        self.interval = interval
+        self.batch_size = batch_size
+        self._stop = threading.Event()
+        self._thread = None
+
+    def run_once(self) -> int:
+        """
+        Retry every due row once.
+
+        :return: The number of rows attempted
+        """
+        jobs = self.journal.claim(self.batch_size)
+        groups = {}
+        for job in jobs:
+            groups.setdefault((job["tenant_id"], job["entity"], job["op"]), []).append(job["record_id"])
+        for (tenant_id, entity, op), record_ids in groups.items():
+            try:
+                self._retry(tenant_id, entity, op, record_ids)
+            except Exception as exc:
+                logger.exception("Journal retry failed", extra={"tenant_id": tenant_id, "entity": entity, "op": op})
+                for record_id in record_ids:
+                    self.journal.failed(tenant_id, entity, op, record_id, repr(exc))
+        return len(jobs)
+
+    def _retry(self, tenant_id, entity: str, op: str, record_ids: list):
+        with metrics.scope(tenant=tenant_id):
+            exporter = self.service.exporter(tenant_id, entity)
+            if op == EXPORT:
+                results = exporter.export_by_ids(record_ids)
+            else:
+                results = {record_id: exporter.delete_from_salesforce(record_id) for record_id in record_ids}
+        for record_id in record_ids:
+            if results.get(record_id):
+                self.journal.done(tenant_id, entity, op, record_id)
+            else:
+                self.journal.failed(tenant_id, entity, op, record_id, f"{op} failed on retry")
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sync-journal-retry", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                attempted = self.run_once()
+            except Exception:
+                logger.exception("Journal retry loop failed")
+                attempted = 0
+            if not attempted:
+                self._stop.wait(self.interval)
+
+
+def _pid_alive(pid: int) -> bool:
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
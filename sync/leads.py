@@ -1,15 +1,47 @@
-import requests
-from sync import sb
+from sync import sb, guards, integration, logs, metrics, tracing
+from sync.config import SYNC_EXPORT_BATCH_SIZE
 from sync.enums import EntityType
 
+logger = logs.get_logger(__name__)
+
 
 class Leads:
-    def __init__(self, access_token: str, salesforce_id: str):
-        session = requests.session()
+    export_url = "https://api.integration.app/connections/salesforce/actions/create-lead/run"
+    update_url = "https://api.integration.app/connections/salesforce/actions/update-lead/run"
+    batch_create_url = "https://api.integration.app/connections/salesforce/actions/batch-create-leads/run"
+    batch_update_url = "https://api.integration.app/connections/salesforce/actions/batch-update-leads/run"
+    owner_column = "owner_id"
+    export_columns = "*, phone_book(*), deal_lead_source(*)"
+    import_url = "https://api.integration.app/connections/salesforce/actions/get-leads/run"
+    # map_o keys written to their own table first, and the column linking them
+    import_parents = {"phone_book": ("phone_book", "phone_book_id"), "source": ("deal_lead_source", "source_id")}
+    # Columns resolved from a Salesforce reference field through entity_integration
+    import_references = {}
+    # Columns of map_o compared by sync.reconcile, by map_o key; text, integer or boolean columns only
+    reconcile_columns = {
+        "phone_book": ("first_name", "last_name", "email", "phone", "street", "city", "state", "country", "title",
+                       "company"),
+        "source": ("name",),
+    }
+
+    def __init__(self, access_token: str, salesforce_id: str, journal=None, batch_size: int = None,
+                 since: str = None):
+        """
+        :param journal: Optional ``TenantJournal`` recording pending and failed exports for retry
+        :param batch_size: Records per batch action call on export, defaults to ``SYNC_EXPORT_BATCH_SIZE``;
+            1 exports each record with its own request
+        :param since: Import only records updated after this time, ISO 8601; all records by default
+        """
+        session = guards.GuardedSession()
         session.headers.update({'Authorization': f'Bearer {access_token}'})
         self.session = session
         self.salesforce_id = salesforce_id
+        self.journal = journal
+        self.batch_size = SYNC_EXPORT_BATCH_SIZE if batch_size is None else batch_size
+        self.since = since
 
+    @tracing.traced(entity="lead")
+    @metrics.scope(entity="lead")
     def delete_from_supabase(self, record_id: str):
         """
         Delete a lead from Supabase, the entity_integration table, and Salesforce.
@@ -20,9 +52,8 @@ class Leads:
         integration_response = sb.table('entity_integration').select('salesforce_id').eq('entity_based_id',
                                                                                          record_id).execute()
         if not integration_response.data:
-            print(
-                f"Failed to retrieve salesforce_id for lead {record_id} from entity_integration: "
-                f"{integration_response.json()}")
+            logger.warning("Failed to retrieve salesforce_id from entity_integration",
+                           extra={"record_id": record_id, "response": integration_response.json()})
             return
 
         salesforce_id = integration_response.data[0]['salesforce_id']
@@ -30,49 +61,62 @@ class Leads:
         # Attempt to delete from Salesforce using the retrieved salesforce_id
         self.delete_from_salesforce(salesforce_id)
 
-    def delete_from_salesforce(self, salesforce_id: str):
+    @tracing.traced(entity="lead")
+    @metrics.scope(entity="lead")
+    def delete_from_salesforce(self, salesforce_id: str) -> bool:
         """
         Delete a lead from Salesforce and Supabase.
 
         :param salesforce_id: The Salesforce ID of the lead to delete
+        :return: True if the lead was deleted from Salesforce, False otherwise
         """
         url = "https://api.integration.app/connections/salesforce/actions/delete-leads/run"
         payload = {
             "id": salesforce_id
         }
         salesforce_response = self.session.post(url, json=payload)
-        if salesforce_response.status_code == 200:
-            print(f"Successfully deleted lead {salesforce_id} from Salesforce")
+        # 404: already deleted in Salesforce, which is what was asked for (as in integration._delete_linked)
+        if salesforce_response.status_code in (200, 404):
+            logger.info("Deleted lead from Salesforce", extra={"salesforce_id": salesforce_id,
+                                                               "status_code": salesforce_response.status_code})
+            if self.journal:
+                self.journal.done("lead", "delete", salesforce_id)
         else:
-            print(f"Failed to delete lead {salesforce_id} from Salesforce: {salesforce_response.json()}")
-            return
+            logger.error("Failed to delete lead from Salesforce",
+                         extra={"salesforce_id": salesforce_id, "status_code": salesforce_response.status_code,
+                                "response": salesforce_response.json()})
+            if self.journal:
+                self.journal.failed("lead", "delete", salesforce_id,
+                                    f"HTTP {salesforce_response.status_code}: {salesforce_response.text}")
+            return False
 
         # Retrieve the entity_based_id from the entity_integration table
         integration_response = sb.table('entity_integration').select('entity_based_id').eq('salesforce_id',
                                                                                            salesforce_id).execute()
         if not integration_response.data:
-            print(
-                f"Failed to retrieve entity_based_id for salesforce_id {salesforce_id} from entity_integration: "
-                f"{integration_response.json()}")
-            return
+            logger.warning("Failed to retrieve entity_based_id from entity_integration",
+                           extra={"salesforce_id": salesforce_id, "response": integration_response.json()})
+            return True
 
         entity_based_id = integration_response.data[0]['entity_based_id']
 
         # Delete from Supabase lead table
         supabase_response = sb.table('lead').delete().eq('id', entity_based_id).execute()
         if supabase_response.data:
-            print(f"Successfully deleted lead {entity_based_id} from Supabase")
+            logger.info("Deleted lead from Supabase", extra={"record_id": entity_based_id})
         else:
-            print(f"Failed to delete lead {entity_based_id} from Supabase: {supabase_response.json()}")
+            logger.error("Failed to delete lead from Supabase",
+                         extra={"record_id": entity_based_id, "response": supabase_response.json()})
 
         # Delete from entity_integration table
         integration_response = sb.table('entity_integration').delete().eq('entity_based_id', entity_based_id).execute()
+        integration.forget_links(EntityType.LEAD, [salesforce_id])
         if integration_response.data:
-            print(f"Successfully deleted entity integration for lead {entity_based_id} from Supabase")
+            logger.info("Deleted lead entity integration from Supabase", extra={"record_id": entity_based_id})
         else:
-            print(
-                f"Failed to delete entity integration for lead {entity_based_id} from Supabase: "
-                f"{integration_response.json()}")
+            logger.error("Failed to delete lead entity integration from Supabase",
+                         extra={"record_id": entity_based_id, "response": integration_response.json()})
+        return True
 
     @staticmethod
     def map_i(row: dict) -> dict:
@@ -111,17 +155,9 @@ class Leads:
         """Field mapping from salesforce to supabase"""
         fields = row['fields']
 
-        # Get the group ID using the tenant ID
-        group_response = sb.table('entity_group').select('id').eq('tenant_id', tenant_id).limit(1).execute()
-        group_id = group_response.data[0]['id'] if group_response.data else None
-
-        # Get the stage ID using the group ID
-        stage_response = sb.table('entity_stage').select('id').eq('group_id', group_id).limit(1).execute()
-        stage_id = stage_response.data[0]['id'] if stage_response.data else None
-
-        # Get the priority ID using the group ID
-        priority_response = sb.table('entity_priority').select('id').eq('group_id', group_id).limit(1).execute()
-        priority_id = priority_response.data[0]['id'] if priority_response.data else None
+        # The tenant's group, stage and priority, looked up once per tenant rather than per record
+        references = integration.tenant_references(tenant_id)
+        group_id, stage_id, priority_id = references["group_id"], references["stage_id"], references["priority_id"]
 
         return {
             "lead": {
@@ -177,94 +213,83 @@ class Leads:
         return bool(response.data)
 
     @staticmethod
-    def track_record(id_: str, salesforce_id):
-        is_in_db = sb.table("entity_integration").select("*").eq("entity_based_id", id_).execute().data
-        if not is_in_db:
-            data = {
+    def track_record(id_: str, salesforce_id, export_hash: str = None, linked: bool = None):
+        """
+        Link a supabase lead to its Salesforce ID in the entity_integration table.
+
+        :param export_hash: Hash of the payload just exported, stored to skip the row while unchanged
+        :param linked: Whether the row already has an entity_integration row; looked up when None
+        """
+        data = {"salesforce_id": salesforce_id, **integration.exported()}
+        if export_hash is not None:
+            data["export_hash"] = export_hash
+        if linked is None:
+            linked = bool(sb.table("entity_integration").select("id").eq("entity_based_id", id_).execute().data)
+        if not linked:
+            data.update({
                 "entity_based_id": id_,
-                "salesforce_id": salesforce_id,
                 "entity_type_id": EntityType.LEAD.value
-            }
+            })
             sb.table("entity_integration").insert(data).execute()
         else:
-            sb.table("entity_integration").update({"salesforce_id": salesforce_id}).eq("entity_based_id", id_).execute()
+            (sb.table("entity_integration").update(data).eq("entity_type_id", EntityType.LEAD.value)
+             .eq("entity_based_id", id_).execute())
 
+    @tracing.traced(entity="lead")
+    @metrics.scope(entity="lead")
     def to_salesforce_leads(self, owner_id: str):
         """
         Export supabase leads to Salesforce
         """
-        integration_url = "https://api.integration.app/connections/salesforce/actions/create-lead/run"
-        leads = sb.table("lead").select("*, phone_book(*), deal_lead_source(*)").eq("owner_id", owner_id).execute().data
-        for lead in leads:
-            payload = self.map_i(lead)
-            print(payload)
-            response = self.session.post(integration_url, json=payload)
-            if response.status_code == 200:
-                print(f"Successfully exported lead {payload['fullName']}")
-                id_ = response.json()["output"]["id"]
-                self.track_record(lead["id"], id_)
-            else:
-                print(response.json())
-                print()
+        leads = sb.table("lead").select(self.export_columns).eq(self.owner_column, owner_id).execute().data
+        integration.export_journaled(self, "lead", leads)
 
+    def export_by_id(self, record_id: str) -> bool:
+        """
+        Export a single supabase lead to Salesforce.
+
+        :param record_id: The ID of the lead to export
+        :return: True if the lead was exported, False otherwise
+        """
+        return self.export_by_ids([record_id]).get(record_id, False)
+
+    @tracing.traced(entity="lead")
+    @metrics.scope(entity="lead")
+    def export_by_ids(self, record_ids: list) -> dict:
+        """
+        Export the given supabase leads to Salesforce, selecting them in one query.
+
+        :param record_ids: The IDs of the leads to export
+        :return: A dict mapping each ID to True if it was exported, False otherwise
+        """
+        rows = sb.table("lead").select(self.export_columns).in_("id", list(record_ids)).execute().data
+        results = {record_id: False for record_id in record_ids}
+        missing = set(results) - {row["id"] for row in rows}
+        if missing:
+            logger.warning("Leads to export not found", extra={"record_ids": sorted(missing)})
+        results.update(self.export_rows(rows))
+        return results
+
+    def export_rows(self, leads: list) -> dict:
+        """
+        Export lead rows, as selected with ``export_columns``. Rows already linked in entity_integration
+        are updated, the others are created, and rows unchanged since their last export are skipped.
+        With a ``batch_size`` above 1 they go through the batch actions, see ``integration.export_batched``.
+
+        :return: A dict mapping each row ID to True if it was exported or unchanged, False otherwise
+        """
+        links = integration.fetch_links(EntityType.LEAD, [lead["id"] for lead in leads])
+        integration.settle_imported(EntityType.LEAD, leads, links, self.map_i)
+        if self.batch_size > 1:
+            return integration.export_batched(self, "lead", EntityType.LEAD, leads, links, self.batch_size)
+        return {lead["id"]: integration.export_row(self, "lead", lead, links.get(lead["id"]))
+                for lead in leads}
+
+    @tracing.traced(entity="lead")
+    @metrics.scope(entity="lead")
     def from_salesforce_leads(self, owner_id: str, tenant_id):
         """
         Import salesforce leads to Salesforce
         """
-        integration_url = "https://api.integration.app/connections/salesforce/actions/get-leads/run"
-        leads = self.session.post(integration_url).json()
-        for lead in leads["output"]["records"]:
-            salesforce_id = lead['id']
-
-            # Check if the salesforce_id exists before proceeding
-            if self.check_salesforce_id(salesforce_id):
-                print(f"Salesforce ID {salesforce_id} already exists in the entity_integration table.")
-                # Update the existing record
-                existing_record_response = (sb.table('entity_integration').select('entity_based_id').
-                                            eq('salesforce_id', salesforce_id).execute())
-
-                entity_based_id = existing_record_response.data[0]['entity_based_id']
-
-                # Get the phone_book_id and source_id from the lead table
-                lead_response = sb.table('lead').select('phone_book_id', 'source_id').eq('id',
-                                                                                         entity_based_id).execute()
-                phone_book_id = lead_response.data[0]['phone_book_id']
-                source_id = lead_response.data[0]['source_id']
-
-                payload = self.map_o(lead, tenant_id, owner_id)
-                print("phone payload: ", payload['phone_book'])
-                print("source payload: ", payload['source'])
-                print("lead payload: ", payload['lead'])
-
-                # Update the phone_book and deal_lead_source tables using the retrieved phone_book_id and source_id
-                sb.table("phone_book").update(payload['phone_book']).eq('id', phone_book_id).execute()
-                sb.table("deal_lead_source").update(payload['source']).eq('id', source_id).execute()
-                sb.table("lead").update({**payload['lead'], "phone_book_id": phone_book_id, "source_id": source_id}).eq(
-                    'id', entity_based_id).execute()
-
-                print(
-                    f"Successfully updated Salesforce ID {salesforce_id} in the phone_book, deal_lead_source, and "
-                    f"lead tables.")
-                print()
-            else:
-                payload = self.map_o(lead, tenant_id, owner_id)
-                print("phone payload: ", payload['phone_book'])
-                print("source payload: ", payload['source'])
-                print("lead payload: ", payload['lead'])
-                phone_book_response = sb.table("phone_book").insert(payload['phone_book']).execute()
-                phone_book_id = phone_book_response.data[0]['id']
-                source_response = sb.table("deal_lead_source").insert(payload['source']).execute()
-                source_id = source_response.data[0]['id']
-                lead_response = sb.table("lead").insert(
-                    {**payload['lead'], "phone_book_id": phone_book_id, "source_id": source_id}).execute()
-                id_ = lead_response.data[0]['id']
-                print("id ", id_, "salesforce id: ", lead['id'])
-                # Add/Update row to entity_integration table
-                sb.table("entity_integration").insert(
-                    {"entity_based_id": id_, "salesforce_id": lead["id"],
-                     "entity_type_id": 0}).execute()
-
-                print(
-                    f"Successfully inserted Salesforce ID {salesforce_id} into the phone_book, deal_lead_source, "
-                    f"lead, and entity_integration tables.")
-                print()
+        records = integration.list_records(self)
+        return integration.import_records(self, "lead", EntityType.LEAD, records, tenant_id, owner_id)
@@ -0,0 +1,348 @@
+"""
+Tenant leases, so sync workers on several nodes share the tenants between them.
+
+Workers claim due tenants from the ``sync_lease`` table (``sql/002_sync_lease.sql``) through its
+functions, which decide on the database clock and with row locks, so a tenant is synced by one
+worker at a time:
+
+* a worker claims up to ``prefetch`` due tenants whose lease is free or expired, and marks a
+  lease started just before syncing its tenant; a lease taken by another worker in between can't
+  be started, and its tenant is skipped;
+* a heartbeat thread renews the worker's leases every ``heartbeat`` seconds, so the leases of a
+  worker that died expire after ``ttl`` seconds and their tenants are claimed by others;
+* an idle worker takes claimed leases that aren't started yet from workers holding more than one,
+  so a slow worker doesn't sit on tenants others could sync;
+* a synced tenant is released and next due ``interval`` seconds later, or after an interval
+  following its change rate with a :class:`sync.cadence.Cadence`. Its ``synced_at`` becomes the
+  time the sync started, and a sync with a failed stage keeps the previous one, so the next
+  incremental import starts where the last successful one started;
+* a sync whose lease was lost, or may have expired since its last renewal, stops: its next
+  Supabase or integration.app round trip raises :class:`LeaseLostError` (see :func:`check`).
+
+Each worker runs ``slots`` tenants at once; adding workers adds slots::
+
+    python -m sync.lease --slots 4
+"""
+import argparse
+import collections
+import contextlib
+import contextvars
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from sync import sb, cadence, logs, metrics, tracing
+
+logger = logs.get_logger(__name__)
+
+LEASES = metrics.registry.counter("sync_lease_events_total", "Tenant lease claims, starts, losses and releases",
+                                  ("event",))
+
+_fence = contextvars.ContextVar("sync_lease_fence", default=None)
+
+
+class LeaseLostError(RuntimeError):
+    pass
+
+
+class Fence:
+    """The lease a tenant's sync runs under, lost once a renewal finds it taken or it may have expired."""
+
+    def __init__(self, tenant_id, ttl: float, renewed_at: float):
+        """
+        :param ttl: Seconds the lease lasts after a renewal
+        :param renewed_at: ``time.monotonic()`` when the last renewal, or the start, was sent
+        """
+        self.tenant_id = tenant_id
+        self.ttl = ttl
+        self.renewed_at = renewed_at
+        self.lost = threading.Event()
+
+    def check(self):
+        if self.lost.is_set():
+            raise LeaseLostError(f"Lost the lease of tenant {self.tenant_id}")
+        if time.monotonic() - self.renewed_at > self.ttl:
+            raise LeaseLostError(f"The lease of tenant {self.tenant_id} may have expired")
+
+
+@contextlib.contextmanager
+def fenced(fence: Fence):
+    """Run the block's round trips under ``fence``, see :func:`check`."""
+    token = _fence.set(fence)
+    try:
+        yield fence
+    finally:
+        _fence.reset(token)
+
+
+def check():
+    """
+    Raise :class:`LeaseLostError` if this context syncs a tenant under a lease that was lost. Called
+    before every Supabase and integration.app round trip, so a worker that lost a tenant stops
+    writing to it while another worker syncs it.
+    """
+    fence = _fence.get()
+    if fence is not None:
+        fence.check()
+
+
+def worker_id() -> str:
+    """An owner name unique to this process."""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class LeaseStore:
+    """The ``sync_lease`` functions, called through PostgREST."""
+
+    @staticmethod
+    def register() -> int:
+        """Add a lease for every tenant with a Salesforce connection; return how many were added."""
+        return sb.rpc("register_sync_tenants", {}).execute().data or 0
+
+    @staticmethod
+    def claim(owner: str, limit: int, ttl: float) -> list:
+        """:return: The ``sync_lease`` rows claimed, at most ``limit``"""
+        rows = sb.rpc("claim_sync_leases", {"p_owner": owner, "p_limit": limit, "p_ttl_seconds": ttl}).execute().data
+        return rows or []
+
+    @staticmethod
+    def start(owner: str, tenant_id, ttl: float) -> bool:
+        return bool(sb.rpc("start_sync_lease", {"p_owner": owner, "p_tenant_id": tenant_id,
+                                                "p_ttl_seconds": ttl}).execute().data)
+
+    @staticmethod
+    def renew(owner: str, tenant_ids: list, ttl: float) -> set:
+        """:return: The tenant IDs whose lease is still held and was extended"""
+        data = sb.rpc("renew_sync_leases", {"p_owner": owner, "p_tenant_ids": list(tenant_ids),
+                                            "p_ttl_seconds": ttl}).execute().data
+        return {row["renew_sync_leases"] if isinstance(row, dict) else row for row in data or []}
+
+    @staticmethod
+    def release(owner: str, tenant_id, synced: bool = True, next_sync_in: float = 0.0, error: str = None,
+                changes: int = None, change_rate: float = None) -> bool:
+        """
+        :param next_sync_in: Seconds until the tenant is due again, after a sync
+        :param changes: Records changed since the previous sync, saved with the tenant's schedule
+        :param change_rate: The tenant's change rate, see :class:`sync.cadence.Cadence`
+        """
+        return bool(sb.rpc("release_sync_lease", {"p_owner": owner, "p_tenant_id": tenant_id, "p_synced": synced,
+                                                  "p_next_sync_seconds": next_sync_in, "p_error": error,
+                                                  "p_changes": changes,
+                                                  "p_change_rate": change_rate}).execute().data)
+
+
+class LeaseWorker:
+    def __init__(self, sync, owner: str = None, slots: int = 2, prefetch: int = None, ttl: float = 60.0,
+                 heartbeat: float = None, interval: float = 300.0, directions: tuple = ("import", "export"),
+                 cadence=None):
+        """
+        :param sync: The ``main.Sync`` syncing each claimed tenant
+        :param owner: Name of this worker in the lease table, unique per process by default
+        :param slots: Tenants synced at once
+        :param prefetch: Tenants claimed per claim call, ``slots`` by default
+        :param ttl: Seconds a lease lasts without a heartbeat
+        :param heartbeat: Seconds between lease renewals, a third of ``ttl`` by default
+        :param interval: Seconds from a tenant's sync to when it is due again
+        :param directions: Directions synced for each tenant
+        :param cadence: Optional ``cadence.Cadence`` adapting each tenant's interval to its change rate, in place
+            of ``interval``
+        """
+        self.sync = sync
+        self.owner = owner or worker_id()
+        self.slots = slots
+        self.prefetch = prefetch or slots
+        self.ttl = ttl
+        self.heartbeat = heartbeat or ttl / 3
+        self.interval = interval
+        self.directions = directions
+        self.cadence = cadence
+        self.store = LeaseStore()
+        self._queue = collections.deque()
+        self._leases = {}
+        self._held = set()
+        self._fences = {}  # tenant_id -> Fence of its running sync
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat_thread = None
+
+    def start_heartbeat(self):
+        if self._heartbeat_thread is None:
+            self._heartbeat_thread = threading.Thread(target=self._beat, name="sync-lease-heartbeat", daemon=True)
+            self._heartbeat_thread.start()
+
+    def _beat(self):
+        while not self._stop.wait(self.heartbeat):
+            self.renew()
+
+    def renew(self):
+        with self._lock:
+            held = set(self._held)
+        if not held:
+            return
+        sent = time.monotonic()
+        try:
+            renewed = self.store.renew(self.owner, held, self.ttl)
+        except Exception:
+            logger.exception("Lease renewal failed", extra={"owner": self.owner})
+            return
+        lost = held - renewed
+        with self._lock:
+            for tenant_id in renewed:
+                if tenant_id in self._fences:
+                    self._fences[tenant_id].renewed_at = sent
+        if lost:
+            LEASES.inc(len(lost), event="lost")
+            logger.warning("Lost tenant leases", extra={"owner": self.owner, "tenants": sorted(lost)})
+            with self._lock:
+                self._held -= lost
+                self._queue = collections.deque(t for t in self._queue if t not in lost)
+                for tenant_id in lost:
+                    self._leases.pop(tenant_id, None)
+                    if tenant_id in self._fences:
+                        # Stop the running sync at its next round trip
+                        self._fences[tenant_id].lost.set()
+
+    def _next(self):
+        """The next claimed tenant to sync, claiming more when none are queued; None when nothing is due."""
+        with self._lock:
+            if not self._queue and not self._stop.is_set():
+                claimed = self.store.claim(self.owner, self.prefetch, self.ttl)
+                LEASES.inc(len(claimed), event="claimed")
+                for lease in claimed:
+                    self._leases[lease["tenant_id"]] = lease
+                    self._queue.append(lease["tenant_id"])
+                    self._held.add(lease["tenant_id"])
+            return self._queue.popleft() if self._queue else None
+
+    def run_cycle(self) -> dict:
+        """
+        Sync due tenants until none are left to claim.
+
+        :return: Tenant ID to ``{"status", "error"}`` for the tenants this worker synced
+        """
+        self.store.register()
+        self.start_heartbeat()
+        results = {}
+        with ThreadPoolExecutor(max_workers=self.slots, thread_name_prefix="sync-lease") as pool:
+            for future in [pool.submit(self._run_slot, results) for _ in range(self.slots)]:
+                future.result()
+        return results
+
+    def _run_slot(self, results: dict):
+        while True:
+            tenant_id = self._next()
+            if tenant_id is None:
+                return
+            sent = time.monotonic()
+            if not self.store.start(self.owner, tenant_id, self.ttl):
+                LEASES.inc(event="stolen")
+                with self._lock:
+                    self._held.discard(tenant_id)
+                    self._leases.pop(tenant_id, None)
+                continue
+            LEASES.inc(event="started")
+            results[tenant_id] = self._sync_tenant(tenant_id, Fence(tenant_id, self.ttl, sent))
+
+    def _sync_tenant(self, tenant_id, fence: Fence) -> dict:
+        with self._lock:
+            lease = self._leases.pop(tenant_id, None) or {}
+            self._fences[tenant_id] = fence
+        error, changes = None, cadence.Changes()
+        try:
+            with tracing.span("lease.tenant", tenant_id=tenant_id, owner=self.owner), \
+                    cadence.observe(lease.get("synced_at")) as changes, fenced(fence):
+                for connection in self.sync.salesforce_conns((tenant_id,)):
+                    error = error or _failed_stages(self.sync.sync_connection(connection, self.directions))
+            if error:
+                logger.error("Tenant sync had failed stages", extra={"tenant_id": tenant_id, "owner": self.owner,
+                                                                      "error": error})
+        except Exception as exc:
+            logger.exception("Tenant sync failed", extra={"tenant_id": tenant_id, "owner": self.owner})
+            error = repr(exc)
+        finally:
+            rate, interval = lease.get("change_rate"), self.interval
+            if self.cadence is not None:
+                # A failed run may have missed changes, so it doesn't update the rate
+                rate, interval = self.cadence.next(changes.count, None if error else changes.since, rate,
+                                                   lease.get("sync_interval"))
+                logger.info("Tenant scheduled", extra={"tenant_id": tenant_id, "changes": changes.count,
+                                                       "change_rate": rate, "interval": round(interval)})
+            with self._lock:
+                self._held.discard(tenant_id)
+                self._fences.pop(tenant_id, None)
+            # synced_at becomes the lease's started_at, or stays with an error, see
+            # sql/010_sync_lease_synced_at_start.sql
+            if not self.store.release(self.owner, tenant_id, True, interval, error, changes.count, rate):
+                LEASES.inc(event="lost")
+                logger.warning("Tenant lease expired during its sync", extra={"tenant_id": tenant_id,
+                                                                                "owner": self.owner})
+        LEASES.inc(event="released")
+        return {"status": "failed" if error else "ok", "error": error}
+
+    def run_forever(self, idle: float = 5.0):
+        """Run cycles until :meth:`stop`, waiting ``idle`` seconds when no tenant was due."""
+        while not self._stop.is_set():
+            if not self.run_cycle():
+                self._stop.wait(idle)
+
+    def stop(self):
+        """Stop claiming, and hand back the claimed tenants not started yet."""
+        self._stop.set()
+        with self._lock:
+            queued, self._queue = list(self._queue), collections.deque()
+            self._held.difference_update(queued)
+            for tenant_id in queued:
+                self._leases.pop(tenant_id, None)
+        for tenant_id in queued:
+            self.store.release(self.owner, tenant_id, synced=False)
+
+
+def _failed_stages(results: dict):
+    """The errors of the stages in ``Sync.sync_connection`` results that didn't finish, or None."""
+    errors = [f"{direction} {stage}: {result['error'] or result['status']}"
+              for direction, by_user in results.items() for stages in by_user.values()
+              for stage, result in stages.items() if result["status"] != "ok"]
+    return "; ".join(errors) or None
+
+
+if __name__ == "__main__":
+    from sync import capture
+    from sync.config import (SYNC_LOG_LEVEL, SYNC_LOG_SAMPLE_EVERY, SYNC_JOURNAL_PATH, SYNC_CAPTURE_PATH,
+                             SYNC_INTEGRATION_APP_URL, SYNC_MIN_INTERVAL, SYNC_MAX_INTERVAL, SYNC_TARGET_CHANGES)
+    from sync.journal import ExportJournal
+    from sync.main import Sync
+
+    parser = argparse.ArgumentParser(description="Sync tenants claimed through leases shared with other workers")
+    parser.add_argument("--slots", type=int, default=2, help="Tenants synced at once")
+    parser.add_argument("--prefetch", type=int, help="Tenants claimed at a time, default: --slots")
+    parser.add_argument("--ttl", type=float, default=60.0, help="Seconds a lease lasts without a heartbeat")
+    parser.add_argument("--interval", type=float, default=300.0,
+                        help="Seconds between syncs of a tenant, unless --adaptive")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="Sync each tenant at an interval following its change rate")
+    parser.add_argument("--min-interval", type=float, default=SYNC_MIN_INTERVAL)
+    parser.add_argument("--max-interval", type=float, default=SYNC_MAX_INTERVAL)
+    parser.add_argument("--target-changes", type=float, default=SYNC_TARGET_CHANGES,
+                        help="Changed records an adaptive sync should pick up")
+    parser.add_argument("--once", action="store_true", help="Exit when no tenant is due")
+    args = parser.parse_args()
+
+    logs.configure(SYNC_LOG_LEVEL, sample_every=SYNC_LOG_SAMPLE_EVERY)
+    capture.configure(SYNC_CAPTURE_PATH, SYNC_INTEGRATION_APP_URL)
+    worker = LeaseWorker(Sync(ExportJournal(SYNC_JOURNAL_PATH) if SYNC_JOURNAL_PATH else None),
+                         slots=args.slots, prefetch=args.prefetch, ttl=args.ttl, interval=args.interval,
+                         cadence=cadence.Cadence(args.min_interval, args.max_interval, args.target_changes)
+                         if args.adaptive else None)
+    logger.info("Lease worker started", extra={"owner": worker.owner, "slots": args.slots})
+    try:
+        if args.once:
+            worker.run_cycle()
+        else:
+            worker.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        worker.stop()
@@ -0,0 +1,132 @@
+"""
+Structured, leveled logging for the sync package.
+
+Modules log through ``logs.get_logger(__name__)`` with fields passed as ``extra``::
+
+    logger.info("Exported contact", extra={"record_id": id_, "salesforce_id": sf_id, "sample": True})
+    logger.debug("Contact payload", extra={"payload": payload})
+
+:func:`configure` routes the ``sync`` logger through a queue: the sync loop only enqueues the
+record, and a background listener thread formats it (including any payload) and writes it out.
+Records marked ``sample=True`` are per-record success messages and only one in
+``sample_every`` of each message is kept.
+"""
+import atexit
+import itertools
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+
+ROOT_LOGGER = "sync"
+
+# Attributes every LogRecord has; anything else on a record came from ``extra``.
+_RECORD_ATTRS = frozenset(vars(logging.makeLogRecord({})).keys()) | {"message", "asctime", "sample"}
+
+_listener = None
+_lock = threading.Lock()
+
+
+def get_logger(name: str) -> logging.Logger:
+    """Return a logger under the ``sync`` hierarchy."""
+    if name != ROOT_LOGGER and not name.startswith(ROOT_LOGGER + "."):
+        name = f"{ROOT_LOGGER}.{name}"
+    return logging.getLogger(name)
+
+
+class StructuredFormatter(logging.Formatter):
+    """Formats a record as one JSON object: time, level, logger, message and the ``extra`` fields."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps one in ``every`` records marked ``sample=True``, counted per message."""
+
+    def __init__(self, every: int):
+        super().__init__()
+        self.every = max(1, int(every))
+        self._counters = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.every == 1 or not getattr(record, "sample", False):
+            return True
+        counter = self._counters.get(record.msg)
+        if counter is None:
+            counter = self._counters.setdefault(record.msg, itertools.count())
+        seen = next(counter)
+        if seen % self.every:
+            return False
+        record.sampled_every = self.every
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Enqueues records unformatted so payload serialization happens on the listener thread."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def configure(level="INFO", sample_every: int = 1, stream=None, formatter: logging.Formatter = None):
+    """
+    Route the ``sync`` logger through a non-blocking queue handler.
+
+    Safe to call more than once; the previous listener is stopped first.
+
+    :param level: Minimum level to log; payload dumps are only emitted at ``DEBUG``
+    :param sample_every: Keep one in this many per-record success messages
+    :param stream: Where the listener writes, ``sys.stderr`` by default
+    :param formatter: Formatter used by the listener, :class:`StructuredFormatter` by default
+    """
+    global _listener
+    with _lock:
+        _stop_listener()
+
+        output = logging.StreamHandler(stream or sys.stderr)
+        output.setFormatter(formatter or StructuredFormatter())
+
+        records = queue.SimpleQueue()
+        handler = _QueueHandler(records)
+        handler.addFilter(SamplingFilter(sample_every))
+
+        logger = logging.getLogger(ROOT_LOGGER)
+        for existing in list(logger.handlers):
+            if isinstance(existing, _QueueHandler):
+                logger.removeHandler(existing)
+        logger.addHandler(handler)
+        logger.setLevel(level.upper() if isinstance(level, str) else level)
+        logger.propagate = False
+
+        _listener = logging.handlers.QueueListener(records, output)
+        _listener.start()
+
+
+def shutdown():
+    """Flush queued records and stop the listener thread."""
+    with _lock:
+        _stop_listener()
+
+
+def _stop_listener():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(shutdown)
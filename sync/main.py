@@ -1,50 +1,370 @@
-from sync import sb
+import argparse
+import contextlib
+import contextvars
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from sync.config import (SYNC_LOG_LEVEL, SYNC_LOG_SAMPLE_EVERY, SYNC_JOURNAL_PATH, SYNC_CAPTURE_PATH,
+                         SYNC_INTEGRATION_APP_URL)
+from sync import sb, breaker, capture, integration, logs, metrics, tracing
 from sync.accounts import Accounts
+from sync.clients import registry
 from sync.contacts import Contacts
 from sync.deals import Deals
+from sync.enums import EntityType
+from sync.journal import ExportJournal, RetryWorker
 from sync.leads import Leads
 
+logger = logs.get_logger(__name__)
+
+# Contacts resolve companyId through the accounts already mapped in entity_integration, in both
+# directions. Deals and leads don't reference other entities.
+ENTITY_DEPENDENCIES = {
+    "account": (),
+    "contact": ("account",),
+    "deal": (),
+    "lead": (),
+}
+
+DIRECTIONS = ("import", "export", "delete")
+MODES = ("full", "incremental", "dry-run")
+
+ENTITY_CLASSES = {
+    "account": Accounts,
+    "contact": Contacts,
+    "deal": Deals,
+    "lead": Leads,
+}
+
+
+def entity_types(value: str) -> tuple:
+    """Parse a comma-separated ``--entities`` argument, rejecting names not in :data:`ENTITY_CLASSES`."""
+    entities = tuple(value.split(","))
+    unknown = [entity for entity in entities if entity not in ENTITY_CLASSES]
+    if unknown:
+        raise argparse.ArgumentTypeError(f"unknown entity type(s) {', '.join(unknown)}; "
+                                         f"choose from {', '.join(ENTITY_CLASSES)}")
+    return entities
+
+
+STAGE_SECONDS = metrics.registry.histogram("sync_stage_seconds", "Wall-clock time of a per-tenant sync stage",
+                                           ("stage", "direction", "tenant", "outcome"))
+
+
+class EntityScheduler:
+    """
+    Runs per-tenant stages as a dependency graph: a stage starts as soon as every stage it depends
+    on has finished, so independent stages run concurrently. If a stage fails, the stages that
+    depend on it are skipped.
+    """
+
+    def __init__(self, stages: dict, dependencies: dict, max_workers: int = 4):
+        """
+        :param stages: Stage name to a zero-argument callable
+        :param dependencies: Stage name to the names of the stages it waits for
+        :param max_workers: Maximum number of stages running at once
+        """
+        unknown = {dep for name in stages for dep in dependencies.get(name, ()) if dep not in stages}
+        if unknown:
+            raise ValueError(f"Unknown stage dependencies: {sorted(unknown)}")
+        self.stages = stages
+        self.dependencies = {name: tuple(dependencies.get(name, ())) for name in stages}
+        self.max_workers = max_workers
+
+    def run(self) -> dict:
+        """
+        Run every stage.
+
+        :return: Stage name to ``{"status", "seconds", "error"}``, where status is ``ok``, ``failed``
+            or ``skipped``
+        """
+        results = {}
+        pending = dict(self.dependencies)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="sync-stage") as pool:
+            while pending or running:
+                for name, deps in list(pending.items()):
+                    if any(results.get(dep, {}).get("status") in ("failed", "skipped") for dep in deps):
+                        del pending[name]
+                        results[name] = {"status": "skipped", "seconds": 0.0, "error": None}
+                    elif all(dep in results for dep in deps):
+                        del pending[name]
+                        # Threads don't inherit context, so carry the metrics labels and current span over
+                        context = contextvars.copy_context()
+                        running[pool.submit(context.run, self._run_stage, name)] = name
+                if not running:
+                    if pending:
+                        raise ValueError(f"Stage dependency cycle between {sorted(pending)}")
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[running.pop(future)] = future.result()
+        return results
+
+    def _run_stage(self, name: str) -> dict:
+        start = time.perf_counter()
+        try:
+            with tracing.span(f"stage.{name}"):
+                self.stages[name]()
+        except Exception as exc:
+            logger.exception("Sync stage failed", extra={"stage": name})
+            return {"status": "failed", "seconds": time.perf_counter() - start, "error": repr(exc)}
+        return {"status": "ok", "seconds": time.perf_counter() - start, "error": None}
+
 
 class Sync:
+    def __init__(self, journal=None, entities: tuple = None, batch_size: int = None, max_workers: int = 4,
+                 timeout: float = None, mode: str = "full", since: str = None):
+        """
+        :param journal: Optional ``ExportJournal``; exports are then journaled and failures retried
+        :param entities: Entity types to sync, all by default
+        :param batch_size: Records per batch action call on export, ``SYNC_EXPORT_BATCH_SIZE`` by default
+        :param max_workers: Entity stages of a user run at once
+        :param timeout: Seconds before an integration.app request times out
+        :param mode: ``full``, ``incremental`` to import only the records updated since ``since`` or the
+            tenant's last leased sync, or ``dry-run`` to send no writes to integration.app
+        :param since: Start of an incremental import, ISO 8601
+        """
+        unknown = set(entities or ()) - set(ENTITY_CLASSES)
+        if unknown:
+            raise ValueError(f"Unknown entities: {sorted(unknown)}")
+        if mode not in MODES:
+            raise ValueError(f"Unknown sync mode: {mode}")
+        self.journal = journal
+        self.entities = tuple(entities) if entities else tuple(ENTITY_CLASSES)
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.mode = mode
+        self.since = since
 
     @staticmethod
-    def salesforce_conns():
-        connections = (sb.table("integration_connection")
-                       .select("connection_id,connection_details,tenant_id")
-                       .eq("connection_key", "salesforce")
-                       .execute().data)
+    def salesforce_conns(tenant_ids: tuple = None):
+        """
+        :param tenant_ids: Only the connections of these tenants, all by default
+        """
+        query = (sb.table("integration_connection")
+                 .select("connection_id,connection_details,tenant_id")
+                 .eq("connection_key", "salesforce"))
+        if tenant_ids is not None:
+            query = query.in_("tenant_id", list(tenant_ids))
+        connections = query.execute().data
         for connection in connections:
             connection["users"] = sb.table("user_role").select("user_id").eq("tenant_id",
                                                                              connection["tenant_id"]).execute().data
 
         return connections
 
-    def sync_salesforce(self):
-        for connection in self.salesforce_conns():
-            accounts = Accounts(connection["connection_details"]["access_token"], "")
-            contacts = Contacts(connection["connection_details"]["access_token"], "")
-            deals = Deals(connection["connection_details"]["access_token"], "")
-            leads = Leads(connection["connection_details"]["access_token"], "")
-            for user in connection["users"]:
-                print(user["user_id"])
-                # deals.delete_from_salesforce("006dL000002lBDNQA2")
-                # deals.delete_from_supabase("de38aa2a-cde3-44f0-acd4-be4e1e4431a3")
-                # leads.delete_from_salesforce("00QdL000005xh7MUAQ")
-                # leads.delete_from_supabase("3bdb7e4f-6e10-4aa6-b59f-308a023ceeaa")
-                # contacts.delete_from_salesforce("003dL000003QCYpQAO")
-                # contacts.delete_from_supabase("4909efbc-827e-41da-8941-2b5c2f677140")
-                # accounts.delete_from_salesforce("001dL00000CbSs5QAF")
-                # accounts.delete_from_supabase("0324aadd-0220-4837-ad2d-8e273d7990f1")
-                # leads.from_salesforce_leads(user["user_id"], 7)
-                # leads.to_salesforce_leads(user["user_id"])
-                # deals.from_salesforce_deals(user["user_id"], 7)
-                # deals.to_salesforce_deals(user["user_id"])
-                # contacts.to_salesforce_contacts(user["user_id"])
-                # contacts.from_salesforce_contacts(user["user_id"], 7)
-                # accounts.to_salesforce(user["user_id"])
-                # accounts.from_salesforce(user["user_id"], 7)
+    def since_for(self, tenant_id):
+        """
+        The start of a tenant's incremental import: ``since``, or when the tenant's last successful leased
+        sync started, so records changed while it ran are imported again.
+        """
+        if self.since:
+            return self.since
+        rows = sb.table("sync_lease").select("synced_at").eq("tenant_id", tenant_id).limit(1).execute().data
+        return rows[0]["synced_at"] if rows else None
+
+    def entity(self, cls, connection: dict):
+        """An entity instance for a connection, with this run's batch size, timeout and mode."""
+        tenant_id = connection["tenant_id"]
+        journal = self.journal.for_tenant(tenant_id) if self.journal and self.mode != "dry-run" else None
+        since = self.since_for(tenant_id) if self.mode == "incremental" else None
+        instance = cls(connection["connection_details"]["access_token"], "", journal, self.batch_size, since)
+        instance.session.timeout = self.timeout
+        if self.mode == "dry-run":
+            from sync.dryrun import DryRunSession
+
+            instance.session = DryRunSession(instance.session)
+        return instance
+
+    def stages(self, connection: dict, user_id: str, direction: str) -> dict:
+        """
+        Build the per-entity stages of one direction for a user of a connection.
+
+        :param connection: A row from :meth:`salesforce_conns`
+        :param user_id: The user owning the records; unused by ``delete``
+        :param direction: ``import`` (Salesforce to Supabase), ``export`` (Supabase to Salesforce) or
+            ``delete`` (records deleted from Supabase, from Salesforce)
+        :return: Stage name to a zero-argument callable
+        """
+        tenant_id = connection["tenant_id"]
+        accounts = self.entity(Accounts, connection)
+        contacts = self.entity(Contacts, connection)
+        deals = self.entity(Deals, connection)
+        leads = self.entity(Leads, connection)
+        if direction == "import":
+            return {
+                "account": lambda: accounts.from_salesforce(user_id, tenant_id),
+                "contact": lambda: contacts.from_salesforce_contacts(user_id, tenant_id),
+                "deal": lambda: deals.from_salesforce_deals(user_id, tenant_id),
+                "lead": lambda: leads.from_salesforce_leads(user_id, tenant_id),
+            }
+        if direction == "export":
+            return {
+                "account": lambda: accounts.to_salesforce(user_id),
+                "contact": lambda: contacts.to_salesforce_contacts(user_id),
+                "deal": lambda: deals.to_salesforce_deals(user_id),
+                "lead": lambda: leads.to_salesforce_leads(user_id),
+            }
+        if direction == "delete":
+            return {
+                "account": lambda: integration.delete_removed(accounts, "account", EntityType.ACCOUNT),
+                "contact": lambda: integration.delete_removed(contacts, "contact", EntityType.CONTACT),
+                "deal": lambda: integration.delete_removed(deals, "deal", EntityType.DEAL),
+                "lead": lambda: integration.delete_removed(leads, "lead", EntityType.LEAD),
+            }
+        raise ValueError(f"Unknown sync direction: {direction}")
+
+    def sync_user(self, connection: dict, user_id: str, direction: str, max_workers: int = None) -> dict:
+        """
+        Sync one user's entities in one direction, accounts before contacts and the rest concurrently.
+
+        :param max_workers: Stages run at once, ``max_workers`` of the instance by default
+        :return: The per-stage results of :meth:`EntityScheduler.run`
+        """
+        stages = {name: stage for name, stage in self.stages(connection, user_id, direction).items()
+                  if name in self.entities}
+        dependencies = {name: tuple(dep for dep in deps if dep in stages) for name, deps in ENTITY_DEPENDENCIES.items()}
+        scheduler = EntityScheduler(stages, dependencies, max_workers or self.max_workers)
+        with tracing.span(direction, user_id=user_id):
+            results = scheduler.run()
+        for stage, result in results.items():
+            STAGE_SECONDS.observe(result["seconds"], stage=stage, direction=direction,
+                                  tenant=connection["tenant_id"], outcome=result["status"])
+            logger.info("Sync stage finished", extra={"user_id": user_id, "stage": stage, "direction": direction,
+                                                      **result})
+        return results
+
+    @tracing.traced("sync_salesforce")
+    def sync_salesforce(self, directions: tuple = ("import", "export"), tenant_ids: tuple = None,
+                        parallel: int = 1) -> dict:
+        """
+        Sync every connection, or those of the given tenants.
+
+        :param parallel: Connections synced at once
+        :return: Tenant ID to the results of :meth:`sync_connection`
+        """
+        if self.journal:
+            self.journal.recover()
+        connections = self.salesforce_conns(tenant_ids)
+        if parallel <= 1:
+            return {connection["tenant_id"]: self.sync_connection(connection, directions)
+                    for connection in connections}
+        with ThreadPoolExecutor(max_workers=parallel, thread_name_prefix="sync-tenant") as pool:
+            futures = {connection["tenant_id"]: pool.submit(contextvars.copy_context().run, self.sync_connection,
+                                                            connection, directions)
+                       for connection in connections}
+            return {tenant_id: future.result() for tenant_id, future in futures.items()}
+
+    def sync_connection(self, connection: dict, directions: tuple = ("import", "export")) -> dict:
+        """
+        Sync every user of a connection, one direction after the other; deletes are synced once.
+
+        :return: Direction to user ID to the per-stage results of :meth:`sync_user`
+        """
+        results = {}
+        with tracing.span("connection", tenant_id=connection["tenant_id"],
+                          connection_id=connection["connection_id"]), \
+                metrics.scope(tenant=connection["tenant_id"]):
+            for direction in directions:
+                users = [None] if direction == "delete" else [user["user_id"] for user in connection["users"]]
+                for user_id in users:
+                    logger.info("Syncing user", extra={"user_id": user_id, "direction": direction})
+                    results.setdefault(direction, {})[user_id] = self.sync_user(connection, user_id, direction)
+        return results
+
+
+def main(argv: list = None) -> int:
+    """
+    Run one sync from the command line.
+
+    :return: The exit code, 1 if any stage failed
+    """
+    parser = argparse.ArgumentParser(description="Sync Salesforce connections with Supabase")
+    parser.add_argument("--tenant", type=int, action="append", help="Tenant to sync, repeatable; default: all")
+    parser.add_argument("--entities", type=entity_types, default=",".join(ENTITY_CLASSES),
+                        help="Comma-separated entity types")
+    parser.add_argument("--direction", choices=DIRECTIONS, action="append",
+                        help="Direction to sync, repeatable; default: import then export")
+    parser.add_argument("--mode", choices=MODES, default="full",
+                        help="incremental imports only the records updated since --since or the tenant's last "
+                             "leased sync; dry-run reads both sides and logs the writes it would make")
+    parser.add_argument("--since", help="Start of an incremental import, ISO 8601")
+    parser.add_argument("--concurrency", type=int, default=4, help="Entity stages run at once per user")
+    parser.add_argument("--tenant-concurrency", type=int, default=1, help="Tenants synced at once")
+    parser.add_argument("--queue-workers", type=int, default=0,
+                        help="Share this many workers between tenants one record batch at a time, see sync.workqueue")
+    parser.add_argument("--queue-tenant-concurrency", type=int, default=2,
+                        help="Record batches of one tenant run at once with --queue-workers")
+    parser.add_argument("--queue-batch-size", type=int, default=500, help="Records per batch with --queue-workers")
+    parser.add_argument("--batch-size", type=int, help="Records per integration.app batch call on export")
+    parser.add_argument("--timeout", type=float, help="Seconds before an integration.app request times out")
+    parser.add_argument("--profile", metavar="DIR",
+                        help="Profile the run and write profile.json and profile.collapsed to DIR")
+    args = parser.parse_args(argv)
+    if args.since and args.mode != "incremental":
+        parser.error("--since requires --mode incremental")
+
+    logs.configure(SYNC_LOG_LEVEL, sample_every=SYNC_LOG_SAMPLE_EVERY)
+    capture.configure(SYNC_CAPTURE_PATH, SYNC_INTEGRATION_APP_URL)
+    dry_run = args.mode == "dry-run"
+    with contextlib.ExitStack() as stack:
+        if dry_run:
+            from sync import dryrun
+
+            stack.enter_context(registry.use(dryrun.DryRunClient(registry.get())))
+        if args.queue_workers:
+            from sync import workqueue
+
+            queue = stack.enter_context(workqueue.FairQueue(args.queue_workers, args.queue_tenant_concurrency,
+                                                            args.queue_batch_size))
+            stack.enter_context(workqueue.use(queue))
+        results = _run(args, None if dry_run else SYNC_JOURNAL_PATH)
+    failed = [(tenant_id, direction, user_id, stage)
+              for tenant_id, by_direction in results.items()
+              for direction, by_user in by_direction.items()
+              for user_id, stages in by_user.items()
+              for stage, result in stages.items() if result["status"] != "ok"]
+    if dry_run:
+        logger.info("Dry run finished", extra={"planned": dryrun.planned()})
+    logger.info("Sync finished", extra={"tenants": len(results), "failed": len(failed)})
+    for open_breaker in breaker.breakers.snapshot():
+        logger.warning("Circuit breaker still open", extra=open_breaker)
+    for tenant_id, direction, user_id, stage in failed:
+        logger.error("Sync stage did not finish", extra={"tenant_id": tenant_id, "direction": direction,
+                                                          "user_id": user_id, "stage": stage})
+    return 1 if failed else 0
+
+
+def _run(args, journal_path: str = None) -> dict:
+    export_journal = ExportJournal(journal_path) if journal_path else None
+    sync = Sync(export_journal, args.entities, args.batch_size, args.concurrency, args.timeout,
+                args.mode, args.since)
+    directions = tuple(args.direction or ("import", "export"))
+    retry_worker = None
+    if export_journal:
+        from sync.service import ExportService
+
+        retry_worker = RetryWorker(export_journal, ExportService())
+        retry_worker.start()
+    profiler = None
+    if args.profile:
+        from sync.profiling import Profiler
+
+        profiler = Profiler()
+        profiler.start()
+    try:
+        return sync.sync_salesforce(directions, tuple(args.tenant) if args.tenant else None, args.tenant_concurrency)
+    finally:
+        if profiler:
+            profiler.stop()
+            profiler.write(args.profile)
+            logger.info("Wrote profile", extra={"directory": args.profile, "samples": profiler.samples})
+        if retry_worker:
+            retry_worker.stop()
 
 
 if __name__ == "__main__":
-    sync = Sync()
-    sync.sync_salesforce()
+    sys.exit(main())
@@ -0,0 +1,361 @@
+"""
+In-process metrics for Supabase and integration.app round trips.
+
+Every ``sb.table(...).execute()`` goes through :class:`InstrumentedClient` and every
+integration.app request goes through :class:`InstrumentedSession`. Both count and time the
+call, labeled by backend, table or action, operation, entity type, tenant and outcome. They
+don't decide whether a call may be made; :mod:`sync.guards` does, around them.
+
+The entity and tenant labels come from :func:`scope`, which can be used as a context manager
+or as a method decorator::
+
+    with metrics.scope(tenant=connection["tenant_id"]):
+        contacts.from_salesforce_contacts(user_id, tenant_id)
+
+Results are kept in :data:`registry` and can be rendered in the Prometheus text format with
+:meth:`Registry.render_prometheus` or served with :func:`start_http_server`.
+"""
+import bisect
+import contextlib
+import contextvars
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from sync import capture, tracing
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_ACTION_RE = re.compile(r"/actions/([^/]+)/run")
+_QUERY_OPERATIONS = ("select", "insert", "update", "upsert", "delete")
+
+_labels = contextvars.ContextVar("sync_metric_labels", default={})
+
+
+@contextlib.contextmanager
+def scope(**labels):
+    """
+    Attach labels (e.g. ``entity``, ``tenant``) to every call recorded inside the block.
+
+    Also usable as a decorator, in which case the labels apply to each call of the function.
+    """
+    token = _labels.set({**_labels.get(), **{k: str(v) for k, v in labels.items()}})
+    try:
+        yield
+    finally:
+        _labels.reset(token)
+
+
+def current_labels() -> dict:
+    """Return the labels set by the enclosing :func:`scope` blocks."""
+    return dict(_labels.get())
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: tuple):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        """Sum of every series matching the given labels."""
+        with self._lock:
+            items = list(self._values.items())
+        return sum(v for k, v in items if all(k[self.labelnames.index(n)] == str(labels[n]) for n in labels))
+
+    def samples(self):
+        with self._lock:
+            return [(dict(zip(self.labelnames, k)), v) for k, v in self._values.items()]
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labels, value in self.samples():
+            lines.append(f"{self.name}{_format_labels(labels)} {value}")
+        return lines
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Gauge(Counter):
+    """A value that goes up and down, such as a queue depth."""
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def render(self) -> list:
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: tuple, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0}
+            series["counts"][bisect.bisect_left(self.buckets, value)] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def samples(self):
+        """Return ``(labels, {"count", "sum", "buckets"})`` per series, with cumulative buckets."""
+        with self._lock:
+            items = [(k, dict(v, counts=list(v["counts"]))) for k, v in self._series.items()]
+        result = []
+        for key, series in items:
+            cumulative, running = [], 0
+            for bound, count in zip(self.buckets + (float("inf"),), series["counts"]):
+                running += count
+                cumulative.append((bound, running))
+            result.append((dict(zip(self.labelnames, key)),
+                           {"count": series["count"], "sum": series["sum"], "buckets": cumulative}))
+        return result
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, series in self.samples():
+            for bound, count in series["buckets"]:
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': le})} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {series['sum']}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {series['count']}")
+        return lines
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, *args):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args)
+            elif type(metric) is not cls:
+                raise ValueError(f"Metric {name} is already registered as {type(metric).__name__}")
+            return metric
+
+    def counter(self, name: str, documentation: str, labelnames: tuple) -> Counter:
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple) -> Gauge:
+        return self._get_or_create(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple, buckets: tuple = DEFAULT_BUCKETS) \
+            -> Histogram:
+        return self._get_or_create(Histogram, name, documentation, labelnames, buckets)
+
+    def render_prometheus(self) -> str:
+        """Render every metric in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            metric.clear()
+
+
+registry = Registry()
+
+CALL_LABELS = ("backend", "target", "operation", "entity", "tenant", "outcome")
+CALLS = registry.counter("sync_calls_total", "Supabase and integration.app round trips", CALL_LABELS)
+CALL_SECONDS = registry.histogram("sync_call_seconds", "Latency of Supabase and integration.app round trips",
+                                  CALL_LABELS)
+
+
+def record_call(backend: str, target: str, operation: str, outcome: str, seconds: float):
+    """Record one round trip, labeled with the current :func:`scope`."""
+    labels = current_labels()
+    labels.update(backend=backend, target=target, operation=operation, outcome=outcome)
+    CALLS.inc(**labels)
+    CALL_SECONDS.observe(seconds, **labels)
+
+
+def report(limit: int = 20) -> list:
+    """
+    Summarize round trips by total time spent, slowest first.
+
+    :param limit: Maximum number of rows to return
+    :return: A list of dicts with the call labels plus ``count``, ``total_seconds`` and ``mean_seconds``
+    """
+    rows = []
+    for labels, series in CALL_SECONDS.samples():
+        rows.append({**labels, "count": series["count"], "total_seconds": series["sum"],
+                     "mean_seconds": series["sum"] / series["count"] if series["count"] else 0.0})
+    rows.sort(key=lambda row: row["total_seconds"], reverse=True)
+    return rows[:limit]
+
+
+class InstrumentedQuery:
+    """Wraps a postgrest request builder and records the round trip made by ``execute()``."""
+
+    def __init__(self, builder, table: str, operation: str = "select", payload=None):
+        self._builder = builder
+        self._table = table
+        self._operation = operation
+        self._payload = payload
+
+    def execute(self):
+        labels = current_labels()
+        with tracing.span(f"supabase.{self._operation}", table=self._table, entity=labels.get("entity"),
+                          tenant_id=labels.get("tenant")) as span:
+            start = time.perf_counter()
+            outcome = "error"
+            try:
+                response = self._builder.execute()
+                outcome = "ok"
+            finally:
+                record_call("supabase", self._table, self._operation, outcome, time.perf_counter() - start)
+            if span.recording:
+                span.set_attributes({"request_bytes": tracing.payload_size(self._payload),
+                                     "response_bytes": tracing.payload_size(response.data),
+                                     "rows": len(response.data) if isinstance(response.data, list) else None})
+            return response
+
+    def __getattr__(self, name):
+        attr = getattr(self._builder, name)
+        if not callable(attr):
+            return attr
+        operation = name if name in _QUERY_OPERATIONS else self._operation
+
+        def call(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            if hasattr(result, "execute"):
+                payload = args[0] if name in ("insert", "update", "upsert") and args else self._payload
+                return InstrumentedQuery(result, self._table, operation, payload)
+            return result
+
+        return call
+
+
+class InstrumentedClient:
+    """Proxy around a Supabase ``Client`` whose ``table()`` queries and ``rpc()`` calls are counted and timed."""
+
+    def __init__(self, client):
+        self._client = client
+
+    def table(self, name: str) -> InstrumentedQuery:
+        return InstrumentedQuery(self._client.table(name), name)
+
+    def rpc(self, function: str, params: dict = None) -> InstrumentedQuery:
+        return InstrumentedQuery(self._client.rpc(function, params or {}), function, "rpc", params)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+class InstrumentedSession(requests.Session):
+    """
+    ``requests.Session`` that records every request by integration.app action, and captures it when
+    :mod:`sync.capture` is enabled. The entity classes use it through ``sync.guards.GuardedSession``.
+    """
+
+    # Seconds before a request times out, unless the call sets its own; no timeout when None
+    timeout = None
+
+    def request(self, method, url, *args, **kwargs):
+        if self.timeout is not None:
+            kwargs.setdefault("timeout", self.timeout)
+        url = capture.route(url)
+        target = target_of(url)
+        labels = current_labels()
+        with tracing.span(f"integration_app.{target}", method=method, entity=labels.get("entity"),
+                          tenant_id=labels.get("tenant")) as span:
+            start = time.perf_counter()
+            outcome = "exception"
+            try:
+                response = super().request(method, url, *args, **kwargs)
+                outcome = "ok" if response.status_code < 400 else f"http_{response.status_code}"
+            finally:
+                record_call("integration_app", target, method.lower(), outcome, time.perf_counter() - start)
+            capture.record(method, url, kwargs.get("json"), response, time.perf_counter() - start)
+            if span.recording:
+                span.set_attributes({"status_code": response.status_code,
+                                     "request_bytes": tracing.payload_size(response.request.body),
+                                     "response_bytes": len(response.content)})
+            return response
+
+
+def target_of(url: str) -> str:
+    """The integration.app action a request URL runs, or the URL itself."""
+    match = _ACTION_RE.search(url)
+    return match.group(1) if match else url
+
+
+def start_http_server(port: int, addr: str = "", registry_: Registry = None) -> ThreadingHTTPServer:
+    """
+    Serve the registry at ``/metrics`` for Prometheus to scrape, from a daemon thread.
+
+    :param port: The port to listen on
+    :param addr: The address to bind, all interfaces by default
+    :param registry_: The registry to expose, :data:`registry` by default
+    :return: The running server; call ``shutdown()`` to stop it
+    """
+    source = registry_ or registry
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = source.render_prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((addr, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
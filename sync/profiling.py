@@ -0,0 +1,213 @@
+"""
+Sampling profiler and allocation tracking for sync runs, reported per sync stage.
+
+While a :class:`Profiler` runs, a thread samples the stacks of every other thread every
+``interval`` seconds, and ``tracemalloc`` traces allocations. Each sample and each allocation is
+put in the stage of the innermost function of the ``sync`` package on its stack that belongs to
+one of :data:`STAGES`, or in ``other``:
+
+* ``fetch``: selecting rows to export, listing Salesforce records
+* ``map``: ``map_i``/``map_o`` and payload hashing
+* ``lookup``: entity_integration and reference lookups
+* ``write``: Supabase inserts and upserts, integration.app create and update calls
+* ``track``: linking exported records in entity_integration
+
+Samples whose innermost frame waits on a socket, a lock or a queue count as ``waiting``, the
+others as ``running``, so a stage's running samples approximate its CPU time. The report is a
+JSON file meant to be diffed between releases, with a collapsed-stack file next to it for flame
+graphs::
+
+    python -m sync.main --profile profile/ --tenant 7 --entities account --direction import
+"""
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+STAGES = {
+    "fetch": ("from_salesforce", "from_salesforce_contacts", "from_salesforce_deals", "from_salesforce_leads",
+              "to_salesforce", "to_salesforce_contacts", "to_salesforce_deals", "to_salesforce_leads",
+              "export_by_ids", "_fetch_page", "salesforce_leaves"),
+    "map": ("map_i", "map_o", "payload_hash"),
+    "lookup": ("fetch_links", "fetch_imported", "fetch_sync_state", "tenant_references", "check_salesforce_id",
+               "access_token", "salesforce_conns"),
+    "write": ("import_records", "_import_batch", "update_changed", "export_rows", "export_row", "export_batched",
+              "send", "insert_rows", "upsert_rows", "update_links", "_write", "delete_from_salesforce",
+              "delete_from_supabase"),
+    "track": ("track_records", "track_record", "_link"),
+}
+
+_STAGE_OF = {name: stage for stage, names in STAGES.items() for name in names}
+_PACKAGE = os.path.dirname(os.path.abspath(__file__))
+_WAITING = {"wait", "acquire", "select", "poll", "recv", "recv_into", "readinto", "read", "accept", "sleep",
+            "_wait_for_tstate_lock"}
+
+
+class Profiler:
+    def __init__(self, interval: float = 0.005, nframe: int = 16, top: int = 15):
+        """
+        :param interval: Seconds between two samples
+        :param nframe: Frames kept per traced allocation
+        :param top: Functions and allocation sites listed per stage
+        """
+        self.interval = interval
+        self.nframe = nframe
+        self.top = top
+        self.samples = 0
+        self._stages = {}
+        self._stacks = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self._started = None
+        self._cpu = None
+        self._snapshot = None
+        self._peak = 0
+
+    def start(self):
+        self._started = time.time()
+        self._cpu = time.process_time()
+        tracemalloc.start(self.nframe)
+        self._thread = threading.Thread(target=self._sample_loop, name="sync-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self._cpu = time.process_time() - self._cpu
+        self._snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)])
+        self._peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _sample_loop(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own:
+                    self._sample(frame)
+
+    def _sample(self, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+            frame = frame.f_back
+        stack.reverse()
+        stage = _stage([(name, filename) for name, filename, _ in stack])
+        state = "waiting" if stack and stack[-1][0] in _WAITING else "running"
+        stats = self._stages.setdefault(stage, {"running": 0, "waiting": 0, "functions": {}})
+        stats[state] += 1
+        leaf = stack[-1] if stack else ("?", "?", 0)
+        stats["functions"][leaf] = stats["functions"].get(leaf, 0) + 1
+        collapsed = ";".join([stage] + [f"{name} ({os.path.basename(filename)}:{line})"
+                                        for name, filename, line in stack])
+        self._stacks[collapsed] = self._stacks.get(collapsed, 0) + 1
+        self.samples += 1
+
+    def report(self) -> dict:
+        stages = {stage: {"samples": 0, "running": 0, "waiting": 0, "seconds": 0.0, "top_functions": [],
+                          "allocated_bytes": 0, "allocated_blocks": 0, "top_allocations": []}
+                  for stage in list(STAGES) + ["other"]}
+        for stage, stats in self._stages.items():
+            samples = stats["running"] + stats["waiting"]
+            functions = sorted(stats["functions"].items(), key=lambda item: item[1], reverse=True)[:self.top]
+            stages[stage].update(samples=samples, running=stats["running"], waiting=stats["waiting"],
+                                 seconds=round(samples * self.interval, 3),
+                                 top_functions=[{"function": name, "file": _relative(filename), "line": line,
+                                                 "samples": count} for (name, filename, line), count in functions])
+
+        sites, overall = {}, {}
+        ranges = _code_ranges()
+        for statistic in self._snapshot.statistics("traceback") if self._snapshot else ():
+            frames = list(statistic.traceback)
+            stage = _stage([(_function_at(ranges, frame.filename, frame.lineno), frame.filename) for frame in frames])
+            site = (_relative(frames[-1].filename), frames[-1].lineno)
+            stages[stage]["allocated_bytes"] += statistic.size
+            stages[stage]["allocated_blocks"] += statistic.count
+            for totals in (sites.setdefault(stage, {}), overall):
+                size, count = totals.get(site, (0, 0))
+                totals[site] = (size + statistic.size, count + statistic.count)
+        for stage, totals in sites.items():
+            stages[stage]["top_allocations"] = _top_sites(totals, self.top)
+        return {
+            "version": 1,
+            "started_at": self._started,
+            "python": sys.version.split()[0],
+            "interval": self.interval,
+            "samples": self.samples,
+            "cpu_seconds": round(self._cpu, 3) if self._cpu is not None else None,
+            "peak_traced_bytes": self._peak,
+            "stages": stages,
+            "top_allocations": _top_sites(overall, self.top),
+        }
+
+    def write(self, directory: str) -> dict:
+        """
+        Write ``profile.json`` and ``profile.collapsed`` to ``directory``.
+
+        :return: The report
+        """
+        os.makedirs(directory, exist_ok=True)
+        report = self.report()
+        with open(os.path.join(directory, "profile.json"), "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        with open(os.path.join(directory, "profile.collapsed"), "w") as f:
+            for stack, count in sorted(self._stacks.items()):
+                f.write(f"{stack} {count}\n")
+        return report
+
+
+def _stage(frames: list) -> str:
+    """The stage of the innermost ``sync`` function on a stack, listed outermost first."""
+    for name, filename in reversed(frames):
+        if name in _STAGE_OF and filename.startswith(_PACKAGE):
+            return _STAGE_OF[name]
+    return "other"
+
+
+def _relative(filename: str) -> str:
+    return os.path.relpath(filename, os.path.dirname(_PACKAGE)) if filename.startswith(_PACKAGE) else filename
+
+
+def _code_ranges() -> dict:
+    """Filename to ``(first line, last line, function name)`` of every function in the sync package."""
+    ranges = {}
+
+    def visit(code):
+        lines = [line for _, _, line in code.co_lines() if line is not None]
+        if lines:
+            ranges.setdefault(code.co_filename, []).append((min(lines), max(lines), code.co_name))
+        for const in code.co_consts:
+            if hasattr(const, "co_lines"):
+                visit(const)
+
+    for name, module in list(sys.modules.items()):
+        filename = getattr(module, "__file__", None) or ""
+        if name.startswith("sync") and filename.startswith(_PACKAGE) and filename.endswith(".py"):
+            with open(filename) as f:
+                visit(compile(f.read(), filename, "exec"))
+    return ranges
+
+
+def _function_at(ranges: dict, filename: str, line: int) -> str:
+    """The innermost function of the sync package spanning a line, or ``?``."""
+    best = None
+    for first, last, name in ranges.get(filename, ()):
+        if name != "<module>" and first <= line <= last and (best is None or last - first < best[1] - best[0]):
+            best = (first, last, name)
+    return best[2] if best else "?"
+
+
+def _top_sites(totals: dict, top: int) -> list:
+    ordered = sorted(totals.items(), key=lambda item: item[1][0], reverse=True)[:top]
+    return [{"file": filename, "line": line, "bytes": size, "blocks": count}
+            for (filename, line), (size, count) in ordered]
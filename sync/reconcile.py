@@ -0,0 +1,201 @@
+"""
+Hash-tree reconciliation of a tenant's Salesforce records against Supabase.
+
+Both sides are summarized the same way (``sql/007_reconcile_tenant.sql``): each linked record gets a
+leaf hash of its Salesforce ID and of the entity's ``reconcile_columns`` as ``map_o`` maps them,
+records are bucketed by the hex MD5 of their Salesforce ID, and a bucket hashes its leaves. The
+summaries are compared one hex digit at a time, from the 16 top-level buckets down, and only the
+buckets whose hashes differ are split further; a differing bucket of at most ``leaf_size``
+records is compared record by record. The result is the records:
+
+* ``missing`` in Supabase: in Salesforce, but not linked in entity_integration to an existing row;
+* ``extra`` in Supabase: linked in entity_integration, but not in Salesforce;
+* ``divergent``: on both sides with different compared columns.
+
+Supabase computes its summaries in the database, so the Supabase round trips and the rows read
+back grow with the number of differing records rather than with the table. integration.app has
+no such summaries, so the Salesforce records are still all listed and hashed here::
+
+    python -m sync.reconcile --tenant 7 --owner <user_id> --output drift-7.json
+"""
+import argparse
+import hashlib
+import json
+
+from sync import sb, integration, logs, metrics, tracing
+from sync.backfill import ENTITY_TYPES
+from sync.main import ENTITY_CLASSES, entity_types
+
+logger = logs.get_logger(__name__)
+
+DRIFT = metrics.registry.counter("sync_reconcile_records_total", "Records found out of sync by reconciliation",
+                                 ("entity", "kind"))
+
+
+def column_spec(cls) -> list:
+    """The compared columns of an entity class, as passed to the reconcile database functions."""
+    entity = _entity(cls)
+    spec = []
+    for key, columns in cls.reconcile_columns.items():
+        table, via = (entity, None) if key == entity else cls.import_parents[key]
+        spec.extend({"key": key, "table": table, "via": via, "column": column} for column in columns)
+    return spec
+
+
+def text(value) -> str:
+    """A value as Postgres casts it to text; NULL as ``\\N``."""
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
+
+
+def leaf_hash(salesforce_id: str, values: list) -> str:
+    return _md5(salesforce_id + "|" + "|".join(text(value) for value in values))
+
+
+def bucket_hash(leaves) -> str:
+    return _md5("".join(sorted(leaves)))
+
+
+def bucket_key(salesforce_id: str) -> str:
+    return _md5(salesforce_id)
+
+
+def _md5(value: str) -> str:
+    return hashlib.md5(value.encode()).hexdigest()
+
+
+def _entity(cls) -> str:
+    return next(name for name, entity_cls in ENTITY_CLASSES.items() if entity_cls is cls)
+
+
+class Reconciler:
+    def __init__(self, entity: str, tenant_id, owner_id: str, access_token: str = None, session=None,
+                 leaf_size: int = 64):
+        """
+        :param entity: Entity type to reconcile, such as ``account``
+        :param tenant_id: The tenant whose records are compared; on the Supabase side, the rows owned by its
+            users in user_role
+        :param owner_id: The owner ``map_o`` is given; it isn't compared
+        :param access_token: integration.app token, read from the tenant's integration_connection by default
+        :param session: Optional session for the list actions in place of the entity's own
+        :param leaf_size: Records in a differing bucket below which it is compared record by record
+        """
+        self.entity = entity
+        self.entity_type = ENTITY_TYPES[entity]
+        self.tenant_id = tenant_id
+        self.owner_id = owner_id
+        self.exporter = ENTITY_CLASSES[entity](access_token or integration.access_token(tenant_id), "")
+        if session is not None:
+            self.exporter.session = session
+        self.leaf_size = leaf_size
+        self.spec = column_spec(ENTITY_CLASSES[entity])
+        self.buckets_compared = 0
+
+    def salesforce_leaves(self) -> dict:
+        """:return: Salesforce ID to ``(bucket key, leaf hash)`` of every Salesforce record"""
+        leaves, cursor = {}, None
+        with tracing.span("reconcile.salesforce", entity=self.entity):
+            while True:
+                response = self.exporter.session.post(self.exporter.import_url,
+                                                      json={"cursor": cursor} if cursor else {})
+                response.raise_for_status()
+                output = response.json()["output"]
+                for record in output.get("records") or []:
+                    payload = self.exporter.map_o(record, self.tenant_id, self.owner_id)
+                    values = [payload[column["key"]][column["column"]] for column in self.spec]
+                    leaves[record["id"]] = (bucket_key(record["id"]), leaf_hash(record["id"], values))
+                cursor = output.get("cursor")
+                if not cursor:
+                    return leaves
+
+    def _rpc(self, function: str, prefix: str) -> list:
+        params = {"p_entity_type": self.entity_type.value, "p_table": self.entity,
+                  "p_columns": [{key: column[key] for key in ("table", "via", "column")} for column in self.spec],
+                  "p_prefix": prefix, "p_tenant_id": self.tenant_id,
+                  "p_owner_column": ENTITY_CLASSES[self.entity].owner_column}
+        return sb.rpc(function, params).execute().data or []
+
+    @tracing.traced("reconcile")
+    def run(self) -> dict:
+        """
+        :return: ``{"entity", "missing", "extra", "divergent", "buckets_compared"}``, where ``missing`` lists
+            Salesforce IDs and the others ``{"salesforce_id", "entity_based_id"}`` dicts
+        """
+        with metrics.scope(entity=self.entity, tenant=self.tenant_id):
+            salesforce = self.salesforce_leaves()
+            result = {"entity": self.entity, "missing": [], "extra": [], "divergent": []}
+            self.buckets_compared = 0
+            self._compare("", salesforce, result)
+        result["buckets_compared"] = self.buckets_compared
+        for kind in ("missing", "extra", "divergent"):
+            result[kind].sort(key=lambda item: item if isinstance(item, str) else item["salesforce_id"])
+            DRIFT.inc(len(result[kind]), entity=self.entity, kind=kind)
+        logger.info("Reconciled records", extra={"entity": self.entity, "tenant_id": self.tenant_id,
+                                                 "salesforce": len(salesforce), "buckets": self.buckets_compared,
+                                                 **{kind: len(result[kind]) for kind in ("missing", "extra",
+                                                                                         "divergent")}})
+        return result
+
+    def _compare(self, prefix: str, salesforce: dict, result: dict):
+        with tracing.span("reconcile.buckets", prefix=prefix):
+            rows = self._rpc("reconcile_buckets", prefix)
+        supabase = {row["bucket"]: (row["records"], row["hash"]) for row in rows}
+        local = {}
+        for salesforce_id, (key, leaf) in salesforce.items():
+            if key.startswith(prefix):
+                local.setdefault(key[:len(prefix) + 1], {})[salesforce_id] = leaf
+        for bucket in sorted(set(local) | set(supabase)):
+            self.buckets_compared += 1
+            leaves = local.get(bucket, {})
+            records, hash_ = supabase.get(bucket, (0, None))
+            if leaves and hash_ == bucket_hash(leaves.values()):
+                continue
+            if not records:
+                result["missing"].extend(leaves)
+            elif max(len(leaves), records) <= self.leaf_size or len(bucket) == 32:
+                self._compare_leaves(bucket, leaves, result)
+            else:
+                self._compare(bucket, {salesforce_id: salesforce[salesforce_id] for salesforce_id in leaves}, result)
+
+    def _compare_leaves(self, bucket: str, leaves: dict, result: dict):
+        with tracing.span("reconcile.leaves", prefix=bucket):
+            rows = self._rpc("reconcile_leaves", bucket)
+        seen = set()
+        for row in rows:
+            salesforce_id = row["salesforce_id"]
+            seen.add(salesforce_id)
+            link = {"salesforce_id": salesforce_id, "entity_based_id": row["entity_based_id"]}
+            if salesforce_id not in leaves:
+                result["extra"].append(link)
+            elif leaves[salesforce_id] != row["hash"]:
+                result["divergent"].append(link)
+        result["missing"].extend(salesforce_id for salesforce_id in leaves if salesforce_id not in seen)
+
+
+def main(argv: list = None) -> dict:
+    from sync.config import SYNC_LOG_LEVEL, SYNC_LOG_SAMPLE_EVERY
+
+    parser = argparse.ArgumentParser(description="Find records out of sync between Salesforce and Supabase")
+    parser.add_argument("--tenant", required=True, type=int)
+    parser.add_argument("--owner", required=True, help="User ID the records are mapped for")
+    parser.add_argument("--entities", type=entity_types, default=",".join(ENTITY_CLASSES),
+                        help="Comma-separated entity types")
+    parser.add_argument("--token", help="integration.app token, default: the tenant's salesforce connection")
+    parser.add_argument("--leaf-size", type=int, default=64, help="Records per bucket compared record by record")
+    parser.add_argument("--output", help="Write the records out of sync to this JSON file")
+    args = parser.parse_args(argv)
+
+    logs.configure(SYNC_LOG_LEVEL, sample_every=SYNC_LOG_SAMPLE_EVERY)
+    results = {name: Reconciler(name, args.tenant, args.owner, args.token, leaf_size=args.leaf_size).run()
+               for name in args.entities}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main()
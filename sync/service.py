@@ -0,0 +1,350 @@
+"""
+Long-running receiver for single-record changes.
+
+Accepts "entity X id Y changed" events over HTTP and exports the record to Salesforce through
+warm, per-tenant entity instances on already-open connections. Once the owner's tenants and the
+access token are cached, an event costs three Supabase selects (the record's owner, then the row
+and its link), one write of the link and one integration.app call. Bursts of edits to the same record are
+coalesced: an event is exported ``window`` seconds after the last edit, but never later than
+``max_delay`` seconds after the first one.
+
+    POST /events  {"tenant_id": 7, "entity": "account", "id": "<uuid>"}   (or a list of them)
+    GET  /healthz
+    GET  /metrics
+
+Events must carry the shared secret, either as ``Authorization: Bearer <secret>`` or as an
+``X-Sync-Signature: sha256=<hex>`` HMAC of the body keyed with it, and a record is only exported
+when its owner belongs to the event's tenant. Run with
+``SYNC_SERVICE_SECRET=... python -m sync.service --port 8080``; it listens on 127.0.0.1 unless
+given ``--host``.
+"""
+import argparse
+import collections
+import hashlib
+import heapq
+import hmac
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from sync import sb, logs, metrics, tracing
+from sync.main import ENTITY_CLASSES
+
+logger = logs.get_logger(__name__)
+
+EVENT_LATENCY = metrics.registry.histogram("sync_event_latency_seconds",
+                                           "Time from receiving a change event to finishing its export",
+                                           ("entity", "outcome"),
+                                           (0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0))
+EVENTS = metrics.registry.counter("sync_events_total", "Change events received", ("entity", "result"))
+
+
+class Debouncer:
+    """
+    Coalesces events with the same key and hands each key to ``handler(key, first_received)`` once
+    it has been quiet for ``window`` seconds, or ``max_delay`` seconds after its first event.
+
+    A key is never handled by two workers at once; an event arriving while its key is being
+    handled schedules one more run afterwards.
+    """
+
+    def __init__(self, handler, window: float = 0.2, max_delay: float = 0.5, workers: int = 8):
+        self.handler = handler
+        self.window = window
+        self.max_delay = max_delay
+        self.workers = workers
+        self._pending = {}  # key -> (due, first_received)
+        self._heap = []
+        self._sequence = itertools.count()
+        self._in_flight = set()
+        self._cond = threading.Condition()
+        self._threads = []
+        self._stopped = False
+
+    def submit(self, key, received: float = None) -> bool:
+        """
+        Schedule ``key``.
+
+        :return: True if this event started a new batch, False if it was coalesced into a pending one
+        """
+        now = time.monotonic()
+        received = received or now
+        with self._cond:
+            pending = self._pending.get(key)
+            first = pending[1] if pending else received
+            due = min(now + self.window, first + self.max_delay)
+            self._pending[key] = (due, first)
+            heapq.heappush(self._heap, (due, next(self._sequence), key))
+            self._cond.notify()
+        return pending is None
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"sync-debounce-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: float = None):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def depth(self) -> int:
+        with self._cond:
+            return len(self._pending)
+
+    def _next(self):
+        with self._cond:
+            while not self._stopped:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                due, _, key = self._heap[0]
+                pending = self._pending.get(key)
+                if pending is None or pending[0] != due:
+                    heapq.heappop(self._heap)  # superseded by a later event
+                    continue
+                wait = due - time.monotonic()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+                heapq.heappop(self._heap)
+                if key in self._in_flight:
+                    retry = time.monotonic() + self.window
+                    self._pending[key] = (retry, pending[1])
+                    heapq.heappush(self._heap, (retry, next(self._sequence), key))
+                    continue
+                del self._pending[key]
+                self._in_flight.add(key)
+                return key, pending[1]
+        return None
+
+    def _work(self):
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            key, first_received = item
+            try:
+                self.handler(key, first_received)
+            except Exception:
+                logger.exception("Failed to handle change event", extra={"key": list(key)})
+            finally:
+                with self._cond:
+                    self._in_flight.discard(key)
+
+
+class ExportService:
+    """Exports changed records through entity instances kept warm per tenant."""
+
+    def __init__(self, token_ttl: float = 60.0, tenant_ttl: float = 300.0, max_users: int = 10_000):
+        """
+        :param token_ttl: How long a tenant's access token is reused before re-reading integration_connection
+        :param tenant_ttl: How long a user's tenants are reused before re-reading user_role
+        :param max_users: Users whose tenants are cached at most, the least recently used evicted first
+        """
+        self.token_ttl = token_ttl
+        self.tenant_ttl = tenant_ttl
+        self.max_users = max_users
+        self._tokens = {}  # tenant_id -> (access_token, fetched_at)
+        self._exporters = {}  # (tenant_id, entity) -> (access_token, instance)
+        self._tenants = collections.OrderedDict()  # user_id -> (frozenset of tenant_id, fetched_at)
+        self._lock = threading.Lock()
+        self._tenants_lock = threading.Lock()
+
+    def tenants_of_user(self, user_id: str) -> frozenset:
+        """
+        Return the tenants a user has a role in, from user_role. Cached for ``tenant_ttl``
+        seconds; a user without any role isn't cached, so a role granted since is found at once.
+        """
+        with self._tenants_lock:
+            cached = self._tenants.get(user_id)
+            if cached and time.monotonic() - cached[1] < self.tenant_ttl:
+                self._tenants.move_to_end(user_id)
+                return cached[0]
+        rows = sb.table("user_role").select("tenant_id").eq("user_id", user_id).execute().data
+        tenants = frozenset(row["tenant_id"] for row in rows)
+        with self._tenants_lock:
+            if tenants:
+                self._tenants[user_id] = (tenants, time.monotonic())
+                self._tenants.move_to_end(user_id)
+                while len(self._tenants) > self.max_users:
+                    self._tenants.popitem(last=False)
+            else:
+                self._tenants.pop(user_id, None)
+        return tenants
+
+    def tenant_for_user(self, user_id: str):
+        """Return the tenant of a record owner, or None if the owner has a role in no tenant or in several."""
+        tenants = self.tenants_of_user(user_id)
+        return next(iter(tenants)) if len(tenants) == 1 else None
+
+    def owner_tenants(self, entity: str, record_id: str) -> frozenset:
+        """Return the tenants of a record's owner, empty if the record is missing or its owner has no role."""
+        column = ENTITY_CLASSES[entity].owner_column
+        rows = sb.table(entity).select(column).eq("id", record_id).limit(1).execute().data
+        owner_id = rows[0][column] if rows else None
+        return self.tenants_of_user(owner_id) if owner_id else frozenset()
+
+    def access_token(self, tenant_id) -> str:
+        cached = self._tokens.get(tenant_id)
+        if cached and time.monotonic() - cached[1] < self.token_ttl:
+            return cached[0]
+        rows = (sb.table("integration_connection").select("connection_details")
+                .eq("connection_key", "salesforce").eq("tenant_id", tenant_id).limit(1).execute().data)
+        if not rows:
+            raise LookupError(f"No salesforce connection for tenant {tenant_id}")
+        token = rows[0]["connection_details"]["access_token"]
+        self._tokens[tenant_id] = (token, time.monotonic())
+        return token
+
+    def exporter(self, tenant_id, entity: str):
+        token = self.access_token(tenant_id)
+        with self._lock:
+            cached = self._exporters.get((tenant_id, entity))
+            if cached is None or cached[0] != token:
+                if cached is not None:
+                    cached[1].session.close()
+                cached = self._exporters[(tenant_id, entity)] = (token, ENTITY_CLASSES[entity](token, ""))
+            return cached[1]
+
+    def handle(self, key: tuple, first_received: float):
+        tenant_id, entity, record_id = key
+        outcome = "error"
+        try:
+            with metrics.scope(tenant=tenant_id), tracing.span("event", tenant_id=tenant_id, entity=entity,
+                                                                record_id=record_id):
+                owner_tenants = self.owner_tenants(entity, record_id)
+                if str(tenant_id) not in {str(owner_tenant) for owner_tenant in owner_tenants}:
+                    # Never push a record through another tenant's connection
+                    outcome = "rejected"
+                    logger.warning("Record not owned by the event's tenant",
+                                   extra={"tenant_id": tenant_id, "entity": entity, "record_id": record_id,
+                                          "owner_tenants": sorted(owner_tenants)})
+                    return
+                outcome = "ok" if self.exporter(tenant_id, entity).export_by_id(record_id) else "failed"
+        finally:
+            EVENT_LATENCY.observe(time.monotonic() - first_received, entity=entity, outcome=outcome)
+
+
+def parse_events(body: bytes) -> list:
+    """
+    Parse a request body into ``(tenant_id, entity, id)`` keys.
+
+    :raises ValueError: If the body is not a valid event or list of events
+    """
+    data = json.loads(body or b"null")
+    events = data if isinstance(data, list) else [data]
+    keys = []
+    for event in events:
+        if not isinstance(event, dict) or not all(event.get(k) is not None for k in ("tenant_id", "entity", "id")):
+            raise ValueError("Each event needs tenant_id, entity and id")
+        if event["entity"] not in ENTITY_CLASSES:
+            raise ValueError(f"Unknown entity {event['entity']!r}")
+        keys.append((event["tenant_id"], event["entity"], str(event["id"])))
+    return keys
+
+
+def authorized(headers, body: bytes, secret: str) -> bool:
+    """
+    Whether a request carries the shared secret: an ``Authorization: Bearer <secret>`` header, or an
+    ``X-Sync-Signature: sha256=<hex>`` header with the HMAC-SHA256 of the body keyed with the secret.
+    """
+    signature = headers.get("X-Sync-Signature")
+    if signature:
+        expected = "sha256=" + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+        return hmac.compare_digest(signature.encode(), expected.encode())
+    return hmac.compare_digest((headers.get("Authorization") or "").encode(), f"Bearer {secret}".encode())
+
+
+def make_server(host: str, port: int, debouncer: Debouncer, secret: str) -> ThreadingHTTPServer:
+    """
+    :param secret: The shared secret every event must carry, see :func:`authorized`
+    :raises ValueError: If there is no secret
+    """
+    if not secret:
+        raise ValueError("The export service needs a shared secret for its events")
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            if self.path != "/events":
+                return self._reply(404, {"error": "not found"})
+            received = time.monotonic()
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            if not authorized(self.headers, body, secret):
+                return self._reply(401, {"error": "unauthorized"})
+            try:
+                keys = parse_events(body)
+            except ValueError as exc:
+                return self._reply(400, {"error": str(exc)})
+            for key in keys:
+                result = "accepted" if debouncer.submit(key, received) else "coalesced"
+                EVENTS.inc(entity=key[1], result=result)
+            self._reply(202, {"accepted": len(keys)})
+
+        def do_GET(self):
+            if self.path == "/healthz":
+                return self._reply(200, {"status": "ok", "pending": debouncer.depth()})
+            if self.path == "/metrics":
+                body = metrics.registry.render_prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+            self._reply(404, {"error": "not found"})
+
+        def _reply(self, status: int, payload: dict):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug("HTTP request", extra={"client": self.client_address[0], "request": format % args})
+
+    return ThreadingHTTPServer((host, port), Handler)
+
+
+def serve(secret: str, host: str = "127.0.0.1", port: int = 8080, window: float = 0.2, max_delay: float = 0.5,
+          workers: int = 8):
+    service = ExportService()
+    debouncer = Debouncer(service.handle, window, max_delay, workers)
+    server = make_server(host, port, debouncer, secret)
+    debouncer.start()
+    logger.info("Listening for change events", extra={"host": host, "port": port})
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        debouncer.stop()
+
+
+if __name__ == "__main__":
+    from sync import capture
+    from sync.config import (SYNC_LOG_LEVEL, SYNC_LOG_SAMPLE_EVERY, SYNC_CAPTURE_PATH, SYNC_INTEGRATION_APP_URL,
+                             SYNC_SERVICE_SECRET)
+
+    parser = argparse.ArgumentParser(description="Export single-record changes to Salesforce as they happen")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on; 0.0.0.0 for every interface")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--window", type=float, default=0.2, help="Seconds of quiet before a record is exported")
+    parser.add_argument("--max-delay", type=float, default=0.5, help="Upper bound on coalescing, in seconds")
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args()
+    if not SYNC_SERVICE_SECRET:
+        parser.error("SYNC_SERVICE_SECRET must be set")
+
+    logs.configure(SYNC_LOG_LEVEL, sample_every=SYNC_LOG_SAMPLE_EVERY)
+    capture.configure(SYNC_CAPTURE_PATH, SYNC_INTEGRATION_APP_URL)
+    serve(SYNC_SERVICE_SECRET, args.host, args.port, args.window, args.max_delay, args.workers)
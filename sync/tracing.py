@@ -0,0 +1,196 @@
+"""
+OpenTelemetry-style spans across a sync run.
+
+Spans nest as ``sync_salesforce`` -> connection -> entity method -> record -> Supabase/HTTP call,
+so a slow tenant or a slow record can be found in a long run. Tracing is off by default and
+:func:`span` is then a no-op; turn it on with an exporter::
+
+    exporter = tracing.InMemoryExporter()
+    tracing.enable(exporter)
+    Sync().sync_salesforce()
+    slowest = max(exporter.spans, key=lambda s: s.duration)
+"""
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+
+_current = contextvars.ContextVar("sync_current_span", default=None)
+_exporter = None
+
+
+class Span:
+    recording = True
+
+    def __init__(self, name: str, parent=None, attributes: dict = None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = dict(attributes or {})
+        self.status = "ok"
+        self.error = None
+        self.start_time = time.time_ns()
+        self.end_time = None
+
+    @property
+    def duration(self) -> float:
+        """Duration in seconds, or 0 while the span is still open."""
+        return (self.end_time - self.start_time) / 1e9 if self.end_time else 0.0
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def set_attributes(self, attributes: dict):
+        self.attributes.update(attributes)
+
+    def record_exception(self, exc: BaseException):
+        self.status = "error"
+        self.error = f"{type(exc).__name__}: {exc}"
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_time": self.start_time,
+            "end_time": self.end_time,
+            "duration": self.duration,
+            "status": self.status,
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+
+class _NoopSpan:
+    """Returned by :func:`span` when tracing is disabled; every method does nothing."""
+    recording = False
+    duration = 0.0
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_attributes(self, attributes):
+        pass
+
+    def record_exception(self, exc):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class InMemoryExporter:
+    """Keeps finished spans in a list, for tests and ad-hoc analysis."""
+
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def export(self, span: Span):
+        with self._lock:
+            self.spans.append(span)
+
+    def find(self, name: str) -> list:
+        with self._lock:
+            return [s for s in self.spans if s.name == name]
+
+    def children(self, parent: Span) -> list:
+        with self._lock:
+            return [s for s in self.spans if s.parent_id == parent.span_id]
+
+    def clear(self):
+        with self._lock:
+            self.spans.clear()
+
+
+class JsonLinesExporter:
+    """Appends each finished span as one JSON object per line."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, span: Span):
+        line = json.dumps(span.to_dict(), default=str)
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(line + "\n")
+
+
+def enable(exporter):
+    """Start recording spans to ``exporter`` (any object with an ``export(span)`` method)."""
+    global _exporter
+    _exporter = exporter
+
+
+def disable():
+    global _exporter
+    _exporter = None
+
+
+def enabled() -> bool:
+    return _exporter is not None
+
+
+def current_span():
+    return _current.get() or NOOP_SPAN
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes):
+    """
+    Open a child span of the current span for the duration of the block.
+
+    :param name: The span name
+    :param attributes: Initial span attributes; ``None`` values are dropped
+    """
+    exporter = _exporter
+    if exporter is None:
+        yield NOOP_SPAN
+        return
+
+    s = Span(name, _current.get(), {k: v for k, v in attributes.items() if v is not None})
+    token = _current.set(s)
+    try:
+        yield s
+    except BaseException as exc:
+        s.record_exception(exc)
+        raise
+    finally:
+        _current.reset(token)
+        s.end_time = time.time_ns()
+        exporter.export(s)
+
+
+def traced(name: str = None, **attributes):
+    """Decorator wrapping every call of the function in a :func:`span` named after it."""
+
+    def decorator(func):
+        span_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _exporter is None:
+                return func(*args, **kwargs)
+            with span(span_name, **attributes):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def payload_size(payload) -> int:
+    """Approximate size in bytes of a JSON payload, for span attributes."""
+    if payload is None:
+        return 0
+    if isinstance(payload, (bytes, bytearray)):
+        return len(payload)
+    if isinstance(payload, str):
+        return len(payload.encode())
+    return len(json.dumps(payload, default=str))
@@ -0,0 +1,184 @@
+"""
+Weighted fair sharing of sync work between tenants, one record batch at a time.
+
+Inside :func:`use`, imports and exports split their records into batches of ``batch_size`` and
+run each batch through a :class:`FairQueue` instead of in the stage's own thread (see
+:func:`run_batches`). The queue's ``workers`` threads take batches in start-time fair queueing
+order: a batch of ``n`` records costs ``n / weight`` of its tenant's virtual time, and the batch
+with the earliest virtual start runs next. A tenant with a million records therefore gets its
+share of the workers, like every other tenant with work queued, instead of holding them until
+it's done, and a tenant that was idle starts at the current virtual time rather than with
+credit saved up. No tenant runs more than ``tenant_concurrency`` batches at once.
+
+Queued batches and their wait per tenant are in :data:`DEPTH` and :data:`WAIT_SECONDS`, and
+:meth:`FairQueue.stats` has them too::
+
+    with workqueue.use(FairQueue(workers=8, tenant_concurrency=2)):
+        sync.sync_salesforce(parallel=16)
+"""
+import collections
+import contextlib
+import contextvars
+import threading
+import time
+from concurrent.futures import Future
+
+from sync import logs, metrics
+
+logger = logs.get_logger(__name__)
+
+DEPTH = metrics.registry.gauge("sync_queue_depth", "Record batches queued per tenant", ("tenant",))
+RUNNING = metrics.registry.gauge("sync_queue_running", "Record batches running per tenant", ("tenant",))
+WAIT_SECONDS = metrics.registry.histogram("sync_queue_wait_seconds", "Time a record batch waited in the queue",
+                                          ("tenant",))
+BATCHES = metrics.registry.counter("sync_queue_batches_total", "Record batches run per tenant", ("tenant",))
+
+_queue = contextvars.ContextVar("sync_work_queue", default=None)
+_worker = threading.local()
+
+_Item = collections.namedtuple("_Item", "start finish cost fn future queued_at")
+
+
+class _Tenant:
+    def __init__(self, weight: float):
+        self.weight = weight
+        self.items = collections.deque()
+        self.running = 0
+        self.finish = 0.0  # virtual finish time of the last batch queued
+        self.waited = 0.0
+        self.batches = 0
+
+
+class FairQueue:
+    def __init__(self, workers: int = 8, tenant_concurrency: int = 2, batch_size: int = 500, weights: dict = None):
+        """
+        :param workers: Batches run at once across every tenant
+        :param tenant_concurrency: Batches of one tenant run at once
+        :param batch_size: Records per batch
+        :param weights: Tenant ID to its share relative to the others, 1 by default
+        """
+        self.workers = workers
+        self.tenant_concurrency = tenant_concurrency
+        self.batch_size = batch_size
+        self.weights = {str(tenant): weight for tenant, weight in (weights or {}).items()}
+        self._tenants = {}
+        self._virtual_time = 0.0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._threads = [threading.Thread(target=self._work, name=f"sync-queue-{i}", daemon=True)
+                         for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, tenant, fn, *args, cost: float = 1, **kwargs) -> Future:
+        """Queue ``fn(*args, **kwargs)`` as a batch of ``tenant`` costing ``cost`` records."""
+        tenant = str(tenant)
+        future = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("The work queue is shut down")
+            state = self._tenants.get(tenant)
+            if state is None:
+                state = self._tenants[tenant] = _Tenant(self.weights.get(tenant, 1.0))
+            start = max(self._virtual_time, state.finish)
+            state.finish = start + max(cost, 1) / state.weight
+            state.items.append(_Item(start, state.finish, cost, lambda: fn(*args, **kwargs), future,
+                                     time.monotonic()))
+            DEPTH.inc(tenant=tenant)
+            self._cond.notify()
+        return future
+
+    def _next(self):
+        """The queued batch with the earliest virtual start among tenants below their cap, or None."""
+        best = None
+        for tenant, state in self._tenants.items():
+            if state.items and state.running < self.tenant_concurrency:
+                if best is None or state.items[0].start < best[1].items[0].start:
+                    best = (tenant, state)
+        if best is None:
+            return None
+        tenant, state = best
+        item = state.items.popleft()
+        state.running += 1
+        self._virtual_time = max(self._virtual_time, item.start)
+        return tenant, state, item
+
+    def _work(self):
+        _worker.queue = self
+        while True:
+            with self._cond:
+                picked = self._next()
+                while picked is None:
+                    if self._closed:
+                        return
+                    self._cond.wait()
+                    picked = self._next()
+            tenant, state, item = picked
+            waited = time.monotonic() - item.queued_at
+            DEPTH.dec(tenant=tenant)
+            RUNNING.inc(tenant=tenant)
+            WAIT_SECONDS.observe(waited, tenant=tenant)
+            BATCHES.inc(tenant=tenant)
+            if item.future.set_running_or_notify_cancel():
+                try:
+                    item.future.set_result(item.fn())
+                except BaseException as exc:
+                    item.future.set_exception(exc)
+            RUNNING.dec(tenant=tenant)
+            with self._cond:
+                state.running -= 1
+                state.waited += waited
+                state.batches += 1
+                if not state.items and not state.running:
+                    # An idle tenant starts again at the current virtual time
+                    del self._tenants[tenant]
+                self._cond.notify_all()
+
+    def stats(self) -> dict:
+        """:return: Tenant ID to ``{"queued", "running", "batches", "waited"}``, for the tenants with work"""
+        with self._cond:
+            return {tenant: {"queued": len(state.items), "running": state.running, "batches": state.batches,
+                             "waited": round(state.waited, 3)} for tenant, state in self._tenants.items()}
+
+    def shutdown(self, wait: bool = True):
+        """Stop once the queued batches have run."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+
+@contextlib.contextmanager
+def use(queue: FairQueue):
+    """Run the record batches of imports and exports inside the block through ``queue``."""
+    token = _queue.set(queue)
+    try:
+        yield queue
+    finally:
+        _queue.reset(token)
+
+
+def run_batches(fn, items: list) -> list:
+    """
+    Call ``fn`` on batches of ``items`` through the queue in use, as work of the tenant of the current
+    ``metrics.scope``, and wait for them; call it once on every item when no queue is in use, or from
+    a batch already running in the queue.
+
+    :return: The result of each batch, in order
+    """
+    queue = _queue.get()
+    if queue is None or getattr(_worker, "queue", None) is queue or not items:
+        return [fn(items)]
+    tenant = metrics.current_labels().get("tenant", "")
+    futures = [queue.submit(tenant, contextvars.copy_context().run, fn, items[i:i + queue.batch_size],
+                            cost=len(items[i:i + queue.batch_size]))
+               for i in range(0, len(items), queue.batch_size)]
+    return [future.result() for future in futures]
@@ -0,0 +1,35 @@
+import os
+import pathlib
+import uuid
+
+import pytest
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+
+@pytest.fixture
+def postgres():
+    """
+    A fresh schema in the database of ``SYNC_TEST_DSN`` with the tables of ``tests/schema.sql`` and
+    the migrations of ``sql/``, dropped afterwards: ``(dsn, schema, connection)``. Skipped when
+    ``SYNC_TEST_DSN`` isn't set.
+    """
+    dsn = os.getenv("SYNC_TEST_DSN")
+    if not dsn:
+        pytest.skip("SYNC_TEST_DSN is not set")
+    psycopg2 = pytest.importorskip("psycopg2")
+
+    schema = f"sync_test_{uuid.uuid4().hex[:8]}"
+    connection = psycopg2.connect(dsn)
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+        cursor.execute(f'CREATE SCHEMA "{schema}"')
+        cursor.execute(f'SET search_path TO "{schema}", public')
+        for path in [ROOT / "tests" / "schema.sql"] + sorted((ROOT / "sql").glob("*.sql")):
+            cursor.execute(path.read_text())
+    try:
+        yield dsn, schema, connection
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP SCHEMA "{schema}" CASCADE')
+        connection.close()
@@ -0,0 +1,113 @@
+-- Stand-ins for the Supabase tables the sync writes, with their keys, defaults and NOT NULL
+-- constraints, for the tests run against Postgres (see conftest.py). The migrations in sql/ are
+-- applied on top.
+CREATE TABLE user_role (
+    user_id uuid NOT NULL,
+    tenant_id bigint NOT NULL
+);
+
+CREATE TABLE integration_connection (
+    id bigint GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    tenant_id bigint NOT NULL,
+    connection_key text NOT NULL,
+    connection_details jsonb NOT NULL
+);
+
+CREATE TABLE phone_book (
+    id bigint GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+    first_name text,
+    last_name text,
+    email text,
+    phone text,
+    website text,
+    street text,
+    city text,
+    state text,
+    country text,
+    location text,
+    department text,
+    description text,
+    do_not_call boolean,
+    title text,
+    company text,
+    created_by uuid NOT NULL,
+    created_at timestamptz NOT NULL DEFAULT now(),
+    last_updated_by uuid,
+    last_updated_at timestamptz
+);
+
+CREATE TABLE deal_lead_source (
+    id bigserial PRIMARY KEY,
+    name text NOT NULL,
+    created_at timestamptz NOT NULL DEFAULT now()
+);
+
+CREATE TABLE account (
+    id uuid PRIMARY KEY DEFAULT gen_random_uuid(),
+    phone_book_id bigint NOT NULL REFERENCES phone_book (id),
+    group_id bigint NOT NULL,
+    entity_stage_id bigint,
+    entity_priority_id bigint,
+    domain text,
+    industry text,
+    no_of_employees integer,
+    headquarters text,
+    owner_id uuid NOT NULL,
+    created_by uuid NOT NULL,
+    created_at timestamptz NOT NULL DEFAULT now(),
+    last_updated_by uuid,
+    last_updated_at timestamptz
+);
+
+CREATE TABLE contact (
+    id uuid PRIMARY KEY DEFAULT gen_random_uuid(),
+    phone_book_id bigint NOT NULL REFERENCES phone_book (id),
+    account_id uuid REFERENCES account (id),
+    group_id bigint NOT NULL,
+    entity_stage_id bigint,
+    entity_priority_id bigint,
+    created_by uuid NOT NULL,
+    created_at timestamptz NOT NULL DEFAULT now(),
+    last_updated_by uuid,
+    last_updated_at timestamptz
+);
+
+CREATE TABLE deal (
+    id uuid PRIMARY KEY DEFAULT gen_random_uuid(),
+    source_id bigint NOT NULL REFERENCES deal_lead_source (id),
+    group_id bigint NOT NULL,
+    entity_stage_id bigint,
+    name text NOT NULL,
+    expected_revenue numeric,
+    expected_close_date date,
+    close_date date,
+    score integer,
+    owner_id uuid NOT NULL,
+    created_by uuid NOT NULL,
+    created_at timestamptz NOT NULL DEFAULT now(),
+    last_updated_by uuid,
+    last_updated_at timestamptz
+);
+
+CREATE TABLE lead (
+    id uuid PRIMARY KEY DEFAULT gen_random_uuid(),
+    phone_book_id bigint NOT NULL REFERENCES phone_book (id),
+    source_id bigint NOT NULL REFERENCES deal_lead_source (id),
+    group_id bigint NOT NULL,
+    entity_stage_id bigint,
+    entity_priority_id bigint,
+    converted_deal_id uuid,
+    score integer,
+    owner_id uuid NOT NULL,
+    created_by uuid NOT NULL,
+    created_at timestamptz NOT NULL DEFAULT now(),
+    last_updated_by uuid,
+    last_updated_at timestamptz
+);
+
+CREATE TABLE entity_integration (
+    id bigint GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    entity_based_id uuid NOT NULL,
+    salesforce_id text NOT NULL,
+    entity_type_id integer NOT NULL
+);
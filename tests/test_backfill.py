@@ -0,0 +1,77 @@
+import pytest
+
+from sync import fakes
+from sync.accounts import Accounts
+from sync.backfill import Backfill
+from sync.clients import registry
+from sync.contacts import Contacts
+from sync.deals import Deals
+from sync.fakes import FakeIntegrationApp, MemoryClient
+from sync.leads import Leads
+
+LISTINGS = {"get-all-accounts": "account", "get-contacts": "contact", "get-deals": "deal", "get-leads": "lead"}
+
+
+def test_export_after_backfill_sends_nothing_back():
+    listings = {action: fakes.salesforce_records(5, entity) for action, entity in LISTINGS.items()}
+    client, fake = MemoryClient(), FakeIntegrationApp(listings=listings)
+    fakes.seed(client, 0)
+    with registry.use(client):
+        backfill = Backfill(fakes.TENANT_ID, fakes.OWNER_ID, ":memory:", access_token="token", session=fake)
+        backfill.checkpoint.save = lambda: None
+        backfill.run()
+        assert {link["sync_origin"] for link in client.tables["entity_integration"]} == {"salesforce"}
+        assert all(link["salesforce_updated_at"] == fakes.CREATED for link in client.tables["entity_integration"])
+
+        fake.calls = []
+        fake.records = {link["salesforce_id"]: {} for link in client.tables["entity_integration"]}
+        for cls, export in ((Accounts, "to_salesforce"), (Contacts, "to_salesforce_contacts"),
+                            (Deals, "to_salesforce_deals"), (Leads, "to_salesforce_leads")):
+            exporter = cls("token", "")
+            exporter.session = fake
+            getattr(exporter, export)(fakes.OWNER_ID)
+        assert fake.calls == []
+        # The rows were settled with their export hashes, by id
+        assert ("update_entity_integration", "rpc") in client.calls
+        assert all(link.get("export_hash") for link in client.tables["entity_integration"])
+
+
+class CrashingClient(MemoryClient):
+    """Fails the ``crash_at``-th insert into ``table``, as if the process died there."""
+
+    def __init__(self, table: str, crash_at: int):
+        super().__init__()
+        self.crash_table, self.crash_at, self.inserts = table, crash_at, 0
+
+    def execute(self, query):
+        if query._operation == "insert" and query._table == self.crash_table:
+            self.inserts += 1
+            if self.inserts == self.crash_at:
+                raise ConnectionError("killed")
+        return super().execute(query)
+
+
+def test_backfill_resumed_after_a_crash_between_inserts_writes_each_record_once(tmp_path):
+    checkpoint = str(tmp_path / "backfill.json")
+    fake = FakeIntegrationApp(listings={"get-all-accounts": fakes.salesforce_records(5, "account")})
+    client = CrashingClient("account", crash_at=2)
+    fakes.seed(client, 0)
+    with registry.use(client):
+        with pytest.raises(ConnectionError):
+            Backfill(fakes.TENANT_ID, fakes.OWNER_ID, checkpoint, ("account",), write_size=2, access_token="token",
+                     session=fake).run()
+        assert len(client.tables["account"]) == 2
+        assert len(client.tables["phone_book"]) == 5
+
+        client.crash_at = None
+        state = Backfill(fakes.TENANT_ID, fakes.OWNER_ID, checkpoint, ("account",), write_size=2,
+                         access_token="token", session=fake).run()
+
+    accounts = client.tables["account"]
+    # The 2 accounts inserted before the crash are linked on resume, and skipped when fetched again
+    assert (state["account"]["imported"], state["account"]["skipped"]) == (3, 2)
+    assert len(accounts) == 5
+    assert sorted(link["entity_based_id"] for link in client.tables["entity_integration"]) == \
+        sorted(account["id"] for account in accounts)
+    # The parent rows of the 3 accounts the crash kept from being inserted were deleted, not orphaned
+    assert sorted(row["id"] for row in client.tables["phone_book"]) == sorted(a["phone_book_id"] for a in accounts)
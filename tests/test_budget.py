@@ -0,0 +1,8 @@
+from sync import budget
+
+
+def test_every_path_is_within_budget():
+    results = budget.check((50, 400))
+
+    assert {r["path"] for r in results} == set(budget.BUDGETS)
+    assert [r for r in results if not r["ok"]] == []
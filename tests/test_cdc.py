@@ -0,0 +1,58 @@
+import pytest
+
+from sync import fakes
+from sync.cdc import ChangeEvent, export_handler
+from sync.clients import registry
+from sync.fakes import FakeIntegrationApp, MemoryClient
+from sync.main import ENTITY_CLASSES
+
+
+class Service:
+    def __init__(self, fake: FakeIntegrationApp):
+        self.exporters = {}
+        for entity, cls in ENTITY_CLASSES.items():
+            self.exporters[entity] = cls("token", "")
+            self.exporters[entity].session = fake
+
+    def tenant_for_user(self, user_id):
+        return fakes.TENANT_ID if user_id == fakes.OWNER_ID else None
+
+    def exporter(self, tenant_id, entity):
+        return self.exporters[entity]
+
+
+@pytest.fixture
+def client():
+    memory = MemoryClient()
+    fakes.seed(memory, 3)
+    with registry.use(memory):
+        yield memory
+
+
+def test_phone_book_change_exports_its_entities(client):
+    fake = FakeIntegrationApp()
+    fake.records = {row["salesforce_id"]: {} for row in client.tables["entity_integration"]}
+    # phone_book 2 is account 2's, phone_book 5 contact 2's, phone_book 8 lead 2's
+    export_handler(Service(fake))([ChangeEvent("phone_book", "update", {"id": phone_book_id}, i)
+                                   for i, phone_book_id in enumerate((2, 5, 8))])
+    assert sorted(action for action, _ in fake.calls) == ["create-contact", "create-lead", "update-account"]
+
+
+def test_deal_lead_source_change_exports_deals_and_leads(client):
+    fake = FakeIntegrationApp()
+    # deal_lead_source 1 is deal 1's, 4 lead 1's
+    export_handler(Service(fake))([ChangeEvent("deal_lead_source", "update", {"id": 1}, 1),
+                                   ChangeEvent("deal_lead_source", "update", {"id": 4}, 2)])
+    assert sorted(action for action, _ in fake.calls) == ["create-deal", "create-lead"]
+
+
+def test_delete_only_deletes_in_salesforce_and_unlinks(client):
+    fake = FakeIntegrationApp()
+    fake.records = {row["salesforce_id"]: {} for row in client.tables["entity_integration"]}
+    client.tables["account"] = [row for row in client.tables["account"] if row["id"] != "acc-1"]
+    client.reset_calls()
+    export_handler(Service(fake))([ChangeEvent("account", "delete", {"id": "acc-1", "owner_id": fakes.OWNER_ID}, 1)])
+    assert fake.calls == [("delete-records", 1)]
+    assert "001000000000001" not in fake.records
+    assert [row["entity_based_id"] for row in client.tables["entity_integration"]] == ["acc-2", "acc-3"]
+    assert ("account", "delete") not in client.calls
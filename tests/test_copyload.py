@@ -0,0 +1,131 @@
+import json
+
+import pytest
+
+from sync import fakes
+from sync.clients import registry
+from sync.enums import EntityType
+from sync.fakes import MemoryClient
+from sync.main import ENTITY_CLASSES
+
+OWNER_ID = fakes.OWNER_ID
+
+
+def _batch(entity: str, n: int):
+    """Keys, parents and rows of ``n`` records as the backfill hands them to the loader."""
+    cls = ENTITY_CLASSES[entity]
+    records = fakes.salesforce_records(n, entity)
+    references = MemoryClient()
+    fakes.seed(references, 0)
+    with registry.use(references):
+        payloads = [cls.map_o(record, fakes.TENANT_ID, OWNER_ID) for record in records]
+    parents = {column: (table, [payload[key] for payload in payloads])
+               for key, (table, column) in cls.import_parents.items()}
+    return [record["id"] for record in records], parents, [dict(payload[entity]) for payload in payloads]
+
+
+@pytest.fixture
+def loader(postgres):
+    from sync.copyload import CopyLoader
+
+    dsn, schema, _ = postgres
+    loader = CopyLoader(dsn, schema)
+    yield loader
+    loader.close()
+
+
+def _query(postgres, sql: str, params=()) -> list:
+    _, schema, connection = postgres
+    with connection.cursor() as cursor:
+        cursor.execute(f'SET search_path TO "{schema}"')
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+@pytest.mark.parametrize("entity", ["account", "deal", "lead"])
+def test_load_merges_parents_entities_and_links(postgres, loader, entity):
+    keys, parents, rows = _batch(entity, 5)
+    entity_type = EntityType[entity.upper()]
+
+    assert loader.load(entity_type, entity, keys, parents, rows) == 5
+
+    links = dict(_query(postgres, "SELECT salesforce_id, entity_based_id FROM entity_integration"
+                                  " WHERE entity_type_id = %s", (entity_type.value,)))
+    assert sorted(links) == sorted(keys)
+    for column, (table, _) in parents.items():
+        joined = _query(postgres, f"SELECT count(*) FROM {entity} e JOIN {table} p ON p.id = e.{column}")
+        assert joined == [(5,)]
+    assert _query(postgres, f"SELECT count(*) FROM {entity} WHERE id IN %s", (tuple(links.values()),)) == [(5,)]
+
+
+def test_load_marks_links_as_imported(postgres, loader):
+    keys, parents, rows = _batch("deal", 3)
+    updated_at = [fakes.CREATED, fakes.UPDATED, None]
+
+    assert loader.load(EntityType.DEAL, "deal", keys, parents, rows, updated_at) == 3
+
+    links = _query(postgres, "SELECT salesforce_id, sync_origin, salesforce_updated_at IS NOT NULL,"
+                             " synced_at IS NOT NULL FROM entity_integration ORDER BY salesforce_id")
+    assert links == [(keys[0], "salesforce", True, True), (keys[1], "salesforce", True, True),
+                     (keys[2], "salesforce", False, True)]
+
+
+def test_update_entity_integration_updates_partial_rows(postgres, loader):
+    keys, parents, rows = _batch("account", 2)
+    loader.load(EntityType.ACCOUNT, "account", keys, parents, rows, [fakes.CREATED] * 2)
+    first, second = [row[0] for row in _query(postgres, "SELECT id FROM entity_integration ORDER BY id")]
+
+    rows = [{"id": first, "export_hash": "a"}, {"id": second, "salesforce_updated_at": fakes.UPDATED},
+            {"id": -1, "export_hash": "gone"}]
+    assert _query(postgres, "SELECT update_entity_integration(%s::jsonb)", (json.dumps(rows),)) == [(2,)]
+
+    links = _query(postgres, "SELECT export_hash, sync_origin, salesforce_updated_at = %s::timestamptz"
+                             " FROM entity_integration ORDER BY id", (fakes.UPDATED,))
+    assert links == [("a", "salesforce", False), (None, "salesforce", True)]
+
+
+def test_update_rows_updates_partial_rows(postgres, loader):
+    keys, parents, rows = _batch("account", 2)
+    loader.load(EntityType.ACCOUNT, "account", keys, parents, rows)
+    accounts = [row[0] for row in _query(postgres, "SELECT id::text FROM account ORDER BY phone_book_id")]
+    phone_books = [row[0] for row in _query(postgres, "SELECT id FROM phone_book ORDER BY id")]
+
+    rows = [{"id": phone_books[0], "first_name": "Renamed", "do_not_call": True},
+            {"id": phone_books[1], "last_updated_at": fakes.UPDATED}, {"id": -1, "first_name": "gone"}]
+    assert _query(postgres, "SELECT update_rows('phone_book', %s::jsonb)", (json.dumps(rows),)) == [(2,)]
+    rows = [{"id": accounts[1], "no_of_employees": 12}]
+    assert _query(postgres, "SELECT update_rows('account', %s::jsonb)", (json.dumps(rows),)) == [(1,)]
+
+    phone_book = _query(postgres, "SELECT first_name, do_not_call, last_updated_at = %s::timestamptz, created_by"
+                                  " FROM phone_book ORDER BY id", (fakes.UPDATED,))
+    assert [row[:2] for row in phone_book] == [("Renamed", True), ("account 2", None)]
+    assert phone_book[1][2] is True
+    assert all(row[3] == OWNER_ID for row in phone_book)
+    assert _query(postgres, "SELECT no_of_employees FROM account ORDER BY phone_book_id") == [(10,), (12,)]
+
+
+def test_load_skips_records_linked_since(postgres, loader):
+    keys, parents, rows = _batch("account", 4)
+    assert loader.load(EntityType.ACCOUNT, "account", keys[:2], {c: (t, r[:2]) for c, (t, r) in parents.items()},
+                       rows[:2]) == 2
+
+    assert loader.load(EntityType.ACCOUNT, "account", keys, parents, rows) == 2
+
+    assert _query(postgres, "SELECT count(*) FROM account") == [(4,)]
+    assert _query(postgres, "SELECT count(*) FROM phone_book") == [(4,)]
+    assert _query(postgres, "SELECT count(DISTINCT salesforce_id) FROM entity_integration") == [(4,)]
+
+
+def test_failed_load_leaves_nothing_behind(postgres, loader):
+    keys, parents, rows = _batch("account", 3)
+    rows[2]["owner_id"] = None  # violates account.owner_id NOT NULL on merge
+
+    with pytest.raises(Exception):
+        loader.load(EntityType.ACCOUNT, "account", keys, parents, rows)
+
+    assert _query(postgres, "SELECT count(*) FROM phone_book") == [(0,)]
+    assert _query(postgres, "SELECT count(*) FROM account") == [(0,)]
+    assert _query(postgres, "SELECT count(*) FROM entity_integration") == [(0,)]
+    # The connection is usable again
+    assert loader.load(EntityType.ACCOUNT, "account", keys[:2], {c: (t, r[:2]) for c, (t, r) in parents.items()},
+                       rows[:2]) == 2
@@ -0,0 +1,118 @@
+import pytest
+
+from sync import fakes, integration
+from sync.accounts import Accounts
+from sync.clients import registry
+from sync.contacts import Contacts
+from sync.enums import EntityType
+from sync.fakes import FakeIntegrationApp, MemoryClient
+
+
+@pytest.fixture
+def client():
+    memory = MemoryClient()
+    fakes.seed(memory, 8)
+    with registry.use(memory):
+        yield memory
+
+
+def _first_name(record: dict) -> str:
+    return record["phone_book"]["first_name"]
+
+
+def test_export_batched_maps_results_by_position(client):
+    # acc-1 to acc-4 are linked: acc-2's update is rejected, acc-3's record was deleted in Salesforce.
+    # acc-5 to acc-8 are new: acc-6's create is rejected, acc-7 matches an existing record.
+    client.tables["entity_integration"] = [link for link in client.tables["entity_integration"]
+                                           if link["entity_based_id"] in ("acc-1", "acc-2", "acc-3", "acc-4")]
+    failing = {("update", "First 2"): "FIELD_CUSTOM_VALIDATION_EXCEPTION",
+               ("create", "First 6"): "REQUIRED_FIELD_MISSING"}
+    fake = FakeIntegrationApp(fail=lambda action, record: failing.get((action, _first_name(record))),
+                              duplicates=lambda record: "001DUPLICATE" if _first_name(record) == "First 7" else None)
+    fake.records = {"001000000000001": {}, "001000000000002": {}, "001000000000004": {}, "001DUPLICATE": {}}
+    accounts = Accounts("token", "", batch_size=3)
+    accounts.session = fake
+
+    results = accounts.export_by_ids([f"acc-{i}" for i in range(1, 9)])
+
+    assert results == {"acc-1": True, "acc-2": False, "acc-3": True, "acc-4": True,
+                       "acc-5": True, "acc-6": False, "acc-7": True, "acc-8": True}
+    links = {link["entity_based_id"]: link["salesforce_id"] for link in client.tables["entity_integration"]}
+    assert set(links) == {"acc-1", "acc-2", "acc-3", "acc-4", "acc-5", "acc-7", "acc-8"}
+    assert links["acc-2"] == "001000000000002"
+    assert links["acc-3"] != "001000000000003"
+    assert links["acc-7"] == "001DUPLICATE"
+    # Every link points at the Salesforce record holding that row's payload
+    phone_books = {row["id"]: row for row in client.tables["phone_book"]}
+    for account in client.tables["account"]:
+        if account["id"] in links and account["id"] != "acc-2":
+            expected = phone_books[account["phone_book_id"]]["first_name"]
+            assert _first_name(fake.records[links[account["id"]]]) == expected, account["id"]
+    # Two update batches and two create batches, then acc-3 retried as a create and acc-7 as an update
+    assert fake.calls == [("batch-update-accounts", 3), ("batch-update-accounts", 1),
+                          ("batch-create-accounts", 3), ("batch-create-accounts", 1),
+                          ("batch-create-accounts", 1), ("batch-update-accounts", 1)]
+
+
+def test_batch_results_without_one_result_per_record_fail_the_batch():
+    class Response:
+        status_code = 200
+        text = "{}"
+
+        @staticmethod
+        def json():
+            return {"output": [{"id": "001A", "success": True, "errors": []}]}
+
+    results = integration.batch_results(Response(), 2)
+    assert [result["success"] for result in results] == [False, False]
+    assert results[0]["errors"][0]["statusCode"] == "BAD_BATCH_RESPONSE"
+
+
+def test_update_changed_updates_by_id_without_upserts(client):
+    # deal-2 and deal-3 share a change, deal-1 and deal-4 have their own, deal-5 is unchanged
+    client.reset_calls()
+    rows = [("deal-1", {"score": 70, "name": "Deal 1"}), ("deal-2", {"score": 70}), ("deal-3", {"score": 70}),
+            ("deal-4", {"name": "Renamed"}), ("deal-5", {"score": 50, "name": "Deal 5"})]
+
+    assert integration.update_changed("deal", rows) == 4
+
+    assert client.calls == [("deal", "select"), ("deal", "update"), ("update_rows", "rpc")]
+    deals = {row["id"]: row for row in client.tables["deal"]}
+    assert [deals[f"deal-{i}"]["score"] for i in range(1, 6)] == [70, 70, 70, 50, 50]
+    assert deals["deal-4"]["name"] == "Renamed"
+    assert deals["deal-4"]["owner_id"] == fakes.OWNER_ID
+
+
+def test_delete_of_a_record_already_gone_from_salesforce_succeeds(client):
+    accounts = Accounts("token", "")
+    accounts.session = FakeIntegrationApp()  # has no records, so the delete answers 404
+
+    assert accounts.delete_from_salesforce("001000000000001") is True
+    assert "acc-1" not in {account["id"] for account in client.tables["account"]}
+    assert "001000000000001" not in {link["salesforce_id"] for link in client.tables["entity_integration"]}
+
+
+def test_import_follows_the_cursor_past_the_first_page(client):
+    accounts = Accounts("token", "")
+    accounts.session = FakeIntegrationApp(listings={"get-all-accounts": fakes.salesforce_records(5, "account")},
+                                          page_size=2)
+    client.tables["entity_integration"] = []
+
+    assert accounts.from_salesforce(fakes.OWNER_ID, fakes.TENANT_ID)["inserted"] == 5
+    assert accounts.session.calls == [("get-all-accounts", 1)] * 3
+
+
+def test_import_looks_up_a_stale_cached_reference_again(client):
+    contacts = Contacts("token", "")
+    contacts.session = FakeIntegrationApp(listings={"get-contacts": fakes.salesforce_records(1, "contact")})
+    with integration.use_id_map(integration.IdMap()):
+        assert integration.fetch_imported(EntityType.ACCOUNT, ["001000000000001"]) == {"001000000000001": "acc-1"}
+        # Another worker deleted the account and its link, then imported it again as a new row
+        account = next(account for account in client.tables["account"] if account["id"] == "acc-1")
+        account["id"] = "acc-new"
+        link = next(link for link in client.tables["entity_integration"] if link["entity_based_id"] == "acc-1")
+        link["entity_based_id"] = "acc-new"
+
+        assert contacts.from_salesforce_contacts(fakes.OWNER_ID, fakes.TENANT_ID)["inserted"] == 1
+
+    assert client.tables["contact"][-1]["account_id"] == "acc-new"
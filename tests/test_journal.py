@@ -0,0 +1,36 @@
+import pytest
+import requests
+
+from sync import fakes
+from sync.accounts import Accounts
+from sync.clients import registry
+from sync.fakes import FakeIntegrationApp, MemoryClient
+from sync.journal import ExportJournal
+
+
+class FlakyIntegrationApp(FakeIntegrationApp):
+    """Fails with a connection error from the ``fail_at``-th call on."""
+
+    def __init__(self, fail_at: int):
+        super().__init__()
+        self.fail_at = fail_at
+
+    def post(self, url: str, json: dict = None, **kwargs):
+        if len(self.calls) + 1 >= self.fail_at:
+            raise requests.ConnectionError("connection reset")
+        return super().post(url, json=json, **kwargs)
+
+
+def test_export_that_raises_releases_its_unfinished_rows(tmp_path):
+    client = MemoryClient()
+    fakes.seed(client, 5)
+    client.tables["entity_integration"] = []
+    journal = ExportJournal(str(tmp_path / "journal.db"))
+    accounts = Accounts("token", "", journal=journal.for_tenant(fakes.TENANT_ID), batch_size=1)
+    accounts.session = FlakyIntegrationApp(fail_at=3)
+
+    with registry.use(client), pytest.raises(requests.ConnectionError):
+        accounts.to_salesforce(fakes.OWNER_ID)
+
+    # The first 2 accounts were exported, the other 3 are due for a retry instead of left running
+    assert journal.counts() == {"failed": 3}
@@ -0,0 +1,124 @@
+import time
+from datetime import datetime, timezone
+
+import pytest
+
+from sync import fakes, sb
+from sync.accounts import Accounts
+from sync.clients import registry
+from sync.fakes import FakeIntegrationApp, MemoryClient
+from sync.guards import GuardedSession
+from sync.lease import Fence, LeaseLostError, LeaseWorker, fenced
+from sync.main import Sync as MainSync
+
+TENANT_ID = 7
+
+
+class Sync:
+    """Stands in for ``main.Sync``, running ``stages`` as the one user's sync of the tenant's connection."""
+
+    def __init__(self, stages):
+        self.stages = stages
+        self.errors = []
+
+    def salesforce_conns(self, tenant_ids):
+        return [{"tenant_id": tenant_id, "connection_id": 1, "users": [{"user_id": 1}]} for tenant_id in tenant_ids]
+
+    def sync_connection(self, connection, directions):
+        try:
+            return {"import": {1: self.stages()}}
+        except LeaseLostError as exc:
+            self.errors.append(exc)
+            return {"import": {1: {"account": {"status": "failed", "seconds": 0.0, "error": repr(exc)}}}}
+
+
+@pytest.fixture
+def client():
+    memory = MemoryClient()
+    memory.tables["integration_connection"] = [{"tenant_id": TENANT_ID, "connection_key": "salesforce",
+                                                "connection_id": 1}]
+    memory.tables["account"] = []
+    with registry.use(memory):
+        yield memory
+
+
+def lease(client):
+    return client.tables["sync_lease"][0]
+
+
+def test_failed_stage_keeps_synced_at(client):
+    ok = {"account": {"status": "ok", "seconds": 0.0, "error": None}}
+    worker = LeaseWorker(Sync(lambda: ok), owner="a", heartbeat=3600)
+    assert worker.run_cycle() == {TENANT_ID: {"status": "ok", "error": None}}
+    synced_at = lease(client)["synced_at"]
+    assert synced_at is not None
+    lease(client)["next_sync_at"] = 0.0
+
+    worker.sync = Sync(lambda: {"account": {"status": "ok", "seconds": 0.0, "error": None},
+                                "contact": {"status": "failed", "seconds": 0.0, "error": "ValueError()"},
+                                "deal": {"status": "skipped", "seconds": 0.0, "error": None}})
+    results = worker.run_cycle()
+    assert results[TENANT_ID] == {"status": "failed", "error": "import contact: ValueError(); import deal: skipped"}
+    assert lease(client)["synced_at"] == synced_at
+    assert lease(client)["last_error"] == results[TENANT_ID]["error"]
+    assert lease(client)["owner"] is None
+
+
+def test_lost_lease_stops_the_sync(client):
+    def stages():
+        sb.table("account").select("id").execute()
+        lease(client)["owner"] = "b"  # another worker took the tenant over
+        worker.renew()
+        sb.table("account").select("id").execute()
+        return {"account": {"status": "ok", "seconds": 0.0, "error": None}}
+
+    sync = Sync(stages)
+    worker = LeaseWorker(sync, owner="a", heartbeat=3600)
+    results = worker.run_cycle()
+    assert [str(exc) for exc in sync.errors] == [f"Lost the lease of tenant {TENANT_ID}"]
+    assert results[TENANT_ID]["status"] == "failed"
+    assert lease(client)["owner"] == "b"
+
+
+def test_expired_lease_stops_the_sync(client):
+    def stages():
+        worker._fences[TENANT_ID].renewed_at -= worker.ttl  # no renewal came within the lease's ttl
+        sb.table("account").select("id").execute()
+
+    sync = Sync(stages)
+    worker = LeaseWorker(sync, owner="a", heartbeat=3600)
+    worker.run_cycle()
+    assert [str(exc) for exc in sync.errors] == [f"The lease of tenant {TENANT_ID} may have expired"]
+
+
+def test_lost_lease_stops_integration_app_requests():
+    fence = Fence(TENANT_ID, ttl=60.0, renewed_at=time.monotonic())
+    fence.lost.set()
+    with fenced(fence), pytest.raises(LeaseLostError):
+        GuardedSession().post(Accounts.import_url)  # raises before anything is sent
+
+
+def test_incremental_sync_imports_records_changed_during_the_last_one(client):
+    fakes.seed(client, 0)
+    records = fakes.salesforce_records(3, "account")
+    fake = FakeIntegrationApp(listings={"get-all-accounts": records})
+    imported = []
+
+    def stages():
+        accounts = Accounts("token", "", since=MainSync(mode="incremental").since_for(TENANT_ID))
+        accounts.session = fake
+        imported.append(accounts.from_salesforce(fakes.OWNER_ID, TENANT_ID))
+        if len(imported) == 1:
+            # Changed in Salesforce after the accounts were fetched, before the lease is released
+            time.sleep(0.01)
+            records[0]["updatedTime"] = datetime.now(timezone.utc).isoformat()
+            records[0]["fields"]["Phone"] = "555-0199"
+            time.sleep(0.01)
+        return {"account": {"status": "ok", "seconds": 0.0, "error": None}}
+
+    worker = LeaseWorker(Sync(stages), owner="a", heartbeat=3600)
+    worker.run_cycle()
+    lease(client)["next_sync_at"] = 0.0
+    worker.run_cycle()
+
+    assert imported == [{"inserted": 3, "updated": 0, "skipped": 0}, {"inserted": 0, "updated": 1, "skipped": 0}]
@@ -0,0 +1,15 @@
+import pytest
+
+from sync import main
+
+
+def test_unknown_entity_is_a_usage_error(capsys):
+    with pytest.raises(SystemExit) as exit_:
+        main.main(["--entities", "account,acount"])
+
+    assert exit_.value.code == 2
+    assert "unknown entity type(s) acount; choose from account, contact, deal, lead" in capsys.readouterr().err
+
+
+def test_entities_are_parsed_in_order():
+    assert main.entity_types("lead,account") == ("lead", "account")
@@ -0,0 +1,76 @@
+import json
+import uuid
+
+import pytest
+
+from sync import fakes
+from sync.clients import registry
+from sync.enums import EntityType
+from sync.fakes import FakeIntegrationApp, MemoryClient
+from sync.main import ENTITY_CLASSES
+from sync.reconcile import Reconciler, column_spec
+
+OTHER_TENANT_ID = fakes.TENANT_ID + 1
+OTHER_OWNER_ID = str(uuid.uuid4())
+
+
+@pytest.fixture
+def client():
+    """Accounts of two tenants: 4 linked ones of fakes.TENANT_ID, and 3 of another tenant."""
+    memory = MemoryClient()
+    fakes.seed(memory, 7)
+    for account in memory.tables["account"][4:]:
+        account["owner_id"] = OTHER_OWNER_ID
+    memory.tables["user_role"] = [{"user_id": fakes.OWNER_ID, "tenant_id": fakes.TENANT_ID},
+                                  {"user_id": OTHER_OWNER_ID, "tenant_id": OTHER_TENANT_ID}]
+    with registry.use(memory):
+        yield memory
+
+
+def test_links_of_other_tenants_are_not_extra(client):
+    # Salesforce has the tenant's first 3 accounts, so its fourth is the only extra one
+    fake = FakeIntegrationApp(listings={"get-all-accounts": fakes.salesforce_records(3, "account")})
+    result = Reconciler("account", fakes.TENANT_ID, fakes.OWNER_ID, "token", fake, leaf_size=2).run()
+
+    assert result["missing"] == []
+    assert result["extra"] == [{"salesforce_id": "001000000000004", "entity_based_id": "acc-4"}]
+
+
+def test_reconcile_functions_are_scoped_to_the_tenant(postgres):
+    from sync.copyload import CopyLoader
+
+    dsn, schema, connection = postgres
+    cls = ENTITY_CLASSES["account"]
+    records = fakes.salesforce_records(5, "account")
+    references = MemoryClient()
+    fakes.seed(references, 0)
+    with registry.use(references):
+        payloads = [cls.map_o(record, fakes.TENANT_ID, fakes.OWNER_ID) for record in records]
+    rows = [dict(payload["account"]) for payload in payloads]
+    for row in rows[3:]:
+        row["owner_id"] = OTHER_OWNER_ID
+    parents = {column: (table, [payload[key] for payload in payloads])
+               for key, (table, column) in cls.import_parents.items()}
+    loader = CopyLoader(dsn, schema)
+    try:
+        loader.load(EntityType.ACCOUNT, "account", [record["id"] for record in records], parents, rows)
+    finally:
+        loader.close()
+
+    spec = json.dumps([{key: column[key] for key in ("table", "via", "column")} for column in column_spec(cls)])
+    with connection.cursor() as cursor:
+        cursor.execute(f'SET search_path TO "{schema}"')
+        cursor.execute("INSERT INTO user_role (user_id, tenant_id) VALUES (%s, %s), (%s, %s)",
+                       (fakes.OWNER_ID, fakes.TENANT_ID, OTHER_OWNER_ID, OTHER_TENANT_ID))
+        leaves = {}
+        for tenant_id in (fakes.TENANT_ID, OTHER_TENANT_ID):
+            cursor.execute("SELECT salesforce_id FROM reconcile_leaves(%s, 'account', %s, '', %s, 'owner_id')",
+                           (EntityType.ACCOUNT.value, spec, tenant_id))
+            leaves[tenant_id] = sorted(row[0] for row in cursor.fetchall())
+        cursor.execute("SELECT sum(records) FROM reconcile_buckets(%s, 'account', %s, '', %s, 'owner_id')",
+                       (EntityType.ACCOUNT.value, spec, OTHER_TENANT_ID))
+        other_records = cursor.fetchone()[0]
+
+    assert leaves[fakes.TENANT_ID] == [record["id"] for record in records[:3]]
+    assert leaves[OTHER_TENANT_ID] == [record["id"] for record in records[3:]]
+    assert other_records == 2
@@ -0,0 +1,108 @@
+import hashlib
+import hmac
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+from sync import fakes
+from sync.accounts import Accounts
+from sync.clients import registry
+from sync.fakes import FakeIntegrationApp, MemoryClient
+from sync.service import ExportService, authorized, make_server
+
+SECRET = "s3cret"
+
+
+@pytest.fixture
+def client():
+    memory = MemoryClient()
+    fakes.seed(memory, 1)
+    memory.tables["entity_integration"] = []
+    memory.tables["user_role"] = [{"user_id": fakes.OWNER_ID, "tenant_id": fakes.TENANT_ID},
+                                  {"user_id": "someone-else", "tenant_id": 8}]
+    memory.tables["integration_connection"] = [{"tenant_id": tenant_id, "connection_key": "salesforce",
+                                                "connection_details": {"access_token": f"t{tenant_id}"}}
+                                               for tenant_id in (fakes.TENANT_ID, 8)]
+    with registry.use(memory):
+        yield memory
+
+
+def _service(tenant_id, fake: FakeIntegrationApp) -> ExportService:
+    service = ExportService()
+    accounts = Accounts(f"t{tenant_id}", "")
+    accounts.session = fake
+    service._exporters[(tenant_id, "account")] = (f"t{tenant_id}", accounts)
+    return service
+
+
+def test_exports_a_record_of_the_events_tenant(client):
+    fake = FakeIntegrationApp()
+    _service(fakes.TENANT_ID, fake).handle((fakes.TENANT_ID, "account", "acc-1"), 0.0)
+    assert [action for action, _ in fake.calls] == ["create-accounts"]
+    assert client.tables["entity_integration"][0]["entity_based_id"] == "acc-1"
+
+
+def test_rejects_a_record_of_another_tenant(client):
+    fake = FakeIntegrationApp()
+    _service(8, fake).handle((8, "account", "acc-1"), 0.0)
+    assert fake.calls == []
+    assert not client.tables.get("entity_integration")
+
+
+def test_exports_a_record_whose_owner_has_roles_in_several_tenants(client):
+    client.tables["user_role"].insert(0, {"user_id": fakes.OWNER_ID, "tenant_id": 8})
+    fake = FakeIntegrationApp()
+    _service(fakes.TENANT_ID, fake).handle((fakes.TENANT_ID, "account", "acc-1"), 0.0)
+    assert [action for action, _ in fake.calls] == ["create-accounts"]
+
+
+def test_a_role_granted_after_a_rejected_event_is_found(client):
+    client.tables["user_role"] = []
+    fake = FakeIntegrationApp()
+    service = _service(fakes.TENANT_ID, fake)
+    service.handle((fakes.TENANT_ID, "account", "acc-1"), 0.0)
+    assert fake.calls == []
+
+    client.tables["user_role"] = [{"user_id": fakes.OWNER_ID, "tenant_id": fakes.TENANT_ID}]
+    service.handle((fakes.TENANT_ID, "account", "acc-1"), 0.0)
+    assert [action for action, _ in fake.calls] == ["create-accounts"]
+
+
+def test_authorized():
+    body = b'{"tenant_id": 7}'
+    signature = "sha256=" + hmac.new(SECRET.encode(), body, hashlib.sha256).hexdigest()
+    assert authorized({"X-Sync-Signature": signature}, body, SECRET)
+    assert not authorized({"X-Sync-Signature": signature}, body + b" ", SECRET)
+    assert authorized({"Authorization": f"Bearer {SECRET}"}, body, SECRET)
+    assert not authorized({"Authorization": "Bearer nope"}, body, SECRET)
+    assert not authorized({}, body, SECRET)
+
+
+def test_server_requires_the_secret():
+    class Debouncer:
+        keys = []
+
+        def submit(self, key, received=None):
+            self.keys.append(key)
+            return True
+
+    debouncer = Debouncer()
+    with pytest.raises(ValueError):
+        make_server("127.0.0.1", 0, debouncer, "")
+    server = make_server("127.0.0.1", 0, debouncer, SECRET)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/events"
+    body = json.dumps({"tenant_id": 7, "entity": "account", "id": "acc-1"}).encode()
+    try:
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(urllib.request.Request(url, body, method="POST"))
+        assert error.value.code == 401
+        request = urllib.request.Request(url, body, {"Authorization": f"Bearer {SECRET}"}, method="POST")
+        assert urllib.request.urlopen(request).status == 202
+        assert debouncer.keys == [(7, "account", "acc-1")]
+    finally:
+        server.shutdown()
+        server.server_close()